@@ -0,0 +1,141 @@
+"""Non-blocking access to a Store.
+
+The operations of the store run in a pool of threads and return
+concurrent.futures.Future instances, which need the futures package
+on Python 2.  They can be waited on with result(), chained with
+add_done_callback() or, on Python 3, awaited with asyncio.wrap_future.
+"""
+
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from thunder.cache import LockedCache
+
+
+class AsyncStore(object):
+    """Runs the blocking operations of a store in an executor.
+
+    Operations are run one at a time, queries after the flushes
+    submitted before them.  The changes of different collections are
+    flushed concurrently.  The store must not be used directly while
+    operations are pending.
+    """
+
+    def __init__(self, store, executor=None, max_workers=4):
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self.store = store
+        self.executor = executor
+        store._cache = LockedCache(store._cache)
+        self._lock = threading.RLock()
+        # The number of flushes submitted and done, an operation waits
+        # for the flushes submitted before it without holding the lock.
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._flushed = 0
+
+    def _wait_flushed(self, ticket):
+        with self._cond:
+            while self._flushed < ticket:
+                self._cond.wait()
+
+    def _submit(self, func, *args, **kwargs):
+        with self._cond:
+            ticket = self._submitted
+
+        def call():
+            self._wait_flushed(ticket)
+            with self._lock:
+                return func(*args, **kwargs)
+        return self.executor.submit(call)
+
+    def get(self, cls, obj_id):
+        return self._submit(self.store.get, cls, obj_id)
+
+    def get_many(self, cls, obj_ids):
+        return self._submit(self.store.get_many, cls, obj_ids)
+
+    def find_one(self, cls, *args, **kwargs):
+        return self._submit(self.store.find_one, cls, *args, **kwargs)
+
+    def find(self, cls, *args, **kwargs):
+        """Returns a future with the list of matching objects, the
+        arguments are the ones of Store.find.
+        """
+        def find():
+            return list(self.store.find(cls, *args, **kwargs))
+        return self._submit(find)
+
+    def count(self, cls, *args, **kwargs):
+        return self._submit(self.store.count, cls, *args, **kwargs)
+
+    def add(self, obj):
+        self.store.add(obj)
+
+    def remove(self, obj):
+        self.store.remove(obj)
+
+    def flush(self):
+        """Flushes the pending changes in the executor and returns a
+        future with the number of objects flushed.
+
+        The changes of each collection are sent by a thread of their
+        own, the first exception raised by one of them is set on the
+        future.
+        """
+        with self._cond:
+            ticket = self._submitted
+            self._submitted += 1
+
+        def flush():
+            self._wait_flushed(ticket)
+            try:
+                with self._lock:
+                    return self._flush()
+            finally:
+                with self._cond:
+                    self._flushed += 1
+                    self._cond.notify_all()
+        return self.executor.submit(flush)
+
+    def _flush(self):
+        store = self.store
+        flushes = store._take_flushes()
+        by_collection = {}
+        for flush in flushes:
+            by_collection.setdefault(flush[1], []).append(flush)
+
+        errors = []
+
+        def run(group):
+            try:
+                for method, cls_info, obj_infos in group:
+                    method(cls_info, obj_infos)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        groups = by_collection.values()
+        threads = [threading.Thread(target=run, args=(group, ),
+                                    name='thunder-flush')
+                   for group in groups[1:]]
+        for thread in threads:
+            thread.start()
+        if groups:
+            run(groups[0])
+        for thread in threads:
+            thread.join()
+
+        store._invalidate_queries(flushes)
+        if errors:
+            store._restore_flushes(flushes)
+            exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        count = sum(len(flush[2]) for flush in flushes)
+        if store._listeners:
+            store._emit('flush', count)
+        return count
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
@@ -0,0 +1,367 @@
+"""Benchmarks for the hot paths of the store.
+
+Usage: python -m thunder.bench [options] [uri] [count]
+
+The uri defaults to memory://, the in-process engine.  The results are
+printed as JSON, for each benchmark:
+
+  ops_per_sec   operations per second, the best of --repeat runs
+  allocations   objects tracked by the garbage collector which were
+                left allocated, per operation
+  peak_rss_kb   peak resident set size of the process after it ran
+"""
+
+import decimal
+import gc
+import json
+import optparse
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from thunder.cache import QueryCache
+from thunder.events import Counters
+from thunder.fields import (DecimalField, IntField, ListField,
+                            ObjectIdField, StringField)
+from thunder.info import get_obj_info
+from thunder.reference import ReferenceField
+from thunder.sharedcache import SharedCache
+from thunder.store import Store
+
+
+class BenchOwner(object):
+    __thunder_doc__ = 'thunder_bench_owner'
+    name = StringField()
+
+
+class BenchDocument(object):
+    __thunder_doc__ = 'thunder_bench'
+    name = StringField()
+    count = IntField()
+    price = DecimalField()
+    tags = ListField()
+    owner_id = ObjectIdField()
+    owner = ReferenceField(owner_id, BenchOwner)
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of the process in KiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def measure(func, count, setup=None, repeat=3):
+    """Runs func repeat times, calling setup before each run, and
+    returns a dict with the results of the best run.
+    """
+    best = None
+    allocations = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            allocated = len(gc.get_objects()) - before
+        finally:
+            gc.enable()
+        del result
+        if best is None or elapsed < best:
+            best = elapsed
+        if allocations is None:
+            allocations = allocated
+    return dict(ops_per_sec=count / max(best, 1e-9),
+                allocations=float(allocations) / count,
+                peak_rss_kb=get_peak_rss())
+
+
+def create_documents(count, owners=()):
+    docs = []
+    for i in range(count):
+        doc = BenchDocument()
+        doc.name = u'Document %d' % (i, )
+        doc.count = i
+        doc.price = decimal.Decimal(i) / 4
+        doc.tags = [u'a', u'b']
+        if owners:
+            doc.owner = owners[i % len(owners)]
+        docs.append(doc)
+    return docs
+
+
+def populate(store, count):
+    """Stores count documents referencing count / 10 owners."""
+    store.drop_collection(BenchDocument)
+    store.drop_collection(BenchOwner)
+    owners = []
+    for i in range(max(count / 10, 1)):
+        owner = BenchOwner()
+        owner.name = u'Owner %d' % (i, )
+        store.add(owner)
+        owners.append(owner)
+    store.flush()
+    for doc in create_documents(count, owners):
+        store.add(doc)
+    store.flush()
+    store.drop_cache()
+
+
+def _sizeof(value):
+    size = sys.getsizeof(value)
+    if hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__)
+    return size
+
+
+def object_overhead(obj):
+    """Returns the number of bytes used by an object and its ObjectInfo,
+    not counting the field values themselves.
+    """
+    obj_info = get_obj_info(obj)
+    size = _sizeof(obj) + _sizeof(obj_info)
+    values = list(getattr(obj_info, '__dict__', {}).values())
+    for name in getattr(type(obj_info), '__slots__', ()):
+        values.append(getattr(obj_info, name, None))
+    for value in values:
+        if isinstance(value, (dict, list, set)):
+            size += sys.getsizeof(value)
+    return size
+
+
+def bench_memory(store, count, repeat):
+    """Average per object overhead of loaded objects, in bytes."""
+    objs = list(store.find(BenchDocument))
+    size = sum(object_overhead(obj) for obj in objs) / len(objs)
+    store.drop_cache()
+    return dict(bytes_per_object=size)
+
+
+def bench_find(store, count, repeat):
+    """Hydrating count objects with Store.find, also while reading the
+    documents ahead in a thread, and reading some of their fields with
+    Store.iter_values instead.
+    """
+    names = ['name', 'count', 'price']
+
+    def objects():
+        return list(store.find(BenchDocument))
+
+    def read_ahead():
+        return list(store.find(BenchDocument).read_ahead())
+
+    def values():
+        return list(store.iter_values(BenchDocument, names))
+
+    return dict(
+        find=measure(objects, count, store.drop_cache, repeat),
+        find_read_ahead=measure(read_ahead, count, store.drop_cache, repeat),
+        iter_values=measure(values, count, store.drop_cache, repeat))
+
+
+def bench_get(store, count, repeat):
+    """Store.get of each object, with an empty identity map, with the
+    documents in a SharedCache and with the objects already in the map.
+    """
+    obj_ids = [row[0] for row in store.iter_values(BenchDocument, ['_id'])]
+
+    def get():
+        return [store.get(BenchDocument, obj_id) for obj_id in obj_ids]
+
+    results = dict(get_cold=measure(get, count, store.drop_cache, repeat))
+    fd, path = tempfile.mkstemp(prefix='thunder-bench-')
+    os.close(fd)
+    store.shared_cache = SharedCache(path)
+    try:
+        get()
+        results['get_shared'] = measure(get, count, store.drop_cache,
+                                        repeat)
+    finally:
+        store.shared_cache.close()
+        store.shared_cache = None
+        os.remove(path)
+    objs = list(store.find(BenchDocument))
+    results['get_warm'] = measure(get, count, repeat=repeat)
+    del objs
+    store.drop_cache()
+    return results
+
+
+def bench_flush(store, count, repeat):
+    """Flushing count new objects and then count modified ones."""
+    docs = []
+
+    def setup():
+        store.find(BenchDocument, {'name': u'new'}).remove()
+        docs[:] = create_documents(count)
+        for doc in docs:
+            doc.name = u'new'
+
+    def insert():
+        for doc in docs:
+            store.add(doc)
+        store.flush()
+
+    def update():
+        for doc in docs:
+            doc.count += 1
+        store.flush()
+
+    results = dict(flush_new=measure(insert, count, setup, repeat))
+    results['flush_modified'] = measure(update, count, repeat=repeat)
+    store.find(BenchDocument, {'name': u'new'}).remove()
+    del docs[:]
+    store.drop_cache()
+    return results
+
+
+def bench_reference(store, count, repeat):
+    """Following a ReferenceField on loaded objects, the owners are
+    fetched with Store.get the first time they are accessed.
+    """
+    docs = []
+
+    def setup():
+        store.drop_cache()
+        docs[:] = store.find(BenchDocument)
+
+    def traverse():
+        return [doc.owner for doc in docs]
+
+    results = dict(reference=measure(traverse, count, setup, repeat))
+    del docs[:]
+    store.drop_cache()
+    return results
+
+
+def bench_query_cache(store, count, repeat):
+    """Running the same find_one_by query count times, without and with
+    a QueryCache.
+    """
+    objs = list(store.find(BenchDocument, limit=10))
+
+    def query():
+        return [store.find_one_by(BenchDocument, name=objs[i % 10].name)
+                for i in xrange(count)]
+
+    results = dict(find_one_by=measure(query, count, repeat=repeat))
+    store.query_cache = QueryCache()
+    try:
+        results['find_one_by_cached'] = measure(query, count, repeat=repeat)
+    finally:
+        store.query_cache = None
+    del objs[:]
+    store.drop_cache()
+    return results
+
+
+def bench_decimal(store, count, repeat):
+    """Encoding Decimal values with DecimalField and decoding them."""
+    field = BenchDocument.price
+    values = [decimal.Decimal(i) / 4 for i in range(count)]
+    encoded = [field.from_python(value) for value in values]
+
+    def encode():
+        return [field.from_python(value) for value in values]
+
+    def decode():
+        return [field.to_python(value) for value in encoded]
+
+    return dict(decimal_encode=measure(encode, count, repeat=repeat),
+                decimal_decode=measure(decode, count, repeat=repeat))
+
+
+def bench_events(store, count, repeat):
+    """Loading objects with a listener for all the store events, and
+    the cost of the check done for each event when nothing listens.
+    """
+    def load():
+        return list(store.find(BenchDocument))
+
+    counters = Counters()
+    store.add_listener(counters)
+    results = dict(
+        find_listener=measure(load, count, store.drop_cache, repeat))
+    store.remove_listener(counters)
+    store.drop_cache()
+
+    loops = 1000000
+    start = time.time()
+    for i in xrange(loops):
+        if store._listeners:
+            pass
+    checked = time.time() - start
+    start = time.time()
+    for i in xrange(loops):
+        pass
+    empty = time.time() - start
+    results['event_check_ns'] = (checked - empty) / loops * 1e9
+    return results
+
+
+benchmarks = [
+    bench_find,
+    bench_get,
+    bench_flush,
+    bench_reference,
+    bench_query_cache,
+    bench_decimal,
+    bench_memory,
+    bench_events,
+]
+
+
+def run(uri='memory://', count=10000, repeat=3, names=None):
+    """Runs the benchmarks, or the ones in names, against a database
+    at uri and returns a dict with the results.
+    """
+    store = Store(uri, 'thunder-bench')
+    populate(store, count)
+    results = {}
+    try:
+        for bench in benchmarks:
+            name = bench.__name__[len('bench_'):]
+            if names and name not in names:
+                continue
+            results.update(bench(store, count, repeat))
+    finally:
+        store.drop_collection(BenchDocument)
+        store.drop_collection(BenchOwner)
+    return dict(uri=uri, count=count, repeat=repeat,
+                python=platform.python_version(),
+                peak_rss_kb=get_peak_rss(), results=results)
+
+
+def main(args):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [uri] [count]',
+        description='Benchmarks: ' + ', '.join(
+            bench.__name__[len('bench_'):] for bench in benchmarks))
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs of each benchmark, the best one is kept')
+    parser.add_option('-b', '--bench', action='append', dest='names',
+                      help='only run this benchmark, can be repeated')
+    parser.add_option('-o', '--output',
+                      help='write the JSON results to this file')
+    options, args = parser.parse_args(args)
+    uri = args and args[0] or 'memory://'
+    count = len(args) > 1 and int(args[1]) or 10000
+    results = run(uri, count, options.repeat, options.names)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
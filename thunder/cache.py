@@ -0,0 +1,252 @@
+import collections
+import threading
+import time
+import weakref
+
+from thunder.info import get_obj_info
+
+
+class Cache(object):
+    """An identity map keeping a strong reference to every object
+    until it's cleared.
+
+    Objects are keyed by (cls_info, obj_id).
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, key):
+        obj = self._objects.get(key)
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return obj
+
+    def add(self, key, obj):
+        self._objects[key] = obj
+
+    def remove(self, key):
+        self._objects.pop(key, None)
+
+    def clear(self):
+        self._objects.clear()
+
+    def remove_class(self, cls_info):
+        """Removes and returns all the objects of a class."""
+        objs = []
+        for key in self._objects.keys():
+            if key[0] is cls_info:
+                objs.append(self._objects.pop(key))
+        return objs
+
+    def get_stats(self):
+        return dict(size=len(self), hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+class WeakCache(Cache):
+    """An identity map which only keeps weak references, objects are
+    evicted once they are no longer referenced and have been garbage
+    collected.
+
+    Objects with pending changes are referenced by the store until
+    they are flushed so they are never lost.
+    """
+
+    def __init__(self):
+        Cache.__init__(self)
+        self._selfref = weakref.ref(self)
+
+    def get(self, key):
+        ref = self._objects.get(key)
+        obj = ref and ref()
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return obj
+
+    def add(self, key, obj):
+        def collected(ref, key=key, selfref=self._selfref):
+            self = selfref()
+            if self is not None and self._objects.get(key) is ref:
+                del self._objects[key]
+                self.evictions += 1
+        self._objects[key] = weakref.ref(obj, collected)
+
+    def remove_class(self, cls_info):
+        objs = [ref() for ref in Cache.remove_class(self, cls_info)]
+        return [obj for obj in objs if obj is not None]
+
+
+class LRUCache(Cache):
+    """An identity map keeping at most size objects, the least recently
+    used ones are evicted first.
+
+    Objects with pending changes are never evicted, the map is allowed
+    to grow beyond size while they are waiting to be flushed.
+    """
+
+    def __init__(self, size=1000):
+        Cache.__init__(self)
+        self.size = size
+        self._objects = collections.OrderedDict()
+
+    def get(self, key):
+        obj = self._objects.pop(key, None)
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._objects[key] = obj
+        return obj
+
+    def add(self, key, obj):
+        self._objects.pop(key, None)
+        self._objects[key] = obj
+        self._evict()
+
+    def _evict(self):
+        objects = self._objects
+        excess = len(objects) - self.size
+        # Look at each object once at most, pending ones are moved to
+        # the end since they are still in use.  The last one was just
+        # added and is never evicted, the map grows instead.
+        for i in range(len(objects) - 1):
+            if excess <= 0:
+                break
+            key, obj = objects.popitem(last=False)
+            if get_obj_info(obj).flush_pending:
+                objects[key] = obj
+            else:
+                excess -= 1
+                self.evictions += 1
+
+
+class LockedCache(object):
+    """Wraps a cache so it can be used from several threads."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.cache)
+
+    def get(self, key):
+        with self._lock:
+            return self.cache.get(key)
+
+    def add(self, key, obj):
+        with self._lock:
+            self.cache.add(key, obj)
+
+    def remove(self, key):
+        with self._lock:
+            self.cache.remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+
+    def remove_class(self, cls_info):
+        with self._lock:
+            return self.cache.remove_class(cls_info)
+
+    def get_stats(self):
+        with self._lock:
+            return self.cache.get_stats()
+
+
+def _freeze(value):
+    # Hashable form of a query, the keys of dicts are sorted.
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class QueryCache(object):
+    """Caches the ids of the objects matching queries, which resolve
+    through the identity map of the store.  It's used by passing
+    query_cache=QueryCache() to Store.
+
+    Entries expire after ttl seconds and at most size of them are
+    kept, the least recently used ones are evicted first.  Flushing
+    objects of a collection invalidates the entries of its queries,
+    writes made by other stores are only seen once they expire.
+    """
+
+    def __init__(self, size=1000, ttl=60, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self._clock = clock
+        # key: (expires, generation, obj_ids)
+        self._entries = collections.OrderedDict()
+        # Bumped for a collection to invalidate its entries.
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_key(self, cls_info, spec, fields=None, options=None):
+        """Returns the key of a query, None if it can not be cached."""
+        key = (cls_info, _freeze(spec), _freeze(fields), _freeze(options))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        """Returns the tuple of ids cached for key, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            expires, generation, obj_ids = entry
+            current = self._generations.get(key[0].doc_name, 0)
+            if expires > self._clock() and generation == current:
+                self._entries[key] = entry
+                self.hits += 1
+                return obj_ids
+        self.misses += 1
+        return None
+
+    def add(self, key, obj_ids):
+        generation = self._generations.get(key[0].doc_name, 0)
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock() + self.ttl, generation,
+                              tuple(obj_ids))
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, cls_info):
+        """Invalidates the queries of the collection of cls_info, the
+        entries are dropped when they are next looked up or evicted.
+        """
+        name = cls_info.doc_name
+        self._generations[name] = self._generations.get(name, 0) + 1
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return dict(size=len(self), hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    invalidations=self.invalidations)
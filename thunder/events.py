@@ -0,0 +1,28 @@
+import collections
+
+# The events emitted by a store and their arguments, listeners are
+# called with the name of the event followed by them.
+EVENTS = (
+    'get',          # cls, obj_id
+    'find',         # cls, spec
+    'find_one',     # cls, spec
+    'count',        # cls, spec
+    'insert',       # cls, docs
+    'update',       # cls, spec, document
+    'remove',       # cls, spec
+    'flush',        # number of objects flushed
+    'cache_hit',    # cls, obj_id
+    'cache_miss',   # cls, obj_id
+    'hydrate',      # obj
+)
+
+
+class Counters(collections.Counter):
+    """A listener counting the events it receives.
+
+    When it's added with a sample_rate the counts are estimates of
+    count * sample_rate.
+    """
+
+    def __call__(self, name, *args):
+        self[name] += 1
@@ -4,3 +4,26 @@ class InvalidObject(Exception):
 
 class ValidationError(Exception):
     pass
+
+
+class NotOneError(Exception):
+    pass
+
+
+class ScanError(Exception):
+    """Raised by Store.parallel_scan when ranges failed.
+
+    results maps the ranges which were scanned to their results, errors
+    maps the failed ones to the traceback of the worker.  They can be
+    scanned again by passing ranges=error.failed.
+    """
+
+    def __init__(self, results, errors):
+        Exception.__init__(self, "%d ranges failed:\n%s" % (
+            len(errors), '\n'.join(errors.values())))
+        self.results = results
+        self.errors = errors
+
+    @property
+    def failed(self):
+        return sorted(self.errors)
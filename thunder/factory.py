@@ -0,0 +1,61 @@
+import contextlib
+import threading
+
+from thunder.store import Store, connect
+
+
+class StoreFactory(object):
+    """Creates stores sharing a single connection, and the pool of
+    sockets it keeps, and hands out one store per thread.
+
+        factory = StoreFactory('localhost', 'mydb')
+        store = factory.get()
+
+    Each store has its own unit of work and identity map, a store must
+    only be used by one thread.  Other keyword arguments are passed on
+    to Store, cache_factory is called to create the cache of each one.
+    """
+
+    def __init__(self, conn_string, database, cache_factory=None, **kwargs):
+        if isinstance(conn_string, basestring):
+            conn_string = connect(conn_string)
+        self.connection = conn_string
+        self.database = database
+        self.cache_factory = cache_factory
+        self._kwargs = kwargs
+        self._local = threading.local()
+
+    def create(self):
+        """Returns a new store."""
+        cache = None
+        if self.cache_factory is not None:
+            cache = self.cache_factory()
+        return Store(self.connection, self.database, cache=cache,
+                     **self._kwargs)
+
+    def get(self):
+        """Returns the store of the current thread, creating it the
+        first time.
+        """
+        store = getattr(self._local, 'store', None)
+        if store is None:
+            store = self._local.store = self.create()
+        return store
+
+    def release(self):
+        """Forgets the store of the current thread, its pending changes
+        are discarded.  The next get() returns a new store.
+        """
+        self._local.store = None
+
+    @contextlib.contextmanager
+    def session(self):
+        """Returns a context manager giving a new store which is flushed
+        at the end of the block, unless it raises an exception.
+
+            with factory.session() as store:
+                store.add(obj)
+        """
+        store = self.create()
+        yield store
+        store.flush()
@@ -2,29 +2,63 @@ import datetime
 import decimal
 import re
 
-from thunder.exceptions import ValidationError
-from thunder.info import get_obj_info
+from pymongo import ASCENDING, GEO2D
 
-Undef = object()
+from thunder.exceptions import ValidationError
+from thunder.index import Index
+from thunder.info import Undef, get_obj_info
 
 
 class Field(object):
-    def __init__(self, default=None, required=False, unique=False):
+    # Set for fields holding values which can be modified in place,
+    # reading them marks the object as possibly changed so the value
+    # is compared against the stored one when flushing.
+    mutable = False
+
+    # Set for fields holding large values, they are not loaded until
+    # they are accessed if the class sets __thunder_deferred__ = True.
+    deferrable = False
+
+    def __init__(self, default=None, required=False, unique=False,
+                 sparse=False, index=False, expire_after=None):
         self.default = default
         self.required = required
         self.unique = unique
+        self.sparse = sparse
+        # True or a direction such as pymongo.DESCENDING or GEO2D.
+        self.index = index
+        # Seconds after which the server removes the document, for
+        # fields holding a datetime.
+        self.expire_after = expire_after
 
     def __set__(self, obj, value):
         obj_info = get_obj_info(obj)
-        obj_info.variables[self] = self.from_python(value)
+        position = obj_info.cls_info.index[self]
+        obj_info.variables[position] = self.from_python(value)
+        obj_info.mark_changed(position)
+
+    def __delete__(self, obj):
+        obj_info = get_obj_info(obj)
+        position = obj_info.cls_info.index[self]
+        obj_info.variables[position] = Undef
+        obj_info.mark_changed(position)
 
     def __get__(self, obj, cls=None):
         if obj is None:
             return self
         obj_info = get_obj_info(obj)
-        value = obj_info.variables.get(self, Undef)
+        position = obj_info.cls_info.index[self]
+        value = obj_info.variables[position]
         if value is Undef:
-            return None
+            store = obj_info.store
+            if store is None or not obj_info.unloaded >> position & 1:
+                return None
+            store._load_deferred(obj_info)
+            value = obj_info.variables[position]
+            if value is Undef:
+                return None
+        if self.mutable:
+            obj_info.mark_accessed(position)
         return self.to_python(value)
 
     def to_python(self, value):
@@ -33,6 +67,19 @@ class Field(object):
     def from_python(self, value):
         return value
 
+    def get_index(self, name):
+        """Returns the Index declared by the options of this field when
+        it's stored as name, or None.
+        """
+        if not (self.index or self.unique or self.sparse or
+                self.expire_after is not None):
+            return None
+        direction = self.index
+        if direction is True or not direction:
+            direction = ASCENDING
+        return Index([(name, direction)], unique=self.unique,
+                     sparse=self.sparse, expire_after=self.expire_after)
+
 
 class ObjectIdField(Field):
     def __init__(self):
@@ -80,9 +127,9 @@ ComplexDateTimeField = DateTimeField
 
 class IntField(Field):
     def __init__(self, min_value=None, max_value=None, **kwargs):
-        self.min_value = kwargs.pop('min_value', None)
-        self.max_value = kwargs.pop('max_value', None)
-        Field.__init__(self, kwargs)
+        self.min_value = min_value
+        self.max_value = max_value
+        Field.__init__(self, **kwargs)
 
     def to_python(self, value):  # pragma: nocoverage
         try:
@@ -106,7 +153,8 @@ class DecimalField(Field):
         self.precision_multiplier = decimal.Decimal(
             10 ** -decimal.Decimal(self.precision))
         self.precision_check = precision_check
-        Field.__init__(self, default=decimal.Decimal("0"))
+        kwargs.setdefault('default', decimal.Decimal("0"))
+        Field.__init__(self, **kwargs)
 
     def _validate(self, value):  # pragma: nocoverage
         if self.min_value is not None and value < self.min_value:
@@ -160,17 +208,23 @@ class GenericReferenceField(Field):
 
 
 class ListField(Field):
-    pass
+    mutable = True
+    deferrable = True
 
 
 class DictField(Field):
+    mutable = True
+    deferrable = True
+
     def __init__(self):
         Field.__init__(self, default={})
 
 
 class GeoPointField(Field):
-    pass
+    def __init__(self, index=GEO2D, **kwargs):
+        Field.__init__(self, index=index, **kwargs)
 
 
 class EmbeddedDocumentField(Field):
-    pass
+    mutable = True
+    deferrable = True
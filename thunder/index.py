@@ -0,0 +1,53 @@
+from pymongo import ASCENDING
+
+
+class Index(object):
+    """An index on one or more fields of a class.
+
+    keys is a field name or a list of (field name, direction) pairs,
+    direction is pymongo.ASCENDING, DESCENDING or GEO2D.  expire_after
+    makes it a TTL index, documents are removed by the server that many
+    seconds after the date stored in the field.
+
+    Compound indexes are declared on the class:
+
+        class Person(object):
+            __thunder_indexes__ = [
+                Index([('last_name', ASCENDING), ('age', DESCENDING)]),
+            ]
+    """
+
+    def __init__(self, keys, unique=False, sparse=False, expire_after=None,
+                 name=None):
+        if isinstance(keys, basestring):
+            keys = [(keys, ASCENDING)]
+        self.keys = [tuple(key) for key in keys]
+        self.unique = unique
+        self.sparse = sparse
+        self.expire_after = expire_after
+        if name is None:
+            name = '_'.join('%s_%s' % key for key in self.keys)
+        self.name = name
+
+    def get_options(self):
+        """Returns the keyword arguments for Collection.create_index."""
+        options = dict(name=self.name)
+        if self.unique:
+            options['unique'] = True
+        if self.sparse:
+            options['sparse'] = True
+        if self.expire_after is not None:
+            options['expireAfterSeconds'] = self.expire_after
+        return options
+
+    def matches(self, info):
+        """Returns True if info, an item of the dict returned by
+        Collection.index_information, describes this index.
+        """
+        return ([tuple(key) for key in info['key']] == self.keys and
+                bool(info.get('unique')) == self.unique and
+                bool(info.get('sparse')) == self.sparse and
+                info.get('expireAfterSeconds') == self.expire_after)
+
+    def __repr__(self):  # pragma: nocoverage
+        return '<Index %s>' % (self.name, )
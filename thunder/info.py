@@ -1,5 +1,24 @@
+import copy
+import weakref
+
 from thunder.exceptions import InvalidObject
-from thunder.utils import TraceCollection
+from thunder.index import Index
+from thunder.utils import TraceCollection, row_type
+
+Undef = object()
+
+# The ClassInfos created by get_cls_info.
+_cls_infos = weakref.WeakSet()
+
+
+def iter_positions(mask):
+    """Yields the positions of the bits set in mask."""
+    position = 0
+    while mask:
+        if mask & 1:
+            yield position
+        mask >>= 1
+        position += 1
 
 
 def get_obj_info(obj):
@@ -16,18 +35,27 @@ def get_cls_info(cls):
         # Can't use attribute access here, otherwise subclassing won't work.
         return cls.__dict__["__thunder_class_info__"]
     else:
-        cls.__thunder_class_info__ = ClassInfo(cls)
-        return cls.__thunder_class_info__
+        cls_info = ClassInfo(cls)
+        cls.__thunder_class_info__ = cls_info
+        _cls_infos.add(cls_info)
+        return cls_info
+
+
+def get_cls_infos():
+    """Returns the ClassInfos of the classes used so far, sorted by
+    collection name.
+    """
+    return sorted(_cls_infos, key=lambda cls_info: cls_info.doc_name)
 
 
 class ClassInfo(object):
     def __init__(self, cls):
         self.cls = cls
         self.doc_name = cls.__dict__.get('__thunder_doc__', cls.__name__)
-        self.collection = None
 
         # FIXME: move this some place.
         from thunder.fields import Field
+        from thunder.reference import ReferenceField
         pairs = []
         for attr in dir(cls):
             field = getattr(cls, attr, None)
@@ -44,16 +72,142 @@ class ClassInfo(object):
         pairs.sort()
 
         self.fields = tuple(pair[1] for pair in pairs)
+        self.field_names = tuple(pair[0] for pair in pairs)
         self.attributes = dict(pairs)
+        self.mutable_positions = tuple(
+            position for position, field in enumerate(self.fields)
+            if field.mutable)
+
+        # Fields which are not loaded until they are accessed, True
+        # defers all the fields holding large values.
+        deferred = getattr(cls, '__thunder_deferred__', ())
+        if deferred is True:
+            deferred = [pair[0] for pair in pairs if pair[1].deferrable]
+        for attr in deferred:
+            if attr not in self.attributes:
+                raise InvalidObject(
+                    "Cannot defer %r, %s has no such field" % (
+                    attr, cls.__name__))
+        self.deferred = self.get_mask(deferred)
+        self.load_fields = [attr for attr in self.field_names
+                            if attr not in deferred]
+        self._row_decoders = {}
+
+        # Indexes declared by the field options and by the class,
+        # __thunder_indexes__ is a list of Index or of their keys.
+        indexes = {}
+        for attr, field in pairs:
+            index = field.get_index(attr)
+            if index is not None:
+                indexes[index.name] = index
+        for index in getattr(cls, '__thunder_indexes__', ()):
+            if not isinstance(index, Index):
+                index = Index(index)
+            for key, direction in index.keys:
+                if key.split('.')[0] not in self.attributes:
+                    raise InvalidObject(
+                        "Cannot index %r, %s has no such field" % (
+                        key, cls.__name__))
+            indexes[index.name] = index
+        self.indexes = tuple(index for name, index in sorted(indexes.items()))
+
+        # References return None when accessed through the class,
+        # look them up in the class dictionaries instead.
+        self.references = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if isinstance(value, ReferenceField):
+                    self.references[attr] = value
+
+        # Object variables are stored in a list, the values of the
+        # fields come first followed by the ones of the references.
+        references = tuple(pair[1] for pair in sorted(self.references.items()))
+        self.index = dict((field, position) for position, field
+                          in enumerate(self.fields + references))
+        self.size = len(self.index)
+        self.encode = self._compile_encoder()
+        self.decode = self._compile_decoder()
+
+    def get_mask(self, attrs):
+        """Returns a bit mask with the positions of the given fields."""
+        mask = 0
+        for attr in attrs:
+            mask |= 1 << self.field_names.index(attr)
+        return mask
+
+    def _compile_encoder(self):
+        names = self.field_names
+        # The defaults are stored like the values of their fields, eg
+        # a DecimalField stores an int.
+        defaults = [field.default if field.default is None
+                    else field.from_python(field.default)
+                    for field in self.fields]
+
+        def encode(variables):
+            """Returns the document for an object, unset fields get
+            their default value.
+            """
+            return dict(zip(names, [
+                default if value is Undef else value
+                for value, default in zip(variables, defaults)]))
+        return encode
+
+    def _compile_decoder(self):
+        names = self.field_names
+        undefs = [Undef] * len(names)
+        references = [Undef] * len(self.references)
+
+        def decode(doc):
+            """Returns the variables for an object loaded from doc."""
+            return map(doc.get, names, undefs) + references
+        return decode
 
     def get_collection(self, store):
-        if not self.collection:
+        collection = store._collections.get(self)
+        if collection is None:
             collection = store.database[self.doc_name]
-            if store.trace:
-                collection = TraceCollection(collection)
+            if store.trace or store.profiler is not None:
+                collection = TraceCollection(collection, store.profiler,
+                                             record=store.trace)
             store.collections.append(collection)
-            self.collection = collection
-        return self.collection
+            store._collections[self] = collection
+        return collection
+
+    def get_row_decoder(self, names):
+        """Returns a function converting a document into a row with the
+        values of the given attributes, converted with Field.to_python.
+        """
+        names = tuple(names)
+        decoder = self._row_decoders.get(names)
+        if decoder is not None:
+            return decoder
+
+        from thunder.fields import Field
+        converters = []
+        for name in names:
+            if name == '_id':
+                converters.append((name, None))
+                continue
+            field = self.attributes.get(name)
+            if field is None:
+                raise ValueError("%s has no field called %r" % (
+                    self.cls.__name__, name))
+            to_python = field.to_python
+            if to_python.__func__ is Field.to_python.__func__:
+                to_python = None
+            converters.append((name, to_python))
+
+        def decoder(doc, row=row_type(self.cls.__name__ + 'Row', names),
+                    converters=converters):
+            values = []
+            for name, to_python in converters:
+                value = doc.get(name)
+                if to_python is not None and value is not None:
+                    value = to_python(value)
+                values.append(value)
+            return row(values)
+        self._row_decoders[names] = decoder
+        return decoder
 
     def __repr__(self):  # pragma: nocoverage
         return '<ClassInfo (%s, %s)>' % (self.cls.__name__,
@@ -61,21 +215,68 @@ class ClassInfo(object):
 
 
 class ObjectInfo(object):
-    def __init__(self, obj):
+    __slots__ = ('obj', 'cls_info', 'store', 'action', 'variables',
+                 'saved', 'changes', 'unloaded', 'flush_pending',
+                 '__weakref__')
+
+    def __init__(self, obj, cls_info=None, variables=None):
+        if cls_info is None:
+            cls_info = get_cls_info(type(obj))
+        if variables is None:
+            variables = [Undef] * cls_info.size
         self.obj = obj
-        self.cls_info = get_cls_info(type(obj))
-        self._options = {}
-        self.variables = {}
+        self.cls_info = cls_info
+        self.store = None
+        self.action = None
+        # The values of the fields and references, indexed by their
+        # position in ClassInfo.index.
+        self.variables = variables
+        # Snapshot of the variables as they are stored in the database,
+        # None until the object has been loaded or flushed.
+        self.saved = None
+        # Bit masks of the positions of the fields modified since the
+        # last checkpoint and of the ones which were not fetched when
+        # the object was loaded.
+        self.changes = 0
+        self.unloaded = 0
         self.flush_pending = False
 
+    def checkpoint(self):
+        saved = self.variables[:]
+        # Mutable values can be modified in place, keep a private copy
+        # so they can be compared when flushing.
+        for position in self.cls_info.mutable_positions:
+            if saved[position] is not Undef:
+                saved[position] = copy.deepcopy(saved[position])
+        self.saved = saved
+        self.changes = 0
+
+    def mark_accessed(self, position):
+        # Mutable values read may be modified in place, they are
+        # compared when flushing but the object is not made pending.
+        if self.changes >> position & 1:
+            return
+        self.changes |= 1 << position
+        if not self.flush_pending:
+            store = self.store
+            if store is not None:
+                store._accessed.add(self)
+
+    def mark_changed(self, position):
+        self.changes |= 1 << position
+        if not self.flush_pending:
+            store = self.store
+            if store is not None:
+                store._set_dirty(self)
+
     def set(self, name, value):
-        self._options[name] = value
+        setattr(self, name, value)
 
     def get(self, name):
-        return self._options.get(name)
+        return getattr(self, name)
 
     def delete(self, name):
-        del self._options[name]
+        setattr(self, name, None)
 
     @property
     def doc_name(self):  # pragma: nocoverage
@@ -0,0 +1,196 @@
+"""Keeping the identity map of a long-lived store up to date.
+
+An OplogInvalidator tails the oplog of a replica set in a thread and
+evicts the cached objects whose documents are written by other
+processes, so the cache doesn't need to be dropped to see them:
+
+    invalidator = OplogInvalidator(store)
+    invalidator.start()
+
+The entries are queued by the thread and applied by the store itself
+when it's used, at the start of get, get_many, find and flush, so the
+identity map is only touched from the thread using the store.  Writes
+made by the store are skipped.
+
+A single server needs to run as a replica set to keep an oplog, eg
+started with mongod --replSet rs0 and rs.initiate() in the shell.
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+logger = logging.getLogger('thunder.invalidation')
+
+
+class OplogInvalidator(object):
+    """Evicts the objects of store modified by inserts, updates and
+    removes found in the oplog, or with refresh keeps them and loads
+    their fields again when accessed.
+
+    The objects are matched with the collections the store has used.
+    Objects with pending changes are left as they are, and so are the
+    ones the store wrote itself.
+    """
+
+    # Seconds the oplog entry of a write of the store may be read
+    # after the ones written later, eg as the clock of the server is
+    # behind.  Writes older than that with no entry, like updates
+    # matching nothing, are forgotten.
+    write_delay = 60
+
+    def __init__(self, store, refresh=False, poll_interval=1.0,
+                 oplog='oplog.rs'):
+        self.store = store
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.oplog = store.connection['local'][oplog]
+        self.invalidations = 0
+        self.last_ts = None
+        self._prefix = store.database.name + '.'
+        self._names = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        # Entries read by the thread, waiting to be applied.
+        self._queue = collections.deque()
+        # The time of the last entry applied, and of the last check for
+        # writes of the store which were forgotten.
+        self._applied = None
+        self._pruned = 0
+        store._invalidator = self
+        if store._written is None:
+            store._written = {}
+
+    def _get_cls_infos(self, name):
+        # The collections of the store are registered when it first
+        # uses them, look for new ones when a name is not known.
+        cls_infos = self._names.get(name)
+        if cls_infos is None:
+            names = {}
+            for cls_info in list(self.store._collections):
+                names.setdefault(cls_info.doc_name, []).append(cls_info)
+            self._names = names
+            cls_infos = names.get(name, ())
+        return cls_infos
+
+    def handle(self, entry):
+        """Invalidates the objects of an oplog entry, returns the
+        number of cached objects it matched.
+        """
+        ns = entry.get('ns', '')
+        if entry.get('op') not in ('i', 'u', 'd') or \
+           not ns.startswith(self._prefix):
+            return 0
+        if entry['op'] == 'u':
+            obj_id = entry['o2']['_id']
+        else:
+            obj_id = entry['o']['_id']
+        name = ns[len(self._prefix):]
+        if 'ts' in entry:
+            self._applied = entry['ts'].time
+
+        # Each write of the store has an entry of its own.
+        written = self.store._written
+        key = (name, obj_id)
+        item = written and written.get(key)
+        if item:
+            item[0] -= 1
+            if not item[0]:
+                del written[key]
+            return 0
+
+        count = 0
+        for cls_info in self._get_cls_infos(name):
+            if self.store._evict(cls_info, obj_id, self.refresh):
+                count += 1
+        self.invalidations += count
+        return count
+
+    def apply(self):
+        """Handles the entries queued by the thread, returns the number
+        of cached objects they matched.  It's called by the store.
+        """
+        queue = self._queue
+        count = 0
+        while queue:
+            count += self.handle(queue.popleft())
+        if self._applied is not None and \
+           time.time() - self._pruned > self.poll_interval:
+            self._prune(self._applied - self.write_delay)
+        return count
+
+    def _prune(self, before):
+        # Forgets the writes of the store made before the entries
+        # applied, their entries have been skipped or never come.
+        written = self.store._written
+        if written:
+            for key, item in written.items():
+                if item[1] < before:
+                    del written[key]
+        self._pruned = time.time()
+
+    def _get_last_ts(self):
+        for entry in self.oplog.find().sort('$natural', -1).limit(1):
+            return entry['ts']
+
+    def poll(self):
+        """Queues the oplog entries written since the last call,
+        returns the number of entries read.
+        """
+        spec = {'ns': {'$regex': '^' + re.escape(self._prefix)}}
+        if self.last_ts is not None:
+            spec['ts'] = {'$gt': self.last_ts}
+        cursor = self.oplog.find(spec, tailable=True, await_data=True)
+        count = 0
+        while not self._stopped.is_set():
+            for entry in cursor:
+                self._queue.append(entry)
+                self.last_ts = entry['ts']
+                count += 1
+                if self._stopped.is_set():
+                    break
+            if not getattr(cursor, 'alive', False):
+                break
+        return count
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except (AutoReconnect, OperationFailure):
+                pass
+            except Exception:
+                logger.exception("Error tailing the oplog, retrying")
+            self._stopped.wait(self.poll_interval)
+
+    def start(self):
+        """Starts tailing the oplog from its last entry in a thread,
+        objects loaded before are not invalidated.
+        """
+        if self.last_ts is None:
+            self.last_ts = self._get_last_ts()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='thunder-invalidator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stops the thread and detaches the invalidator from the
+        store, the queued entries are dropped.
+        """
+        self.stop()
+        self._queue.clear()
+        if self.store._invalidator is self:
+            self.store._invalidator = None
+            self.store._written = None
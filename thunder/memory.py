@@ -0,0 +1,755 @@
+"""An in-process engine with the MongoDB semantics used by Thunder.
+
+It implements the subset of the pymongo Connection, Database,
+Collection and Cursor interfaces that Thunder needs, so tests and
+benchmarks can run without a server:
+
+    store = Store('memory://', 'mydb')
+
+Secondary indexes are dicts over the first key of the index, they are
+used for equality and $in conditions.  Operations are serialized with
+a lock per database, the engine can be used from several threads.
+"""
+
+import collections
+import copy
+import functools
+import re
+import threading
+
+from bson import BSON
+from bson.objectid import ObjectId
+from pymongo.errors import (DuplicateKeyError, InvalidOperation,
+                            OperationFailure)
+
+_missing = object()
+
+
+def _lookup(doc, key):
+    value = doc
+    for part in key.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _missing)
+        elif isinstance(value, list) and part.isdigit():
+            index = int(part)
+            if index >= len(value):
+                return _missing
+            value = value[index]
+        else:
+            return _missing
+        if value is _missing:
+            break
+    return value
+
+
+def _is_operator_dict(value):
+    return (isinstance(value, dict) and value and
+            all(key.startswith('$') for key in value))
+
+
+def _equals(value, cond):
+    if value is _missing:
+        return cond is None
+    if value == cond:
+        return True
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return False
+
+
+def _compare(value, cond, op):
+    if value is _missing:
+        return False
+    if isinstance(value, list):
+        return any(_compare(item, cond, op) for item in value)
+    # Null is only compared with null.
+    if (value is None) != (cond is None):
+        return False
+    return op(value, cond)
+
+_comparisons = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+    }
+
+
+def _match_operator(value, op, cond):
+    if op in _comparisons:
+        return _compare(value, cond, _comparisons[op])
+    elif op == '$in':
+        return any(_equals(value, item) for item in cond)
+    elif op == '$nin':
+        return not any(_equals(value, item) for item in cond)
+    elif op == '$ne':
+        return not _equals(value, cond)
+    elif op == '$exists':
+        return (value is not _missing) == bool(cond)
+    elif op == '$all':
+        return (isinstance(value, list) and
+                all(item in value for item in cond))
+    elif op == '$size':
+        return isinstance(value, list) and len(value) == cond
+    elif op == '$regex':
+        return (isinstance(value, basestring) and
+                re.search(cond, value) is not None)
+    elif op == '$not':
+        return not _match_condition(value, cond)
+    raise OperationFailure("unsupported query operator: %s" % (op, ))
+
+
+def _match_condition(value, cond):
+    if _is_operator_dict(cond):
+        return all(_match_operator(value, op, arg)
+                   for op, arg in cond.items())
+    if hasattr(cond, 'search') and hasattr(cond, 'pattern'):
+        return (isinstance(value, basestring) and
+                cond.search(value) is not None)
+    return _equals(value, cond)
+
+
+def match(doc, spec):
+    for key, cond in spec.items():
+        if key == '$or':
+            if not any(match(doc, sub) for sub in cond):
+                return False
+        elif key == '$and':
+            if not all(match(doc, sub) for sub in cond):
+                return False
+        elif key == '$nor':
+            if any(match(doc, sub) for sub in cond):
+                return False
+        elif not _match_condition(_lookup(doc, key), cond):
+            return False
+    return True
+
+
+def _set_path(doc, key, value):
+    parts = key.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, key):
+    parts = key.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _get_list(doc, key):
+    value = _lookup(doc, key)
+    if value is _missing:
+        value = []
+        _set_path(doc, key, value)
+    elif not isinstance(value, list):
+        raise OperationFailure("Cannot apply array modifier to non-array")
+    return value
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return value['$each']
+    return [value]
+
+
+def apply_update(doc, document):
+    if not _is_operator_dict(document):
+        replacement = copy.deepcopy(document)
+        replacement['_id'] = doc['_id']
+        doc.clear()
+        doc.update(replacement)
+        return
+
+    for op, changes in document.items():
+        for key, value in changes.items():
+            value = copy.deepcopy(value)
+            if op == '$set':
+                _set_path(doc, key, value)
+            elif op == '$unset':
+                _unset_path(doc, key)
+            elif op == '$inc':
+                current = _lookup(doc, key)
+                if current is _missing:
+                    current = 0
+                _set_path(doc, key, current + value)
+            elif op == '$push':
+                _get_list(doc, key).extend(_each(value))
+            elif op == '$pushAll':
+                _get_list(doc, key).extend(value)
+            elif op == '$addToSet':
+                items = _get_list(doc, key)
+                for item in _each(value):
+                    if item not in items:
+                        items.append(item)
+            elif op == '$pull':
+                items = _get_list(doc, key)
+                items[:] = [item for item in items
+                            if not _match_condition(item, value)]
+            elif op == '$pullAll':
+                items = _get_list(doc, key)
+                items[:] = [item for item in items if item not in value]
+            elif op == '$pop':
+                items = _get_list(doc, key)
+                if items:
+                    items.pop(0 if value < 0 else -1)
+            else:
+                raise OperationFailure(
+                    "unsupported update operator: %s" % (op, ))
+
+
+def project(doc, fields):
+    if fields is None:
+        return copy.deepcopy(doc)
+    if not isinstance(fields, dict):
+        fields = dict((field, 1) for field in fields)
+    include = [key for key, value in fields.items()
+               if value and key != '_id']
+    if include:
+        result = {}
+        for key in include:
+            value = _lookup(doc, key)
+            if value is not _missing:
+                _set_path(result, key, copy.deepcopy(value))
+    else:
+        result = copy.deepcopy(doc)
+        for key, value in fields.items():
+            if not value:
+                _unset_path(result, key)
+    if fields.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    else:
+        result.pop('_id', None)
+    return result
+
+
+def _sort_key(value):
+    # Missing values sort before everything else, like null does.
+    if value is _missing:
+        return (0, None)
+    return (1, value)
+
+
+def sort_documents(docs, ordering):
+    docs = list(docs)
+    for key, direction in reversed(ordering):
+        docs.sort(key=lambda doc: _sort_key(_lookup(doc, key)),
+                  reverse=direction < 0)
+    return docs
+
+
+def _locked(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.database.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def _index_list(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+
+def _gen_index_name(keys):
+    return u'_'.join([u'%s_%s' % item for item in keys])
+
+
+class MemoryIndex(object):
+    """A dict based secondary index over the first key of an index
+    specification.
+
+    Documents with unhashable values are kept aside and are always
+    returned as candidates.
+    """
+
+    def __init__(self, name, keys, unique=False, sparse=False, **options):
+        self.name = name
+        self.keys = keys
+        self.unique = unique
+        self.sparse = sparse
+        self.options = options
+        self.key = keys[0][0]
+        self.usable = keys[0][1] in (1, -1)
+        self.entries = collections.defaultdict(set)
+        self.unhashable = set()
+
+    def _values(self, doc):
+        value = _lookup(doc, self.key)
+        if value is _missing:
+            value = None
+        if isinstance(value, list):
+            return value or [None]
+        return [value]
+
+    def add(self, doc):
+        obj_id = doc['_id']
+        if self.sparse and _lookup(doc, self.key) is _missing:
+            return
+        for value in self._values(doc):
+            try:
+                self.entries[value].add(obj_id)
+            except TypeError:
+                self.unhashable.add(obj_id)
+
+    def discard(self, doc):
+        obj_id = doc['_id']
+        for value in self._values(doc):
+            try:
+                ids = self.entries.get(value)
+            except TypeError:
+                self.unhashable.discard(obj_id)
+                continue
+            if ids is not None:
+                ids.discard(obj_id)
+                if not ids:
+                    del self.entries[value]
+
+    def candidates(self, cond):
+        """Returns the set of ids which may match cond, or None
+        if the index cannot be used for it.
+        """
+        if not self.usable or self.sparse:
+            return None
+        if _is_operator_dict(cond):
+            if cond.keys() != ['$in']:
+                return None
+            values = cond['$in']
+        elif isinstance(cond, (dict, list)):
+            return None
+        else:
+            values = [cond]
+        ids = set(self.unhashable)
+        for value in values:
+            try:
+                ids.update(self.entries.get(value, ()))
+            except TypeError:
+                return None
+        return ids
+
+    def check_unique(self, collection, doc):
+        if not self.unique:
+            return
+        if self.sparse and _lookup(doc, self.key) is _missing:
+            return
+        key = [_lookup(doc, name) for name, direction in self.keys]
+        key = [None if value is _missing else value for value in key]
+        ids = set()
+        for value in self._values(doc):
+            try:
+                ids.update(self.entries.get(value, ()))
+            except TypeError:
+                ids.update(self.unhashable)
+        ids.discard(doc['_id'])
+        for obj_id in ids:
+            other = collection._docs[obj_id]
+            other_key = [_lookup(other, name) for name, direction in self.keys]
+            other_key = [None if value is _missing else value
+                         for value in other_key]
+            if other_key == key:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error index: %s.%s" % (
+                    collection.full_name, self.name))
+
+    def info(self):
+        info = dict(key=list(self.keys))
+        if self.unique:
+            info['unique'] = True
+        if self.sparse:
+            info['sparse'] = True
+        info.update(self.options)
+        return info
+
+
+class MemoryCursor(object):
+    def __init__(self, collection, spec=None, fields=None, skip=0, limit=0,
+                 sort=None, **kwargs):
+        if spec is None:
+            spec = {}
+        if not isinstance(spec, dict):
+            raise TypeError("spec must be an instance of dict")
+        self.collection = collection
+        self.__spec = spec
+        self.__fields = fields
+        self.__skip = skip
+        self.__limit = limit
+        self.__ordering = sort and _index_list(sort) or None
+        self.__batch_size = 0
+        self.__results = None
+        self.__plan = None
+
+    def __check_okay_to_chain(self):
+        if self.__results is not None:
+            raise InvalidOperation("cannot set options after executing query")
+
+    def clone(self):
+        return MemoryCursor(self.collection, self.__spec, self.__fields,
+                            self.__skip, self.__limit, self.__ordering)
+
+    def rewind(self):
+        self.__results = None
+        return self
+
+    def limit(self, limit):
+        self.__check_okay_to_chain()
+        self.__limit = limit
+        return self
+
+    def skip(self, skip):
+        self.__check_okay_to_chain()
+        self.__skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        self.__check_okay_to_chain()
+        self.__batch_size = batch_size
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self.__check_okay_to_chain()
+        self.__ordering = _index_list(key_or_list, direction)
+        return self
+
+    def _matching(self):
+        with self.collection.database.lock:
+            docs, self.__plan = self.collection._select(self.__spec)
+        if self.__ordering:
+            docs = sort_documents(docs, self.__ordering)
+        return docs
+
+    def _slice(self, docs):
+        skip = self.__skip
+        limit = abs(self.__limit)
+        if limit:
+            return docs[skip:skip + limit]
+        return docs[skip:]
+
+    def count(self, with_limit_and_skip=False):
+        docs = self._matching()
+        if with_limit_and_skip:
+            docs = self._slice(docs)
+        return len(docs)
+
+    def explain(self):
+        docs = self._matching()
+        plan = self.__plan
+        return {'cursor': plan['cursor'],
+                'nscanned': plan['nscanned'],
+                'nscannedObjects': plan['nscanned'],
+                'n': len(self._slice(docs)),
+                'millis': 0}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self.__check_okay_to_chain()
+            self.__skip = index.start or 0
+            self.__limit = (index.stop - self.__skip
+                            if index.stop is not None else 0)
+            return self
+        clone = self.clone()
+        clone.skip(index + self.__skip)
+        clone.limit(-1)
+        for doc in clone:
+            return doc
+        raise IndexError("no such item for Cursor instance")
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__results is None:
+            fields = self.__fields
+            self.__results = iter([
+                project(doc, fields)
+                for doc in self._slice(self._matching())])
+        return next(self.__results)
+
+
+class MemoryCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._docs = collections.OrderedDict()
+        self._indexes = collections.OrderedDict()
+
+    def __repr__(self):  # pragma: nocoverage
+        return 'MemoryCollection(%r, %r)' % (self.database, self.name)
+
+    # Internal
+
+    def _select(self, spec):
+        candidates = None
+        index_name = None
+        for key, cond in spec.items():
+            if key == '_id' and not _is_operator_dict(cond):
+                candidates = [cond] if cond in self._docs else []
+                index_name = '_id_'
+                break
+            for index in self._indexes.values():
+                if index.key != key:
+                    continue
+                ids = index.candidates(cond)
+                if ids is not None:
+                    candidates = [obj_id for obj_id in self._docs
+                                  if obj_id in ids]
+                    index_name = index.name
+                    break
+            if candidates is not None:
+                break
+
+        if candidates is None:
+            docs = self._docs.values()
+            cursor = 'BasicCursor'
+        else:
+            docs = [self._docs[obj_id] for obj_id in candidates]
+            cursor = 'BtreeCursor %s' % (index_name, )
+        plan = dict(cursor=cursor, nscanned=len(docs))
+        return [doc for doc in docs if match(doc, spec)], plan
+
+    def _store(self, doc, old=None):
+        # Stores a BSON encoded and decoded copy of doc, so values the
+        # server would reject raise InvalidDocument and the other ones
+        # come back as they would from it.  Returns the copy.
+        doc = BSON(BSON.encode(doc)).decode()
+        for index in self._indexes.values():
+            index.check_unique(self, doc)
+        if old is not None:
+            for index in self._indexes.values():
+                index.discard(old)
+        self._docs[doc['_id']] = doc
+        for index in self._indexes.values():
+            index.add(doc)
+        self.database._created(self)
+        return doc
+
+    def _delete(self, doc):
+        for index in self._indexes.values():
+            index.discard(doc)
+        del self._docs[doc['_id']]
+
+    # Public API
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, *args, **kwargs).limit(-1):
+            return doc
+        return None
+
+    @_locked
+    def count(self):
+        return len(self._docs)
+
+    @_locked
+    def insert(self, doc_or_docs, manipulate=True, safe=False, **kwargs):
+        return_one = isinstance(doc_or_docs, dict)
+        docs = return_one and [doc_or_docs] or doc_or_docs
+        ids = []
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = ObjectId()
+            if doc['_id'] in self._docs:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error index: %s.$_id_" % (
+                    self.full_name, ))
+            self._store(doc)
+            ids.append(doc['_id'])
+        return return_one and ids[0] or ids
+
+    @_locked
+    def save(self, to_save, manipulate=True, safe=False, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save, manipulate, safe, **kwargs)
+        self.update({'_id': to_save['_id']}, to_save, True)
+        return to_save['_id']
+
+    @_locked
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=False, multi=False, **kwargs):
+        docs, plan = self._select(spec)
+        if not multi:
+            docs = docs[:1]
+        result = dict(ok=1.0, err=None, n=len(docs),
+                      updatedExisting=bool(docs))
+        for old in docs:
+            doc = copy.deepcopy(old)
+            apply_update(doc, document)
+            self._store(doc, old)
+        if not docs and upsert:
+            doc = {}
+            for key, cond in spec.items():
+                if not key.startswith('$') and not _is_operator_dict(cond):
+                    _set_path(doc, key, copy.deepcopy(cond))
+            doc.setdefault('_id', document.get('_id', ObjectId()))
+            apply_update(doc, document)
+            self._store(doc)
+            result.update(n=1, upserted=doc['_id'])
+        if safe or kwargs:
+            return result
+
+    @_locked
+    def remove(self, spec_or_id=None, safe=False, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        docs, plan = self._select(spec_or_id)
+        for doc in docs:
+            self._delete(doc)
+        if safe or kwargs:
+            return dict(ok=1.0, err=None, n=len(docs))
+
+    @_locked
+    def find_and_modify(self, query={}, update=None, upsert=False,
+                        sort=None, new=False, fields=None, remove=False,
+                        **kwargs):
+        if not update and not remove:
+            raise ValueError("Must either update or remove")
+        cursor = self.find(query)
+        if sort:
+            cursor.sort(sort.items() if isinstance(sort, dict) else sort)
+        for found in cursor.limit(-1):
+            break
+        else:
+            found = None
+
+        if found is None:
+            if not upsert or remove:
+                return None
+            self.update(query, update, upsert=True)
+            if not new:
+                return {}
+            return self.find_one(query, fields=fields)
+
+        old = self._docs[found['_id']]
+        if remove:
+            self._delete(old)
+            return project(old, fields)
+        doc = copy.deepcopy(old)
+        apply_update(doc, update)
+        doc = self._store(doc, old)
+        return project(new and doc or old, fields)
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def ensure_index(self, key_or_list, deprecated_unique=None, ttl=300,
+                     **kwargs):
+        return self.create_index(key_or_list, **kwargs)
+
+    @_locked
+    def create_index(self, key_or_list, deprecated_unique=None, ttl=300,
+                     **kwargs):
+        keys = _index_list(key_or_list)
+        name = kwargs.pop('name', None) or _gen_index_name(keys)
+        kwargs.pop('background', None)
+        kwargs.pop('drop_dups', None)
+        kwargs.pop('dropDups', None)
+        if name in self._indexes:
+            return name
+        index = MemoryIndex(name, keys, **kwargs)
+        for doc in self._docs.values():
+            index.add(doc)
+        for doc in self._docs.values():
+            index.check_unique(self, doc)
+        self._indexes[name] = index
+        self.database._created(self)
+        return name
+
+    @_locked
+    def index_information(self):
+        info = {u'_id_': {'key': [(u'_id', 1)]}}
+        for name, index in self._indexes.items():
+            info[name] = index.info()
+        return info
+
+    @_locked
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = _gen_index_name(_index_list(name))
+        if name not in self._indexes:
+            raise OperationFailure("index not found")
+        del self._indexes[name]
+
+    @_locked
+    def drop_indexes(self):
+        self._indexes.clear()
+
+    @_locked
+    def distinct(self, key):
+        values = []
+        for doc in self._docs.values():
+            value = _lookup(doc, key)
+            if value is not _missing and value not in values:
+                values.append(value)
+        return values
+
+
+class MemoryDatabase(object):
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self._collections = {}
+        self._created_names = set()
+        self.lock = threading.RLock()
+
+    def __repr__(self):  # pragma: nocoverage
+        return 'MemoryDatabase(%r)' % (self.name, )
+
+    def __getitem__(self, name):
+        with self.lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = MemoryCollection(self, name)
+                self._collections[name] = collection
+            return collection
+
+    def _created(self, collection):
+        self._created_names.add(collection.name)
+
+    def collection_names(self):
+        return sorted(self._created_names)
+
+    def drop_collection(self, name):
+        with self.lock:
+            self._created_names.discard(name)
+            collection = self._collections.get(name)
+            if collection is not None:
+                collection._docs.clear()
+                collection._indexes.clear()
+
+
+class MemoryConnection(object):
+    """A process wide registry of in-memory databases, all connections
+    opened against the same uri see the same data.
+    """
+
+    _servers = {}
+
+    def __init__(self, uri='memory://'):
+        self.uri = uri
+        self._databases = self._servers.setdefault(uri, {})
+
+    def __getitem__(self, name):
+        database = self._databases.get(name)
+        if database is None:
+            # setdefault is atomic, threads all get the same database.
+            database = self._databases.setdefault(
+                name, MemoryDatabase(self, name))
+        return database
+
+    def drop_database(self, name):
+        self._databases.pop(name, None)
+
+    def disconnect(self):
+        pass
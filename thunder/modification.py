@@ -0,0 +1,178 @@
+import copy
+import numbers
+
+from thunder.info import Undef, get_obj_info
+from thunder.memory import apply_update
+
+
+class Modification(object):
+    """An atomic update of an object, or of the documents matching a
+    query, sent to the server by execute():
+
+        store.modify(post).inc(views=1).push(tags=u'new').execute()
+        store.update(Post, {'author': name}).set(hidden=True).execute()
+
+    The methods add an update operator for the given fields and return
+    the modification so they can be chained.  The objects modified are
+    updated to the values sent, without being loaded again.
+    """
+
+    def __init__(self, store, cls_info, spec, obj_info=None):
+        self._store = store
+        self._cls_info = cls_info
+        self._spec = spec
+        self._obj_info = obj_info
+        self._update = {}
+
+    def _convert(self, values, convert=False):
+        cls_info = self._cls_info
+        converted = {}
+        for name, value in values.items():
+            field = cls_info.attributes.get(name)
+            if field is None:
+                raise ValueError("%s has no field called %r" % (
+                    cls_info.cls.__name__, name))
+            if convert:
+                value = field.from_python(value)
+            converted[name] = value
+        return converted
+
+    def _add(self, op, values, convert=False):
+        values = self._convert(values, convert)
+        self._update.setdefault(op, {}).update(values)
+        return self
+
+    def set(self, **kwargs):
+        return self._add('$set', kwargs, convert=True)
+
+    def unset(self, *names):
+        return self._add('$unset', dict.fromkeys(names, 1))
+
+    def inc(self, **kwargs):
+        """Adds the amounts to the fields, which must be stored as
+        numbers.  The amounts are converted like the values of the
+        fields, eg a Decimal for a DecimalField.
+        """
+        values = self._convert(kwargs, convert=True)
+        for name, value in values.items():
+            if not isinstance(value, numbers.Number) or \
+               isinstance(value, bool):
+                raise TypeError("Cannot increment %r of %s, it's not "
+                                "stored as a number" % (
+                                    name, self._cls_info.cls.__name__))
+        return self._add('$inc', values)
+
+    def push(self, **kwargs):
+        return self._add('$push', kwargs)
+
+    def push_all(self, **kwargs):
+        return self._add('$pushAll', kwargs)
+
+    def add_to_set(self, **kwargs):
+        return self._add('$addToSet', kwargs)
+
+    def pull(self, **kwargs):
+        return self._add('$pull', kwargs)
+
+    def _get_positions(self, obj_info, check=False):
+        # The positions of the modified fields which are loaded, the
+        # other ones are fetched with their new value when accessed.
+        # Fields with unflushed changes keep them, unless check is set
+        # and it raises an error.
+        cls_info = self._cls_info
+        positions = {}
+        for changes in self._update.values():
+            for name in changes:
+                position = cls_info.index[cls_info.attributes[name]]
+                if obj_info.unloaded >> position & 1:
+                    continue
+                if obj_info.variables[position] != obj_info.saved[position]:
+                    if not check:
+                        continue
+                    raise ValueError(
+                        "Cannot modify %r of %s, it has unflushed "
+                        "changes" % (name, cls_info.cls.__name__))
+                positions[name] = position
+        return positions
+
+    def _patch(self, obj_info, doc=None):
+        # Sets the values of the modified fields to the ones in doc,
+        # or to the ones computed by applying the update locally.
+        positions = self._get_positions(obj_info)
+        variables = obj_info.variables
+        if doc is None:
+            doc = {}
+            for name, position in positions.items():
+                if variables[position] is not Undef:
+                    doc[name] = copy.deepcopy(variables[position])
+            apply_update(doc, self._update)
+
+        saved = obj_info.saved
+        fields = self._cls_info.fields
+        for name, position in positions.items():
+            value = doc.get(name, Undef)
+            variables[position] = value
+            if fields[position].mutable:
+                value = copy.deepcopy(value)
+            saved[position] = value
+
+        # Other fields may have unflushed changes, don't write the
+        # object through.
+        shared_cache = self._store.shared_cache
+        if shared_cache is not None:
+            shared_cache.remove(self._cls_info.doc_name, obj_info.obj._id)
+
+    def execute(self, new=False):
+        """Sends the update.
+
+        With new, a single document is modified with findAndModify and
+        the object with its new values is returned, or None if nothing
+        matched.
+        """
+        update = self._update
+        if not update:
+            return None
+
+        store = self._store
+        cls_info = self._cls_info
+        collection = cls_info.get_collection(store)
+        if store._listeners:
+            store._emit('update', cls_info.cls, self._spec, update)
+        if store.query_cache is not None:
+            store.query_cache.invalidate(cls_info)
+
+        obj_info = self._obj_info
+        if obj_info is not None:
+            # Check the object before anything is sent.
+            self._get_positions(obj_info, check=True)
+
+        if not new:
+            if obj_info is None:
+                collection.update(self._spec, update, multi=True)
+                store._invalidate(cls_info)
+            else:
+                collection.update(self._spec, update)
+                if store._written is not None:
+                    store._record_writes(cls_info, [obj_info.obj._id])
+                self._patch(obj_info)
+            return None
+
+        doc = collection.find_and_modify(self._spec, update, new=True)
+        if doc is None:
+            return None
+        if store._written is not None:
+            store._record_writes(cls_info, [doc['_id']])
+        if obj_info is not None:
+            # The object may have been evicted from the cache.
+            self._patch(obj_info, doc)
+            return obj_info.obj
+        obj = store._cache.get((cls_info, doc['_id']))
+        if obj is None:
+            # The _id wasn't known before the update to take the
+            # version of its slot, so the cached document is only
+            # forgotten, it may already be older than doc.
+            if store.shared_cache is not None:
+                store.shared_cache.remove(cls_info.doc_name, doc['_id'])
+            return store._hydrate(cls_info, doc)
+        self._patch(get_obj_info(obj), doc)
+        return obj
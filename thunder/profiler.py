@@ -0,0 +1,126 @@
+import collections
+import math
+
+Sample = collections.namedtuple(
+    'Sample', ['name', 'shape', 'spec', 'time', 'returned'])
+
+
+def get_shape(spec):
+    """Returns the shape of a query spec, a string with its keys and
+    operators where the values are replaced by ?.
+    """
+    if spec is None:
+        return '{}'
+    if not isinstance(spec, dict):
+        return '{_id: ?}'
+    return _get_shape(spec)
+
+
+def _get_shape(value):
+    if isinstance(value, dict):
+        return '{%s}' % (', '.join(
+            '%s: %s' % (key, _get_shape(item))
+            for key, item in sorted(value.items())), )
+    # The sub queries of $and, $or and $nor.
+    if isinstance(value, list) and value and all(
+            isinstance(item, dict) for item in value):
+        return '[%s]' % (', '.join(_get_shape(item) for item in value), )
+    return '?'
+
+
+def is_collection_scan(plan):
+    """Returns True if plan, as returned by Cursor.explain, reads the
+    whole collection.
+    """
+    if plan.get('cursor', '').startswith('BasicCursor'):
+        return True
+    stage = plan.get('queryPlanner', {}).get('winningPlan')
+    while stage:
+        if stage.get('stage') == 'COLLSCAN':
+            return True
+        stage = stage.get('inputStage')
+    return False
+
+
+def _percentile(times, percent):
+    rank = int(math.ceil(percent / 100.0 * len(times)))
+    return times[max(rank - 1, 0)]
+
+
+class Profiler(object):
+    """Keeps the last size operations on each collection of a store,
+    the operations are aggregated by the shape of their query.
+
+    Pass it to Store to enable it, see Store.profile_report.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._samples = {}
+        self._collections = {}
+
+    def add(self, collection, name, spec, time, returned=None):
+        samples = self._samples.get(collection.name)
+        if samples is None:
+            samples = collections.deque(maxlen=self.size)
+            self._samples[collection.name] = samples
+            self._collections[collection.name] = collection
+        samples.append(Sample(name, get_shape(spec), spec, time, returned))
+
+    def clear(self):
+        self._samples.clear()
+        self._collections.clear()
+
+    def get_stats(self):
+        """Returns a list of dicts with the number of calls, the total,
+        median and 99th percentile time and the number of documents
+        returned for each operation and query shape of each collection.
+        """
+        groups = collections.OrderedDict()
+        for name, samples in sorted(self._samples.items()):
+            for sample in samples:
+                key = (name, sample.name, sample.shape)
+                groups.setdefault(key, []).append(sample)
+
+        stats = []
+        for (name, op, shape), samples in groups.items():
+            times = sorted(sample.time for sample in samples)
+            stats.append(dict(
+                collection=name, op=op, shape=shape, count=len(samples),
+                total=sum(times), p50=_percentile(times, 50),
+                p99=_percentile(times, 99),
+                returned=sum(sample.returned or 0 for sample in samples)))
+        return stats
+
+    def explain(self, collection_name, shape):
+        """Returns the query plan of the last query with shape."""
+        for sample in reversed(self._samples[collection_name]):
+            if sample.shape == shape:
+                break
+        spec = sample.spec
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        collection = self._collections[collection_name]
+        return collection.find(spec).explain()
+
+    def get_report(self, explain=5):
+        """Returns the statistics of get_stats, the shapes most likely
+        to need an index first.
+
+        The query plans of the explain shapes taking the most total
+        time are checked, collection_scan is set to True for the ones
+        reading the whole collection and to None if it's not known.
+        Those come first, then the others by total time.  Queries
+        without conditions are never explained, no index helps them.
+        """
+        stats = self.get_stats()
+        stats.sort(key=lambda stat: stat['total'], reverse=True)
+        for stat in stats:
+            stat['collection_scan'] = None
+            if explain and stat['shape'] != '{}':
+                explain -= 1
+                plan = self.explain(stat['collection'], stat['shape'])
+                stat['collection_scan'] = is_collection_scan(plan)
+        stats.sort(key=lambda stat: (not stat['collection_scan'],
+                                     -stat['total']))
+        return stats
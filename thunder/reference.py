@@ -1,5 +1,5 @@
 from thunder.fields import Field
-from thunder.info import get_obj_info
+from thunder.info import Undef, get_obj_info
 
 
 class ReferenceField(Field):
@@ -18,15 +18,24 @@ class ReferenceField(Field):
             return obj
 
         obj_info = get_obj_info(obj)
-        if self in obj_info.variables:
-            remote_value, remote_id = obj_info.variables[self]
+        index = obj_info.cls_info.index
+        value = obj_info.variables[index[self]]
+        if value is not Undef:
+            remote_value, remote_id = value
+            if remote_value is None:
+                return None
             store = get_obj_info(remote_value).get('store')
-            remote = store.get(self.remote_cls, remote_id)
         else:
-            remote_id = obj_info.variables[self.local_field]
+            position = index[self.local_field]
+            remote_id = obj_info.variables[position]
             store = obj_info.get('store')
-            remote = store.get(self.remote_cls, remote_id)
-        return remote
+            if remote_id is Undef and store is not None and \
+               obj_info.unloaded >> position & 1:
+                store._load_deferred(obj_info)
+                remote_id = obj_info.variables[position]
+            if remote_id is Undef:
+                return None
+        return store.get(self.remote_cls, remote_id)
 
     def __set__(self, obj, value):
         if (value is not None and
@@ -40,8 +49,11 @@ class ReferenceField(Field):
             remote_value = getattr(value, self.remote_attr)
 
         obj_info = get_obj_info(obj)
-        obj_info.variables[self] = value, remote_value
-        obj_info.variables[self.local_field] = remote_value
+        index = obj_info.cls_info.index
+        local_position = index[self.local_field]
+        obj_info.variables[index[self]] = value, remote_value
+        obj_info.variables[local_position] = remote_value
+        obj_info.mark_changed(local_position)
 
 
 class GenericReferenceField(Field):
@@ -0,0 +1,148 @@
+"""Scanning a collection with a pool of processes.
+
+The documents are split in ranges of _id values, each range is loaded
+by a worker process with a store of its own.  The classes of the
+documents and the functions passed must be importable, they are
+pickled to be sent to the workers.
+"""
+
+import binascii
+import itertools
+import multiprocessing
+import traceback
+
+from bson.objectid import ObjectId
+
+from thunder.cache import WeakCache
+from thunder.exceptions import ScanError
+from thunder.info import get_cls_info
+
+
+def _get_id(collection, direction):
+    cursor = collection.find({}, fields=['_id']).sort('_id', direction)
+    for doc in cursor.limit(1):
+        return doc['_id']
+    return None
+
+
+def _interpolate(lower, upper, parts):
+    # Returns parts - 1 values evenly spread from lower to upper, or
+    # None if they can't be computed from the kind of the values.
+    if isinstance(lower, ObjectId) and isinstance(upper, ObjectId):
+        # The timestamp is the most significant part of an ObjectId,
+        # the counter the least one, so they're spread as integers.
+        low = int(binascii.hexlify(lower.binary), 16)
+        high = int(binascii.hexlify(upper.binary), 16)
+        return [ObjectId('%024x' % (low + (high - low) * i // parts))
+                for i in range(1, parts)]
+    numbers = (int, long, float)
+    if (isinstance(lower, numbers) and isinstance(upper, numbers) and
+            not isinstance(lower, bool) and not isinstance(upper, bool)):
+        if isinstance(lower, float) or isinstance(upper, float):
+            return [lower + (upper - lower) * i / float(parts)
+                    for i in range(1, parts)]
+        return [lower + (upper - lower) * i // parts
+                for i in range(1, parts)]
+    return None
+
+
+def split_ranges(collection, parts):
+    """Returns at most parts (lower, upper) ranges of _id values, each
+    of them holding about the same number of the documents of
+    collection.  The lower bound is included, None means unbounded.
+
+    ObjectId and number bounds are interpolated from the lowest and
+    highest ids, so the ranges are as balanced as the ids are evenly
+    spread, eg ObjectIds of documents inserted at a steady rate.  Other
+    kinds of ids are split by walking the sorted ids once.  A query is
+    applied to each range by range_spec, in the workers.
+    """
+    lower = _get_id(collection, 1)
+    upper = _get_id(collection, -1)
+    values = _interpolate(lower, upper, parts)
+    if values is None:
+        count = collection.count()
+        positions = set(count * i // parts for i in range(1, parts))
+        cursor = collection.find({}, fields=['_id']).sort('_id', 1)
+        values = [doc['_id'] for i, doc in enumerate(cursor)
+                  if i in positions]
+    bounds = []
+    for value in values:
+        if value > (bounds[-1] if bounds else lower):
+            bounds.append(value)
+    return zip([None] + bounds, bounds + [None])
+
+
+def range_spec(spec, lower, upper):
+    """Returns spec restricted to the _id values from lower to upper."""
+    cond = {}
+    if lower is not None:
+        cond['$gte'] = lower
+    if upper is not None:
+        cond['$lt'] = upper
+    if not cond:
+        return spec
+    if spec is None:
+        return {'_id': cond}
+    if '_id' in spec:
+        return {'$and': [spec, {'_id': cond}]}
+    spec = dict(spec)
+    spec['_id'] = cond
+    return spec
+
+
+def _scan_range(task):
+    # Runs in a worker process, returns (range, error, found, value)
+    # as exceptions can not always be pickled.
+    from thunder.store import Store
+    conn_string, database, cls, spec, id_range, func, names, reduce_func = task
+    try:
+        store = Store(conn_string, database, cache=WeakCache())
+        spec = range_spec(spec, *id_range)
+        if names:
+            items = store.iter_values(cls, names, spec)
+        else:
+            items = store.find(cls, spec)
+        results = itertools.imap(func, items)
+        if reduce_func is None:
+            return id_range, None, True, list(results)
+        for value in results:
+            return id_range, None, True, reduce(reduce_func, results, value)
+        return id_range, None, False, None
+    except Exception:
+        return id_range, traceback.format_exc(), False, None
+
+
+def parallel_scan(store, cls, spec, func, workers=4, names=None,
+                  reduce_func=None, ranges=None, conn_string=None):
+    """See Store.parallel_scan."""
+    conn_string = conn_string or store.conn_string
+    if conn_string is None:
+        raise ValueError("A connection string is needed for the workers")
+    if ranges is None:
+        collection = get_cls_info(cls).get_collection(store)
+        ranges = split_ranges(collection, workers * 4)
+    tasks = [(conn_string, store.database.name, cls, spec, id_range, func,
+              names, reduce_func) for id_range in ranges]
+
+    results = {}
+    errors = {}
+    pool = multiprocessing.Pool(workers)
+    try:
+        scanned = pool.imap_unordered(_scan_range, tasks)
+        for id_range, error, found, value in scanned:
+            if error is not None:
+                errors[id_range] = error
+            elif found:
+                results[id_range] = value
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise ScanError(results, errors)
+    values = [results[id_range] for id_range in ranges
+              if id_range in results]
+    if reduce_func is not None:
+        return reduce(reduce_func, values) if values else None
+    return list(itertools.chain.from_iterable(values))
@@ -0,0 +1,213 @@
+"""A cache of documents shared by the processes of a host.
+
+SharedCache keeps BSON encoded documents in a memory mapped file, it's
+a second level below the identity map of each store:
+
+    shared = SharedCache('/dev/shm/thunder-mydb', size=64 * 1024 * 1024)
+    store = Store('localhost', 'mydb', shared_cache=shared)
+
+Store.get and Store.get_many look documents up in it before querying
+the server and add the ones they fetch, flushing writes the objects
+through to it.  The file is split in slots of slot_size bytes, each
+document goes to the slot given by the hash of its collection and _id
+and replaces the one which was there, so the cache never grows beyond
+size.  Documents which don't fit in a slot are not cached.
+
+Writers lock the slot with fcntl, readers don't lock and retry when a
+slot is being written.  A document fetched from the server is only
+cached if its slot wasn't written since get_version was called before
+fetching it, so a process can't cache a version older than the one
+another process wrote meanwhile.  Writes made without going through a
+store using the same file are not seen until the entries expire after
+ttl seconds, if it's set.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from bson import BSON
+from bson.errors import BSONError
+
+MAGIC = 'THUNDER1'
+
+# magic, slot size, number of slots, then a generation counter per
+# group of collections.
+_header = struct.Struct('<8sII')
+_generation = struct.Struct('<I')
+GENERATIONS = 256
+HEADER_SIZE = 4096
+
+# sequence, length, generation, expires, digest of the key.
+_slot = struct.Struct('<IIId16s')
+
+# Times a reader retries a slot which is being written.
+READ_RETRIES = 3
+
+
+class SharedCache(object):
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=4096,
+                 ttl=None):
+        if slot_size <= _slot.size:
+            raise ValueError("slot_size must be larger than %d" % (
+                _slot.size, ))
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = (size - HEADER_SIZE) // slot_size
+        if self.slots < 1:
+            raise ValueError("size is too small for a slot of %d bytes" % (
+                slot_size, ))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        length = HEADER_SIZE + self.slots * slot_size
+        fcntl.lockf(self._file, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            if os.fstat(self._file.fileno()).st_size < length:
+                self._file.truncate(length)
+            self._map = mmap.mmap(self._file.fileno(), length)
+            header = _header.unpack_from(self._map, 0)
+            if header != (MAGIC, slot_size, self.slots):
+                self._map[:length] = '\0' * length
+                _header.pack_into(self._map, 0, MAGIC, slot_size,
+                                  self.slots)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _locate(self, doc_name, obj_id):
+        digest = hashlib.md5(
+            doc_name + '\0' + BSON.encode({'_id': obj_id})).digest()
+        slot = struct.unpack_from('<Q', digest)[0] % self.slots
+        return digest, HEADER_SIZE + slot * self.slot_size
+
+    def _generation_offset(self, doc_name):
+        group = ord(hashlib.md5(doc_name).digest()[0]) % GENERATIONS
+        return _header.size + group * _generation.size
+
+    def _get_generation(self, doc_name):
+        return _generation.unpack_from(
+            self._map, self._generation_offset(doc_name))[0]
+
+    def _locked(self, offset, length, func, *args):
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, length, offset)
+            try:
+                return func(*args)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, length, offset)
+
+    def get(self, doc_name, obj_id):
+        """Returns the cached document of obj_id, or None."""
+        digest, offset = self._locate(doc_name, obj_id)
+        data_offset = offset + _slot.size
+        for i in range(READ_RETRIES):
+            seq, length, generation, expires, key = _slot.unpack_from(
+                self._map, offset)
+            if key != digest or not length:
+                break
+            if seq & 1:
+                continue
+            data = self._map[data_offset:data_offset + length]
+            if _slot.unpack_from(self._map, offset)[0] != seq:
+                continue
+            if generation != self._get_generation(doc_name):
+                break
+            if expires and expires < time.time():
+                break
+            try:
+                doc = BSON(data).decode()
+            except (BSONError, ValueError, struct.error):
+                # Left corrupted, eg by a writer which died.
+                break
+            self.hits += 1
+            return doc
+        self.misses += 1
+        return None
+
+    def get_version(self, doc_name, obj_id):
+        """Returns the version of the slot of obj_id, to be passed to
+        put when caching the document fetched after the call.
+        """
+        digest, offset = self._locate(doc_name, obj_id)
+        return (_slot.unpack_from(self._map, offset)[0],
+                self._get_generation(doc_name))
+
+    def _write(self, offset, digest, data, generation, expires):
+        seq = _slot.unpack_from(self._map, offset)[0] | 1
+        # An odd sequence tells readers the slot is being written, it's
+        # only made even again once the rest of the slot is written.
+        struct.pack_into('<I', self._map, offset, seq)
+        start = offset + _slot.size
+        self._map[start:start + len(data)] = data
+        _slot.pack_into(self._map, offset, seq, len(data), generation,
+                        expires, digest)
+        struct.pack_into('<I', self._map, offset, (seq + 1) & 0xffffffff)
+
+    def put(self, doc_name, doc, version=None):
+        """Caches doc, which must have an _id, returns False if it's too
+        large to be cached or if version, returned by get_version, isn't
+        the one of the slot anymore.
+        """
+        data = BSON.encode(doc)
+        if len(data) > self.slot_size - _slot.size:
+            self.remove(doc_name, doc['_id'])
+            return False
+        digest, offset = self._locate(doc_name, doc['_id'])
+        expires = self.ttl and time.time() + self.ttl or 0
+
+        def write():
+            generation = self._get_generation(doc_name)
+            seq = _slot.unpack_from(self._map, offset)[0]
+            if version is not None and version != (seq, generation):
+                return False
+            self._write(offset, digest, data, generation, expires)
+            return True
+        if not self._locked(offset, self.slot_size, write):
+            return False
+        self.writes += 1
+        return True
+
+    def _remove(self, offset, digest):
+        if _slot.unpack_from(self._map, offset)[4] == digest:
+            self._write(offset, '\0' * 16, '', 0, 0)
+        else:
+            # The slot holds another document, only change its version
+            # so documents fetched before aren't cached.
+            seq = _slot.unpack_from(self._map, offset)[0]
+            struct.pack_into('<I', self._map, offset,
+                             (seq + 2) & 0xffffffff)
+
+    def remove(self, doc_name, obj_id):
+        digest, offset = self._locate(doc_name, obj_id)
+        self._locked(offset, self.slot_size, self._remove, offset, digest)
+
+    def _bump(self, offset):
+        value = _generation.unpack_from(self._map, offset)[0]
+        _generation.pack_into(self._map, offset, (value + 1) & 0xffffffff)
+
+    def invalidate(self, doc_name):
+        """Invalidates the documents of a collection, along with the
+        ones of the collections sharing its generation counter.
+        """
+        offset = self._generation_offset(doc_name)
+        self._locked(offset, _generation.size, self._bump, offset)
+
+    def clear(self):
+        for group in range(GENERATIONS):
+            offset = _header.size + group * _generation.size
+            self._locked(offset, _generation.size, self._bump, offset)
+
+    def get_stats(self):
+        return dict(slots=self.slots, hits=self.hits, misses=self.misses,
+                    writes=self.writes)
@@ -1,129 +1,895 @@
+import base64
+import copy
+import itertools
+import Queue
+import random
+import sys
+import threading
+import time
+import weakref
+
+from bson import BSON
+from bson.errors import BSONError
 from pymongo import Connection
-from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from thunder.cache import Cache
+from thunder.events import EVENTS
+from thunder.exceptions import NotOneError
+from thunder.info import (ObjectInfo, Undef, get_cls_info, get_cls_infos,
+                          get_obj_info, iter_positions)
+from thunder.memory import MemoryConnection
+from thunder.modification import Modification
+from thunder.scan import parallel_scan
+
+# The connection classes by URI scheme.  A connection is created with
+# the connection string and maps database names to databases with the
+# API of pymongo.database.Database.
+backends = {
+    'mongodb': Connection,
+    'memory': MemoryConnection,
+}
+
+
+def connect(conn_string):
+    """Returns a connection for conn_string, using the backend of its
+    scheme, mongodb:// if it has none.
+    """
+    if '://' not in conn_string:
+        conn_string = 'mongodb://' + conn_string
+    scheme = conn_string.split('://', 1)[0]
+    backend = backends.get(scheme)
+    if backend is None:
+        raise ValueError("Unknown backend %r in %r" % (
+            scheme, conn_string))
+    return backend(conn_string)
+
 
-from thunder.info import get_cls_info, get_obj_info
+def _call_hook(obj, name):
+    func = getattr(obj, name, None)
+    if func:
+        func()
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _read_ahead(cursor, size, batches):
+    """Yields the documents of cursor, which are read by a thread in
+    batches of size documents, at most batches ahead of the caller.
+
+    Closing the generator stops the thread.
+    """
+    queue = Queue.Queue(batches)
+    stopped = threading.Event()
+    # The thread holds the only reference to the cursor, pymongo kills
+    # it on the server when it's collected as the thread ends.
+    cursors = [cursor]
+    del cursor
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read():
+        cursor = cursors.pop()
+        try:
+            batch = []
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) == size:
+                    if not put((batch, None)):
+                        break
+                    batch = []
+            else:
+                if put((batch, None)):
+                    put((None, None))
+        except Exception:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=read, name='thunder-read-ahead')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if batch is None:
+                return
+            for doc in batch:
+                yield doc
+    finally:
+        stopped.set()
+
+
+def _encode_token(key, obj_id):
+    return base64.urlsafe_b64encode(BSON.encode({'k': key, 'i': obj_id}))
+
+
+def _decode_token(token):
+    try:
+        doc = BSON(base64.urlsafe_b64decode(str(token))).decode()
+        return doc['k'], doc['i']
+    except (TypeError, KeyError, BSONError):
+        raise ValueError("Invalid pagination token %r" % (token, ))
+
+
+def _page_conditions(sort_field, key, obj_id, direction):
+    """Returns the conditions matching the documents sorted after the
+    one with key and obj_id.
+
+    Nulls sort before the other values but range operators never match
+    them, so they are checked for explicitly.
+    """
+    if direction < 0:
+        if key is None:
+            return [{sort_field: None, '_id': {'$lt': obj_id}}]
+        return [{sort_field: {'$lt': key}},
+                {sort_field: key, '_id': {'$lt': obj_id}},
+                {sort_field: None}]
+    if key is None:
+        return [{sort_field: None, '_id': {'$gt': obj_id}},
+                {sort_field: {'$ne': None}}]
+    return [{sort_field: {'$gt': key}},
+            {sort_field: key, '_id': {'$gt': obj_id}}]
 
 
 class Store(object):
-    def __init__(self, conn_string, database, trace=False):
-        if not conn_string.startswith('mongodb://'):
-            conn_string = 'mongodb://' + conn_string
-        self.connection = Connection(conn_string)
-        self.database = Database(self.connection, database)
+    # Maximum number of documents sent in one insert or remove
+    # when flushing.
+    flush_batch_size = 1000
+
+    # Maximum number of ids sent in one $in query.
+    query_batch_size = 1000
+
+    def __init__(self, conn_string, database, trace=False, cache=None,
+                 profiler=None, query_cache=None, shared_cache=None):
+        # An opened connection can be passed instead of a connection
+        # string, to share it with other stores.
+        if isinstance(conn_string, basestring):
+            self.conn_string = conn_string
+            self.connection = connect(conn_string)
+        else:
+            self.conn_string = None
+            self.connection = conn_string
+        self.database = self.connection[database]
         self.trace = trace
         self.collections = []
+        self._collections = {}
         self.obj_infos = set()
-        self._cache = {}
+        # Objects whose mutable fields were read, they are only kept
+        # while they are referenced.
+        self._accessed = weakref.WeakSet()
+        if cache is None:
+            cache = Cache()
+        self._cache = cache
+        self.profiler = profiler
+        # A QueryCache with the ids of the results of queries, None
+        # unless it's enabled.
+        self.query_cache = query_cache
+        # A SharedCache of documents below the identity map, shared
+        # with other processes.
+        self.shared_cache = shared_cache
+        # Maps event names to lists of (callback, sample_rate), it's
+        # empty unless something listens so it's cheap to check.
+        self._listeners = {}
+        # Set by an OplogInvalidator, which queues the writes of other
+        # processes to be applied from the thread using the store, and
+        # maps the (doc_name, _id) written by the store in _written to
+        # [count, time of the last write] to skip them.
+        self._invalidator = None
+        self._written = None
 
-    def _load(self, cls_info, operation, *args, **kwargs):
-        fields = kwargs.pop('fields', None)
+    def add_listener(self, callback, names=None, sample_rate=1.0):
+        """Calls callback(name, *args) when one of the named events, or
+        any event if names is None, happens.  See thunder.events.
+
+        With a sample_rate lower than 1 only that fraction of the
+        events, chosen randomly, is passed on.
+        """
+        if names is None:
+            names = EVENTS
+        for name in names:
+            if name not in EVENTS:
+                raise ValueError("Unknown event %r" % (name, ))
+            self._listeners.setdefault(name, []).append(
+                (callback, sample_rate))
+
+    def remove_listener(self, callback):
+        for name, listeners in self._listeners.items():
+            listeners[:] = [listener for listener in listeners
+                            if listener[0] != callback]
+            if not listeners:
+                del self._listeners[name]
+
+    def _emit(self, name, *args):
+        for callback, sample_rate in self._listeners.get(name, ()):
+            if sample_rate >= 1 or random.random() < sample_rate:
+                callback(name, *args)
+
+    def _get_projection(self, cls_info, fields):
         if not fields:
-            fields = cls_info.attributes.keys()
+            return cls_info.load_fields, cls_info.deferred
 
-        return operation(*args, fields=fields, **kwargs)
+        if isinstance(fields, dict):
+            if any(fields.values()):
+                names = [attr for attr, value in fields.items() if value]
+            else:
+                names = [attr for attr in cls_info.attributes
+                         if attr not in fields]
+        else:
+            names = fields
+        names = set(names)
+        unloaded = cls_info.get_mask(attr for attr in cls_info.field_names
+                                     if attr not in names)
+        return fields, unloaded
 
-    def _build_doc(self, cls_info, doc):
-        obj_id = doc["_id"]
+    def _load(self, cls_info, operation, *args, **kwargs):
+        """Runs a query operation and returns a tuple with its result and
+        the fields which it did not load.
+        """
+        fields, unloaded = self._get_projection(cls_info,
+                                                kwargs.pop('fields', None))
+        return operation(*args, fields=fields, **kwargs), unloaded
 
-        obj = self._cache.get((cls_info, obj_id))
+    def _load_deferred(self, obj_info):
+        cls_info = obj_info.cls_info
+        variables = obj_info.variables
+        # Values set before the field was loaded are kept.
+        positions = [
+            position for position in iter_positions(
+                obj_info.unloaded & ~obj_info.changes)
+            if variables[position] is Undef]
+        obj_info.unloaded = 0
+        if not positions:
+            return
+
+        names = cls_info.field_names
+        collection = cls_info.get_collection(self)
+        spec = {'_id': obj_info.obj._id}
+        if self._listeners:
+            self._emit('find_one', cls_info.cls, spec)
+        doc = collection.find_one(
+            spec, fields=[names[position] for position in positions])
+        if doc is None:
+            return
+
+        saved = obj_info.saved
+        for position in positions:
+            value = doc.get(names[position], Undef)
+            variables[position] = value
+            if cls_info.fields[position].mutable:
+                value = copy.deepcopy(value)
+            saved[position] = value
+
+    def _build_doc(self, cls_info, doc, unloaded=0):
+        obj = self._cache.get((cls_info, doc["_id"]))
+        if self._listeners:
+            self._emit_cache(cls_info, doc["_id"], obj)
         if obj is not None:
             return obj
+        return self._hydrate(cls_info, doc, unloaded)
+
+    def _hydrate(self, cls_info, doc, unloaded=0):
+        obj_id = doc["_id"]
         cls = cls_info.cls
         obj = cls.__new__(cls)
 
-        obj_info = get_obj_info(obj)
-        obj_info.set("store", self)
-
-        for attr, value in doc.items():
-            if attr == '_id':
-                continue
-            else:
-                field = cls_info.attributes[attr]
-            obj_info.variables[field] = value
+        obj_info = ObjectInfo(obj, cls_info, cls_info.decode(doc))
+        obj.__thunder_object_info__ = obj_info
+        obj_info.store = self
+        obj_info.unloaded = unloaded
 
         obj._id = obj_id
-        self._cache[(cls_info, obj_id)] = obj
+        obj_info.checkpoint()
+        self._cache.add((cls_info, obj_id), obj)
+        if self._listeners:
+            self._emit('hydrate', obj)
         func = getattr(obj, '__thunder_loaded__', None)
         if func:
             func()
         return obj
 
+    def _emit_cache(self, cls_info, obj_id, obj):
+        if obj is None:
+            self._emit('cache_miss', cls_info.cls, obj_id)
+        else:
+            self._emit('cache_hit', cls_info.cls, obj_id)
+
     def _encode(self, obj_info):
+        return obj_info.cls_info.encode(obj_info.variables)
+
+    def _encode_changes(self, obj_info):
+        names = obj_info.cls_info.field_names
+        variables = obj_info.variables
+        saved = obj_info.saved
+        unloaded = obj_info.unloaded
+        changes = {}
+        for position in iter_positions(obj_info.changes):
+            value = variables[position]
+            if not unloaded >> position & 1:
+                if value == saved[position]:
+                    continue
+            if value is Undef:
+                changes.setdefault('$unset', {})[names[position]] = 1
+            else:
+                changes.setdefault('$set', {})[names[position]] = value
+        return changes
+
+    def _write_through(self, obj_info, version):
+        # Objects with fields which were not loaded can't be encoded
+        # entirely, forget their document instead, as when the slot
+        # was written since the version was taken before the update.
         cls_info = obj_info.cls_info
-        doc = {}
-        for attr, field in cls_info.attributes.items():
-            value = obj_info.variables.get(field, field.default)
-            doc[attr] = value
-        return doc
+        obj_id = obj_info.obj._id
+        if not obj_info.unloaded:
+            doc = self._encode(obj_info)
+            doc['_id'] = obj_id
+            if self.shared_cache.put(cls_info.doc_name, doc, version):
+                return
+        self.shared_cache.remove(cls_info.doc_name, obj_id)
+
+    def _record_writes(self, cls_info, obj_ids):
+        written = self._written
+        now = time.time()
+        for obj_id in obj_ids:
+            key = (cls_info.doc_name, obj_id)
+            item = written.get(key)
+            if item is None:
+                written[key] = [1, now]
+            else:
+                item[0] += 1
+                item[1] = now
 
     def _flush_one(self, obj_info):
         cls_info = obj_info.cls_info
         collection = cls_info.get_collection(self)
-        mongo_doc = self._encode(obj_info)
-        action = obj_info.get('action')
         obj = obj_info.obj
-        func = getattr(obj, '__thunder_pre_flush__', None)
-        if func:
-            func()
 
-        if action == 'remove':
-            collection.remove(mongo_doc)
-            obj_info.delete("store")
-        else:
-            collection.save(mongo_doc)
+        if not self._encode_changes(obj_info):
+            # Mutable fields read are tracked again when read next.
+            obj_info.changes = 0
+            return
 
-            obj = obj_info.obj
-            obj_id = mongo_doc['_id']
-            obj._id = obj_id
-            self._cache[(cls_info, obj_id)] = obj
+        _call_hook(obj, '__thunder_pre_flush__')
 
-        func = getattr(obj, '__thunder_flushed__', None)
-        if func:
-            func()
+        # The pre flush hook may have modified the object.
+        changes = self._encode_changes(obj_info)
+        if changes:
+            spec = {'_id': obj._id}
+            if self._listeners:
+                self._emit('update', cls_info.cls, spec, changes)
+            if self.shared_cache is not None:
+                version = self.shared_cache.get_version(cls_info.doc_name,
+                                                        obj._id)
+            collection.update(spec, changes)
+            if self._written is not None:
+                self._record_writes(cls_info, [obj._id])
+            if self.shared_cache is not None:
+                self._write_through(obj_info, version)
+        obj_info.checkpoint()
+
+        _call_hook(obj, '__thunder_flushed__')
+
+    def _flush_updates(self, cls_info, obj_infos):
+        for obj_info in obj_infos:
+            self._flush_one(obj_info)
+
+    def _flush_inserts(self, cls_info, obj_infos):
+        collection = cls_info.get_collection(self)
+        for obj_info in obj_infos:
+            _call_hook(obj_info.obj, '__thunder_pre_flush__')
+
+        for batch in _batches(obj_infos, self.flush_batch_size):
+            mongo_docs = [self._encode(obj_info) for obj_info in batch]
+            if self._listeners:
+                self._emit('insert', cls_info.cls, mongo_docs)
+            collection.insert(mongo_docs)
+            if self._written is not None:
+                self._record_writes(cls_info, [mongo_doc['_id']
+                                               for mongo_doc in mongo_docs])
+
+            for obj_info, mongo_doc in zip(batch, mongo_docs):
+                obj = obj_info.obj
+                obj_id = mongo_doc['_id']
+                obj._id = obj_id
+                obj_info.checkpoint()
+                self._cache.add((cls_info, obj_id), obj)
+                if self.shared_cache is not None:
+                    self.shared_cache.put(cls_info.doc_name, mongo_doc)
+
+        for obj_info in obj_infos:
+            _call_hook(obj_info.obj, '__thunder_flushed__')
+
+    def _flush_removes(self, cls_info, obj_infos):
+        collection = cls_info.get_collection(self)
+        for obj_info in obj_infos:
+            _call_hook(obj_info.obj, '__thunder_pre_flush__')
+
+        for batch in _batches(obj_infos, self.flush_batch_size):
+            spec = {'_id': {'$in': [obj_info.obj._id
+                                    for obj_info in batch]}}
+            if self._listeners:
+                self._emit('remove', cls_info.cls, spec)
+            collection.remove(spec)
+            if self._written is not None:
+                self._record_writes(cls_info, spec['_id']['$in'])
+            for obj_info in batch:
+                if self.shared_cache is not None:
+                    self.shared_cache.remove(cls_info.doc_name,
+                                             obj_info.obj._id)
+                obj_info.delete("store")
+                obj_info.delete("action")
+                obj_info.saved = None
+
+        for obj_info in obj_infos:
+            _call_hook(obj_info.obj, '__thunder_flushed__')
 
     def get(self, cls, obj_id):
+        if self._invalidator is not None:
+            self._invalidator.apply()
         cls_info = get_cls_info(cls)
-        collection = cls_info.get_collection(self)
         obj = self._cache.get((cls_info, obj_id))
+        if self._listeners:
+            self._emit('get', cls, obj_id)
+            self._emit_cache(cls_info, obj_id, obj)
         if obj is not None:
             return obj
-        cursor = self._load(cls_info, collection.find,
-                            {'_id': obj_id}, limit=2)
-        if cursor.count():
-            return self._build_doc(cls_info, cursor[0])
+        shared_cache = self.shared_cache
+        if shared_cache is not None:
+            doc = shared_cache.get(cls_info.doc_name, obj_id)
+            if doc is not None:
+                return self._hydrate(cls_info, doc)
+            version = shared_cache.get_version(cls_info.doc_name, obj_id)
+        collection = cls_info.get_collection(self)
+        doc, unloaded = self._load(cls_info, collection.find_one,
+                                   {'_id': obj_id})
+        if doc is not None:
+            if shared_cache is not None and not unloaded:
+                shared_cache.put(cls_info.doc_name, doc, version)
+            return self._hydrate(cls_info, doc, unloaded)
+
+    def get_many(self, cls, obj_ids):
+        """Returns a list with the objects for obj_ids, in the same
+        order, None is used for ids which could not be found.
 
-    def find(self, cls, *args, **kwargs):
+        Objects which are not in the cache are fetched with one
+        $in query per Store.query_batch_size ids.
+        """
+        if self._invalidator is not None:
+            self._invalidator.apply()
         cls_info = get_cls_info(cls)
-        collection = cls_info.get_collection(self)
-        cursor = self._load(cls_info, collection.find, *args, **kwargs)
+        obj_ids = list(obj_ids)
+        objs = {}
+        missing = []
+        for obj_id in obj_ids:
+            if obj_id in objs:
+                continue
+            obj = self._cache.get((cls_info, obj_id))
+            if self._listeners:
+                self._emit_cache(cls_info, obj_id, obj)
+            if obj is None:
+                missing.append(obj_id)
+            objs[obj_id] = obj
+
+        shared_cache = self.shared_cache
+        versions = {}
+        if shared_cache is not None and missing:
+            fetch = []
+            for obj_id in missing:
+                doc = shared_cache.get(cls_info.doc_name, obj_id)
+                if doc is None:
+                    fetch.append(obj_id)
+                    versions[obj_id] = shared_cache.get_version(
+                        cls_info.doc_name, obj_id)
+                else:
+                    objs[obj_id] = self._hydrate(cls_info, doc)
+            missing = fetch
+
+        if missing:
+            collection = cls_info.get_collection(self)
+            for batch in _batches(missing, self.query_batch_size):
+                spec = {'_id': {'$in': batch}}
+                if self._listeners:
+                    self._emit('find', cls, spec)
+                cursor, unloaded = self._load(cls_info, collection.find,
+                                              spec)
+                for doc in cursor:
+                    if shared_cache is not None and not unloaded:
+                        shared_cache.put(cls_info.doc_name, doc,
+                                         versions.get(doc['_id']))
+                    objs[doc['_id']] = self._hydrate(cls_info, doc, unloaded)
+
+        return [objs[obj_id] for obj_id in obj_ids]
+
+    def _prefetch(self, cls_info, objs, prefetch):
+        for name in prefetch:
+            reference = cls_info.references.get(name)
+            if reference is None:
+                raise ValueError("%s has no reference called %r" % (
+                    cls_info.cls.__name__, name))
+            position = cls_info.index[reference.local_field]
+            obj_ids = set()
+            for obj in objs:
+                obj_id = get_obj_info(obj).variables[position]
+                if obj_id is not None and obj_id is not Undef:
+                    obj_ids.add(obj_id)
+            self.get_many(reference.remote_cls, obj_ids)
+
+    def _iter_results(self, cls_info, cursor, unloaded, prefetch=None):
+        if not prefetch:
+            for item in cursor:
+                yield self._build_doc(cls_info, item, unloaded)
+            return
+
+        # Load the referenced objects of each batch of results into
+        # the cache with one query per reference.
+        objs = []
         for item in cursor:
-            yield self._build_doc(cls_info, item)
+            objs.append(self._build_doc(cls_info, item, unloaded))
+            if len(objs) == self.query_batch_size:
+                self._prefetch(cls_info, objs, prefetch)
+                for obj in objs:
+                    yield obj
+                objs = []
+        if objs:
+            self._prefetch(cls_info, objs, prefetch)
+            for obj in objs:
+                yield obj
+
+    def _invalidate(self, cls_info):
+        """Invalidates the cached objects of a class after a bulk
+        operation, their fields are loaded again when accessed.
+
+        Objects with pending changes are kept as they are.
+        """
+        if self.query_cache is not None:
+            self.query_cache.invalidate(cls_info)
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate(cls_info.doc_name)
+        for obj in self._cache.remove_class(cls_info):
+            obj_info = get_obj_info(obj)
+            if self._is_pending(obj_info):
+                self._cache.add((cls_info, obj._id), obj)
+                continue
+            self._unload(obj_info)
+
+    def _is_pending(self, obj_info):
+        # Objects whose mutable fields were modified in place are only
+        # found when flushing, make them pending so their changes are
+        # kept.
+        if obj_info.flush_pending:
+            return True
+        if (obj_info in self._accessed and obj_info.saved is not None and
+                self._encode_changes(obj_info)):
+            self._set_dirty(obj_info)
+            return True
+        return False
+
+    def _unload(self, obj_info):
+        cls_info = obj_info.cls_info
+        obj_info.variables = [Undef] * cls_info.size
+        obj_info.checkpoint()
+        obj_info.unloaded = cls_info.get_mask(cls_info.field_names)
+
+    def _evict(self, cls_info, obj_id, refresh=False):
+        """Evicts a cached object whose document was modified elsewhere,
+        or with refresh keeps it and loads its fields again when they
+        are accessed.  Returns True if the object was cached.
+        """
+        key = (cls_info, obj_id)
+        obj = self._cache.get(key)
+        if obj is None:
+            return False
+        obj_info = get_obj_info(obj)
+        if self._is_pending(obj_info):
+            return False
+        if refresh:
+            self._unload(obj_info)
+        else:
+            self._cache.remove(key)
+        return True
+
+    def find(self, cls, spec=None, fields=None, **kwargs):
+        """Returns a ResultSet with the objects matching spec.
+
+        prefetch can be a list of ReferenceField attribute names, the
+        objects they refer to are loaded together for each batch of
+        results instead of one by one when they are accessed.
+        """
+        if self._invalidator is not None:
+            self._invalidator.apply()
+        return ResultSet(self, get_cls_info(cls), spec, fields, **kwargs)
+
+    def iter_values(self, cls, names, spec=None, **kwargs):
+        """Yields rows with the values of the given fields for the
+        documents matching spec.
+
+        This is a read-only fast path for reports, the objects are not
+        created and the cache is not used.
+        """
+        return self.find(cls, spec, **kwargs).values(*names)
 
     def find_one(self, cls, *args, **kwargs):
         cls_info = get_cls_info(cls)
+        if self.query_cache is not None and len(args) < 2:
+            spec = args and args[0] or kwargs.pop('spec_or_id', None)
+            if spec is not None and not isinstance(spec, dict):
+                spec = {'_id': spec}
+            fields = kwargs.pop('fields', None)
+            return ResultSet(self, cls_info, spec, fields, **kwargs).first()
         collection = cls_info.get_collection(self)
-        item = self._load(cls_info, collection.find_one, *args, **kwargs)
+        if self._listeners:
+            self._emit('find_one', cls, args and args[0] or
+                       kwargs.get('spec_or_id'))
+        item, unloaded = self._load(cls_info, collection.find_one,
+                                    *args, **kwargs)
         if item is not None:
-            return self._build_doc(cls_info, item)
+            return self._build_doc(cls_info, item, unloaded)
 
     def find_by(self, cls, **kwargs):
-        cls_info = get_cls_info(cls)
-        collection = cls_info.get_collection(self)
-        cursor = self._load(cls_info, collection.find, kwargs)
-        for item in cursor:
-            yield self._build_doc(cls_info, item)
+        prefetch = kwargs.pop('prefetch', None)
+        return ResultSet(self, get_cls_info(cls), kwargs, prefetch=prefetch)
 
     def find_one_by(self, cls, **kwargs):
+        return self.find_by(cls, **kwargs).first()
+
+    def count(self, cls, spec=None, **kwargs):
+        return self.find(cls, spec, **kwargs).count()
+
+    def modify(self, obj):
+        """Returns a Modification of obj, its execute() method sends a
+        single atomic update and sets the modified fields of obj.
+        """
+        obj_info = get_obj_info(obj)
+        if obj_info.store is not self or obj_info.saved is None:
+            raise ValueError("Only objects flushed by this store can be "
+                             "modified")
+        return Modification(self, obj_info.cls_info, {'_id': obj._id},
+                            obj_info)
+
+    def update(self, cls, spec=None):
+        """Returns a Modification of all the documents matching spec,
+        the cached objects of the class are loaded again when accessed
+        once it's executed.
+        """
+        if spec is None:
+            spec = {}
+        return Modification(self, get_cls_info(cls), spec)
+
+    def _refresh(self, obj_info, doc):
+        obj_info.variables = obj_info.cls_info.decode(doc)
+        obj_info.checkpoint()
+        obj_info.unloaded = 0
+
+    def upsert_many(self, cls, records, key, hydrate=False):
+        """Inserts the records, dicts of field values, whose key fields
+        match no document, and sets the fields of the other ones.
+
+        The documents of each batch of Store.query_batch_size records
+        are looked up with one query, the new ones are sent with one
+        insert and an update is sent for each changed one.  Returns a
+        dict with the number of records created, updated and unchanged,
+        with hydrate the objects of the records are loaded into the
+        identity map and returned as objects.
+
+        Hooks are not called.  With a unique index on the key, the new
+        records inserted by another process in the meantime are
+        updated instead, one by one with findAndModify, and counted as
+        updated.  Without one they may be inserted twice.
+        """
         cls_info = get_cls_info(cls)
+        key = tuple(key)
+        attributes = cls_info.attributes
+        for name in key:
+            if name not in attributes:
+                raise ValueError("%s has no field called %r" % (
+                    cls.__name__, name))
         collection = cls_info.get_collection(self)
-        item = self._load(cls_info, collection.find_one, **kwargs)
-        if item is not None:
-            return self._build_doc(cls_info, item)
+        result = dict(created=0, updated=0, unchanged=0)
+        objs = []
+
+        for batch in _batches(list(records), self.query_batch_size):
+            values = []
+            for record in batch:
+                doc = {}
+                for name, value in record.items():
+                    field = attributes.get(name)
+                    if field is None:
+                        raise ValueError("%s has no field called %r" % (
+                            cls.__name__, name))
+                    doc[name] = field.from_python(value)
+                if not all(name in doc for name in key):
+                    raise ValueError("Record %r has no value for %s" % (
+                        record, ', '.join(key)))
+                values.append(doc)
+
+            if len(key) == 1:
+                spec = {key[0]: {'$in': [item[key[0]] for item in values]}}
+            else:
+                spec = {'$or': [dict((name, item[name]) for name in key)
+                                for item in values]}
+            if self._listeners:
+                self._emit('find', cls, spec)
+            found = {}
+            for doc in collection.find(spec):
+                found[tuple(doc.get(name) for name in key)] = doc
+
+            inserts = {}
+            # The fields given for the new documents.
+            sets = {}
+            updated = {}
+            docs = []
+            for doc in values:
+                doc_key = tuple(doc[name] for name in key)
+                current = found.get(doc_key)
+                if current is None:
+                    variables = [Undef] * cls_info.size
+                    for name, value in doc.items():
+                        variables[cls_info.index[attributes[name]]] = value
+                    current = found[doc_key] = cls_info.encode(variables)
+                    inserts[doc_key] = current
+                    sets[doc_key] = dict(doc)
+                    result['created'] += 1
+                else:
+                    changes = dict((name, value)
+                                   for name, value in doc.items()
+                                   if current.get(name, Undef) != value)
+                    if not changes:
+                        result['unchanged'] += 1
+                    elif doc_key in inserts:
+                        current.update(changes)
+                        sets[doc_key].update(changes)
+                        result['updated'] += 1
+                    else:
+                        current.update(changes)
+                        updated.setdefault(doc_key, {}).update(changes)
+                        result['updated'] += 1
+                docs.append(current)
+
+            for doc_key, changes in updated.items():
+                spec = {'_id': found[doc_key]['_id']}
+                if self._listeners:
+                    self._emit('update', cls, spec, {'$set': changes})
+                collection.update(spec, {'$set': changes})
+                if self._written is not None:
+                    self._record_writes(cls_info, [spec['_id']])
+            conflicts = []
+            if inserts:
+                conflicts = self._upsert_inserts(cls_info, collection, key,
+                                                 inserts, sets)
+                result['created'] -= len(conflicts)
+                result['updated'] += len(conflicts)
+
+            # Keep the cached objects of the updated documents in sync.
+            for doc_key in updated.keys() + conflicts:
+                doc = found[doc_key]
+                if self.shared_cache is not None:
+                    self.shared_cache.remove(cls_info.doc_name, doc['_id'])
+                obj = self._cache.get((cls_info, doc['_id']))
+                if obj is not None:
+                    obj_info = get_obj_info(obj)
+                    if not self._is_pending(obj_info):
+                        self._refresh(obj_info, doc)
+            if hydrate:
+                objs.extend(self._build_doc(cls_info, doc) for doc in docs)
+
+        if self.query_cache is not None and \
+           (result['created'] or result['updated']):
+            self.query_cache.invalidate(cls_info)
+        if hydrate:
+            result['objects'] = objs
+        return result
+
+    def _upsert_inserts(self, cls_info, collection, key, inserts, sets):
+        # Inserts the new documents of upsert_many.  The ones another
+        # process inserted first are updated with findAndModify, which
+        # replaces their content in inserts, returns their keys.
+        items = inserts.items()
+        conflicts = []
+        written = []
+        while items:
+            new_docs = [doc for doc_key, doc in items]
+            if self._listeners:
+                self._emit('insert', cls_info.cls, new_docs)
+            try:
+                collection.insert(new_docs, safe=True)
+            except DuplicateKeyError:
+                pass
+            else:
+                written.extend(doc['_id'] for doc in new_docs)
+                break
+
+            # The insert stops at the first duplicate, the documents
+            # after it may not even have been given an _id.
+            ids = [doc['_id'] for doc in new_docs if '_id' in doc]
+            stored = set(doc['_id'] for doc in collection.find(
+                {'_id': {'$in': ids}}, fields=['_id']))
+            position = 0
+            while new_docs[position].get('_id') in stored:
+                written.append(new_docs[position]['_id'])
+                position += 1
+
+            doc_key, doc = items[position]
+            spec = dict(zip(key, doc_key))
+            update = {'$set': sets[doc_key]}
+            if self._listeners:
+                self._emit('update', cls_info.cls, spec, update)
+            new_doc = collection.find_and_modify(spec, update, upsert=True,
+                                                 new=True)
+            doc.clear()
+            doc.update(new_doc)
+            written.append(doc['_id'])
+            conflicts.append(doc_key)
+            items = items[position + 1:]
 
-    def count(self, cls):
+        if self._written is not None:
+            self._record_writes(cls_info, written)
+        return conflicts
+
+    def paginate(self, cls, spec, sort_field, page_size, after=None,
+                 direction=1):
+        """Returns a list with a page of the objects matching spec,
+        sorted by sort_field and _id, and a token for the next page,
+        which is None after the last one.
+
+        The token holds the sort key and the _id of the last object,
+        passing it as after fetches the objects past it.  With an index
+        on (sort_field, _id) each page is a single range query, unlike
+        skipping over the previous pages.  Objects without a value for
+        sort_field come first, like the server sorts them.
+        """
         cls_info = get_cls_info(cls)
-        collection = cls_info.get_collection(self)
-        return collection.find().count()
+        if sort_field != '_id' and sort_field not in cls_info.attributes:
+            raise ValueError("%s has no field called %r" % (
+                cls.__name__, sort_field))
+        op = direction < 0 and '$lt' or '$gt'
+        if after is not None:
+            key, obj_id = _decode_token(after)
+            if sort_field == '_id':
+                cond = {'_id': {op: obj_id}}
+            else:
+                cond = {'$or': _page_conditions(sort_field, key, obj_id,
+                                                direction)}
+            spec = spec and {'$and': [spec, cond]} or cond
+        ordering = [(sort_field, direction)]
+        if sort_field != '_id':
+            ordering.append(('_id', direction))
+        objs = list(ResultSet(self, cls_info, spec, sort=ordering,
+                              limit=page_size + 1))
+        if len(objs) <= page_size:
+            return objs, None
+
+        del objs[page_size:]
+        last = objs[-1]
+        if sort_field == '_id':
+            key = None
+        else:
+            obj_info = get_obj_info(last)
+            position = cls_info.index[cls_info.attributes[sort_field]]
+            if obj_info.unloaded >> position & 1:
+                # The object was cached without the field, read the
+                # value the page was sorted by.
+                spec = {'_id': last._id}
+                if self._listeners:
+                    self._emit('find_one', cls, spec)
+                doc = cls_info.get_collection(self).find_one(
+                    spec, fields=[sort_field])
+                key = doc and doc.get(sort_field)
+            else:
+                variables = obj_info.saved or obj_info.variables
+                key = variables[position]
+            if key is Undef:
+                key = None
+        return objs, _encode_token(key, last._id)
 
     def add(self, obj):
         obj_info = get_obj_info(obj)
@@ -133,8 +899,7 @@ class Store(object):
                 "Document %s is already in a store" % (obj, ))
 
         obj_info.set('store', self)
-        obj_info.flush_pending = True
-        self.obj_infos.add(obj_info)
+        self._set_dirty(obj_info)
 
     def remove(self, obj):
         obj_info = get_obj_info(obj)
@@ -142,23 +907,213 @@ class Store(object):
         if store != self:
             raise Exception("This object does not belong to this store")
 
+        if obj_info.saved is None:
+            # Never flushed, just forget about it.
+            self._set_clean(obj_info)
+            obj_info.delete('store')
+            return
+
         obj_info.set('action', 'remove')
-        obj_info.flush_pending = True
-        self.obj_infos.add(obj_info)
-        del self._cache[(obj_info.cls_info, obj._id)]
+        self._set_dirty(obj_info)
+        self._cache.remove((obj_info.cls_info, obj._id))
+
+    def _set_dirty(self, obj_info):
+        if not obj_info.flush_pending:
+            obj_info.flush_pending = True
+            self.obj_infos.add(obj_info)
+
+    def _set_clean(self, obj_info):
+        obj_info.flush_pending = False
+        self.obj_infos.discard(obj_info)
+
+    def _take_flushes(self):
+        """Takes the pending objects and returns a list of
+        (method, cls_info, obj_infos) which flush them when called as
+        method(cls_info, obj_infos), in order.
+        """
+        pending = self.obj_infos
+        self.obj_infos = set()
+        accessed = self._accessed
+        self._accessed = weakref.WeakSet()
+
+        inserts = {}
+        removes = {}
+        updates = {}
+        for obj_info in accessed:
+            if (obj_info.flush_pending or obj_info.store is not self or
+                    obj_info.saved is None):
+                continue
+            if self._encode_changes(obj_info):
+                updates.setdefault(obj_info.cls_info, []).append(obj_info)
+            else:
+                # So they are tracked again when read after this flush.
+                obj_info.changes = 0
+        for obj_info in pending:
+            if not obj_info.flush_pending:
+                continue
+            # Clear it first so hooks modifying the object puts it
+            # back into the pending set.
+            obj_info.flush_pending = False
+            cls_info = obj_info.cls_info
+            if obj_info.get('action') == 'remove':
+                removes.setdefault(cls_info, []).append(obj_info)
+            elif obj_info.saved is None:
+                inserts.setdefault(cls_info, []).append(obj_info)
+            else:
+                updates.setdefault(cls_info, []).append(obj_info)
+
+        flushes = []
+        for method, objs in [(self._flush_updates, updates),
+                             (self._flush_inserts, inserts),
+                             (self._flush_removes, removes)]:
+            for cls_info, obj_infos in objs.items():
+                flushes.append((method, cls_info, obj_infos))
+        return flushes
+
+    def _restore_flushes(self, flushes):
+        # Makes the objects a failed flush didn't write pending again,
+        # the written ones were checkpointed or removed.
+        for method, cls_info, obj_infos in flushes:
+            for obj_info in obj_infos:
+                if obj_info.store is not self:
+                    continue
+                if (obj_info.get('action') == 'remove' or
+                        obj_info.saved is None or obj_info.changes):
+                    self._set_dirty(obj_info)
+
+    def _invalidate_queries(self, flushes):
+        if self.query_cache is not None:
+            for cls_info in set(flush[1] for flush in flushes):
+                self.query_cache.invalidate(cls_info)
 
     def flush(self):
-        for obj_info in self.obj_infos:
-            # FIXME: Use obj_info.flush_pending
-            self._flush_one(obj_info)
+        if self._invalidator is not None:
+            self._invalidator.apply()
+        flushes = self._take_flushes()
+        try:
+            for method, cls_info, obj_infos in flushes:
+                method(cls_info, obj_infos)
+        except Exception:
+            self._restore_flushes(flushes)
+            raise
+        finally:
+            self._invalidate_queries(flushes)
+        if self._listeners:
+            self._emit('flush', sum(len(flush[2]) for flush in flushes))
 
     def drop_cache(self):
-        self._cache = {}
+        self._cache.clear()
+
+    def get_cache_stats(self):
+        """Returns a dict with the size of the identity map and its
+        hits, misses and evictions counters.
+        """
+        return self._cache.get_stats()
+
+    def _get_indexed_classes(self, cls):
+        if cls is None:
+            return [cls_info for cls_info in get_cls_infos()
+                    if cls_info.indexes]
+        if isinstance(cls, type):
+            cls = [cls]
+        return [get_cls_info(doc_cls) for doc_cls in cls]
+
+    def _compare_indexes(self, cls_info):
+        """Returns the indexes of a collection as returned by the server,
+        the declared ones missing from it and the names of the extra ones.
+        """
+        collection = cls_info.get_collection(self)
+        info = collection.index_information()
+        info.pop('_id_', None)
+        missing = [index for index in cls_info.indexes
+                   if index.name not in info or
+                   not index.matches(info[index.name])]
+        declared = set(index.name for index in cls_info.indexes)
+        extra = sorted(name for name in info if name not in declared)
+        return info, missing, extra
+
+    def get_index_report(self, cls=None):
+        """Compares the indexes declared by cls, a class or a list of
+        classes, with the ones on the server.
+
+        Without cls, the classes declaring indexes which were already
+        used in the process are compared, eg stored or passed to
+        get_cls_info; the classes are only known once they are used, so
+        pass them all when checking at startup.
+
+        Returns a dict mapping collection names to dicts with the names
+        of the 'missing' indexes, including the ones whose definition
+        changed, and of the 'extra' ones which are not declared.
+        """
+        report = {}
+        for cls_info in self._get_indexed_classes(cls):
+            info, missing, extra = self._compare_indexes(cls_info)
+            report[cls_info.doc_name] = dict(
+                missing=[index.name for index in missing], extra=extra)
+        return report
+
+    def ensure_indexes(self, cls=None, drop_extra=False):
+        """Creates the missing indexes declared by cls, a class or a
+        list of classes, or by the classes used, see get_index_report:
+
+            store.ensure_indexes([Person, Post])
+
+        Indexes whose definition changed are rebuilt, extra indexes are
+        only dropped if drop_extra is set.
+
+        Returns the report of get_index_report from before the changes.
+        """
+        report = {}
+        for cls_info in self._get_indexed_classes(cls):
+            collection = cls_info.get_collection(self)
+            info, missing, extra = self._compare_indexes(cls_info)
+            for index in missing:
+                if index.name in info:
+                    collection.drop_index(index.name)
+                collection.create_index(index.keys, **index.get_options())
+            if drop_extra:
+                for name in extra:
+                    collection.drop_index(name)
+            report[cls_info.doc_name] = dict(
+                missing=[index.name for index in missing], extra=extra)
+        return report
+
+    def profile_report(self, explain=5):
+        """Returns the statistics of the queries sent by the store, the
+        query shapes most in need of an index first.
+
+        The store must have been created with a Profiler, see
+        Profiler.get_report.
+        """
+        if self.profiler is None:
+            raise TypeError("Store was created without a profiler")
+        return self.profiler.get_report(explain)
 
     def drop_collection(self, cls):
         cls_info = get_cls_info(cls)
         collection = cls_info.get_collection(self)
         collection.drop()
+        if self.query_cache is not None:
+            self.query_cache.invalidate(cls_info)
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate(cls_info.doc_name)
+
+    def parallel_scan(self, cls, spec, func, workers=4, names=None,
+                      reduce_func=None, ranges=None, conn_string=None):
+        """Calls func with each object matching spec in a pool of
+        worker processes and returns the list of results.
+
+        The _id values are split in ranges which are each loaded by a
+        worker with its own store, connected to conn_string or the one
+        of this store.  func is called with rows of the values of names
+        instead of objects if they are given, the results are combined
+        with reduce_func if it is.
+
+        A ScanError is raised if ranges failed, they can be scanned
+        again by passing ranges=error.failed.
+        """
+        return parallel_scan(self, cls, spec, func, workers, names,
+                             reduce_func, ranges, conn_string)
 
     def drop_collections(self):
         for name in self.database.collection_names():
@@ -166,3 +1121,200 @@ class Store(object):
                 continue
             collection = self.database[name]
             collection.drop()
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        if self.shared_cache is not None:
+            self.shared_cache.clear()
+
+
+class ResultSet(object):
+    """The objects matching a query.
+
+    Nothing is sent to the server until the result set is iterated or
+    one of count(), first(), one(), values(), set() or remove() is
+    called.  limit(), skip(), sort(), batch_size() and read_ahead()
+    return a new result set.
+    """
+
+    # Documents read at once by read_ahead() without a batch_size().
+    read_ahead_size = 100
+
+    def __init__(self, store, cls_info, spec=None, fields=None,
+                 prefetch=None, batch_size=None, **kwargs):
+        if spec is None:
+            spec = {}
+        self._store = store
+        self._cls_info = cls_info
+        self._spec = spec
+        self._fields = fields
+        self._prefetch = prefetch
+        self._batch_size = batch_size
+        # Passed on to collection.find(), eg skip, limit and sort.
+        self._kwargs = kwargs
+        self._read_ahead = 0
+
+    def _copy(self, **kwargs):
+        options = self._kwargs.copy()
+        options.update(kwargs)
+        result = ResultSet(self._store, self._cls_info, self._spec,
+                           self._fields, self._prefetch, self._batch_size,
+                           **options)
+        result._read_ahead = self._read_ahead
+        return result
+
+    def _get_collection(self):
+        return self._cls_info.get_collection(self._store)
+
+    def _emit(self, name, *args):
+        if self._store._listeners:
+            self._store._emit(name, self._cls_info.cls, self._spec, *args)
+
+    def __iter__(self):
+        query_cache = self._store.query_cache
+        if query_cache is not None:
+            key = query_cache.get_key(self._cls_info, self._spec,
+                                      self._fields, self._kwargs)
+            if key is not None:
+                return iter(self._get_cached(query_cache, key, self._iter))
+        return self._iter()
+
+    def _get_cached(self, query_cache, key, load):
+        # Returns the list of objects of a query cached by their ids,
+        # load() is called on a miss.
+        obj_ids = query_cache.get(key)
+        if obj_ids is None:
+            objs = [obj for obj in load() if obj is not None]
+            query_cache.add(key, [obj._id for obj in objs])
+            return objs
+
+        store = self._store
+        objs = store.get_many(self._cls_info.cls, obj_ids)
+        objs = [obj for obj in objs if obj is not None]
+        if self._prefetch:
+            store._prefetch(self._cls_info, objs, self._prefetch)
+        return objs
+
+    def _iter(self):
+        store = self._store
+        self._emit('find')
+        cursor, unloaded = store._load(self._cls_info,
+                                       self._get_collection().find,
+                                       self._spec, fields=self._fields,
+                                       **self._kwargs)
+        if self._batch_size:
+            cursor.batch_size(self._batch_size)
+        if self._read_ahead:
+            cursor = _read_ahead(cursor,
+                                 self._batch_size or self.read_ahead_size,
+                                 self._read_ahead)
+        return store._iter_results(self._cls_info, cursor, unloaded,
+                                   self._prefetch)
+
+    def limit(self, limit):
+        return self._copy(limit=limit)
+
+    def skip(self, skip):
+        return self._copy(skip=skip)
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        return self._copy(sort=list(key_or_list))
+
+    def batch_size(self, batch_size):
+        result = self._copy()
+        result._batch_size = batch_size
+        return result
+
+    def read_ahead(self, batches=2):
+        """Returns a result set whose documents are read by a background
+        thread while the objects are being created and used, up to
+        batches batches of batch_size() documents ahead.
+        """
+        result = self._copy()
+        result._read_ahead = batches
+        return result
+
+    def count(self):
+        """Returns the number of matching documents, counted by the
+        server, taking limit() and skip() into account.
+        """
+        options = dict((key, value) for key, value in self._kwargs.items()
+                       if key in ['limit', 'skip'])
+        self._emit('count')
+        cursor = self._get_collection().find(self._spec, **options)
+        return cursor.count(with_limit_and_skip=True)
+
+    def first(self):
+        """Returns the first matching object or None."""
+        options = self._kwargs.copy()
+        options.pop('limit', None)
+        query_cache = self._store.query_cache
+        if query_cache is not None:
+            key = query_cache.get_key(self._cls_info, self._spec,
+                                      self._fields, dict(options, limit=-1))
+            if key is not None:
+                def load():
+                    return [self._first(options)]
+                for obj in self._get_cached(query_cache, key, load):
+                    return obj
+                return None
+        return self._first(options)
+
+    def _first(self, options):
+        store = self._store
+        self._emit('find_one')
+        item, unloaded = store._load(self._cls_info,
+                                     self._get_collection().find_one,
+                                     self._spec, fields=self._fields,
+                                     **options)
+        if item is not None:
+            return store._build_doc(self._cls_info, item, unloaded)
+
+    def one(self):
+        """Returns the matching object, or None if there are none.
+
+        Raises NotOneError if more than one object matches.
+        """
+        objs = list(self.limit(2))
+        if len(objs) > 1:
+            raise NotOneError("one() used with more than one result")
+        if objs:
+            return objs[0]
+
+    def values(self, *names):
+        """Yields a row with the values of the given fields for each
+        matching document, without loading the objects.
+
+        Rows are tuples which also allow accessing the values as
+        attributes.
+        """
+        decoder = self._cls_info.get_row_decoder(names)
+        self._emit('find')
+        cursor = self._get_collection().find(self._spec, fields=list(names),
+                                             **self._kwargs)
+        if self._batch_size:
+            cursor.batch_size(self._batch_size)
+        return itertools.imap(decoder, cursor)
+
+    def set(self, **kwargs):
+        """Sets the given fields on all matching documents with a
+        single update.
+        """
+        cls_info = self._cls_info
+        doc = {}
+        for name, value in kwargs.items():
+            field = cls_info.attributes.get(name)
+            if field is None:
+                raise ValueError("%s has no field called %r" % (
+                    cls_info.cls.__name__, name))
+            doc[name] = field.from_python(value)
+        self._emit('update', {'$set': doc})
+        self._get_collection().update(self._spec, {'$set': doc}, multi=True)
+        self._store._invalidate(cls_info)
+
+    def remove(self):
+        """Removes all matching documents with a single remove."""
+        self._emit('remove')
+        self._get_collection().remove(self._spec)
+        self._store._invalidate(self._cls_info)
@@ -0,0 +1,137 @@
+import threading
+import time
+import unittest
+
+try:
+    from concurrent.futures import wait
+    from thunder.asyncstore import AsyncStore
+except ImportError:
+    AsyncStore = None
+from thunder.fields import StringField
+from thunder.testutils import StoreTest
+
+
+class Person(object):
+    name = StringField()
+
+    def __thunder_loaded__(self):
+        self.loaded = True
+
+
+class Address(object):
+    street = StringField()
+
+    def __thunder_flushed__(self):
+        self.flushed = True
+
+
+@unittest.skipIf(AsyncStore is None, "futures is not installed")
+class TestAsyncStore(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.async_store = AsyncStore(self.store)
+
+    def tearDown(self):
+        self.async_store.shutdown()
+        StoreTest.tearDown(self)
+
+    def testFlush(self):
+        people = []
+        for i in range(3):
+            p = Person()
+            p.name = u'Person %d' % (i, )
+            self.async_store.add(p)
+            people.append(p)
+        a = Address()
+        self.async_store.add(a)
+
+        self.assertEquals(self.async_store.flush().result(), 4)
+        self.failUnless(a.flushed)
+        self.assertOp(Person, name='insert')
+        self.assertOp(Address, name='insert')
+        self.assertEquals(self.async_store.flush().result(), 0)
+
+        self.store.drop_cache()
+        p = self.async_store.get(Person, people[0]._id).result()
+        self.assertOp(Person, name='find_one')
+        self.assertEquals(p.name, u'Person 0')
+        self.failUnless(p.loaded)
+
+        people = self.async_store.get_many(
+            Person, [person._id for person in people]).result()
+        self.assertOp(Person, name='find')
+        self.assertEquals([person.name for person in people],
+                          [u'Person 0', u'Person 1', u'Person 2'])
+        self.failUnless(people[0] is p)
+
+        objs = self.async_store.find(Person, {'name': u'Person 1'}).result()
+        self.assertOp(Person, name='find')
+        self.assertEquals(objs, [people[1]])
+        self.assertEquals(
+            self.async_store.find_one(Person, {'name': u'Person 2'}).result(),
+            people[2])
+        self.assertOp(Person, name='find_one')
+
+    def testQueryAfterFlush(self):
+        flushing = threading.Event()
+        release = threading.Event()
+
+        class Slow(object):
+            name = StringField()
+
+            def __thunder_pre_flush__(self):
+                flushing.set()
+                release.wait()
+
+        slow = Slow()
+        self.async_store.add(slow)
+        flushed = self.async_store.flush()
+        flushing.wait()
+        found = self.async_store.find_one(Slow)
+        try:
+            self.failIf(wait([found], timeout=0.1).done)
+        finally:
+            release.set()
+        self.assertEquals(flushed.result(), 1)
+        self.failUnless(found.result() is slow)
+        self.assertOp(Slow, name='find_one')
+        self.assertOp(Slow, name='insert')
+
+    def testFlushDuringQuery(self):
+        person = Person()
+        person.name = u'Ann'
+        self.async_store.add(person)
+        self.async_store.flush().result()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        loading = threading.Event()
+        release = threading.Event()
+        timer = threading.Timer(2, release.set)
+        timer.start()
+        loaded = Person.__dict__['__thunder_loaded__']
+        Person.__thunder_loaded__ = lambda self: (loading.set(),
+                                                  release.wait())
+        try:
+            found = self.async_store.get(Person, person._id)
+            loading.wait()
+            start = time.time()
+            flushed = self.async_store.flush()
+            self.failUnless(time.time() - start < 1)
+            self.failIf(flushed.done())
+        finally:
+            release.set()
+            timer.cancel()
+            Person.__thunder_loaded__ = loaded
+        self.assertEquals(found.result().name, u'Ann')
+        self.assertEquals(flushed.result(), 0)
+        self.assertOp(Person, name='find_one')
+
+    def testFlushError(self):
+        class Broken(object):
+            name = StringField()
+
+            def __thunder_pre_flush__(self):
+                raise ValueError
+        self.async_store.add(Broken())
+        self.assertRaises(ValueError, self.async_store.flush().result)
@@ -0,0 +1,20 @@
+import unittest
+
+from thunder import bench
+from thunder.testutils import TEST_URI
+
+
+class TestBench(unittest.TestCase):
+    def testRun(self):
+        results = bench.run(TEST_URI, 20, repeat=1,
+                            names=['find', 'get', 'flush', 'reference',
+                                   'decimal'])
+        self.assertEquals(results['count'], 20)
+        self.assertEquals(sorted(results['results']), [
+            'decimal_decode', 'decimal_encode', 'find', 'find_read_ahead',
+            'flush_modified',
+            'flush_new', 'get_cold', 'get_shared', 'get_warm', 'iter_values',
+            'reference'])
+        for result in results['results'].values():
+            self.assertEquals(sorted(result),
+                              ['allocations', 'ops_per_sec', 'peak_rss_kb'])
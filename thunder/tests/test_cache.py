@@ -0,0 +1,241 @@
+import gc
+import unittest
+
+from thunder.cache import Cache, LRUCache, QueryCache, WeakCache
+from thunder.fields import StringField
+from thunder.info import get_cls_info, get_obj_info
+from thunder.store import Store
+from thunder.testutils import TEST_URI, StoreTest
+
+
+class Document(object):
+    pass
+
+
+class TestCache(unittest.TestCase):
+    def testSimple(self):
+        cache = Cache()
+        d = Document()
+        self.assertEquals(cache.get(1), None)
+        cache.add(1, d)
+        self.failUnless(cache.get(1) is d)
+        self.assertEquals(len(cache), 1)
+        cache.remove(1)
+        self.assertEquals(cache.get(1), None)
+        cache.add(1, d)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get_stats(),
+                          dict(size=0, hits=1, misses=2, evictions=0))
+
+
+class TestWeakCache(unittest.TestCase):
+    def testCollected(self):
+        cache = WeakCache()
+        d = Document()
+        cache.add(1, d)
+        self.failUnless(cache.get(1) is d)
+        del d
+        gc.collect()
+        self.assertEquals(cache.get(1), None)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.evictions, 1)
+
+    def testReplaced(self):
+        cache = WeakCache()
+        d1 = Document()
+        d2 = Document()
+        cache.add(1, d1)
+        cache.add(1, d2)
+        del d1
+        gc.collect()
+        self.failUnless(cache.get(1) is d2)
+        self.assertEquals(cache.evictions, 0)
+
+
+class TestLRUCache(unittest.TestCase):
+    def testEvict(self):
+        cache = LRUCache(size=2)
+        docs = [Document() for i in range(3)]
+        cache.add(0, docs[0])
+        cache.add(1, docs[1])
+        cache.get(0)
+        cache.add(2, docs[2])
+        self.assertEquals(len(cache), 2)
+        self.failUnless(cache.get(0) is docs[0])
+        self.assertEquals(cache.get(1), None)
+        self.assertEquals(cache.evictions, 1)
+
+    def testPending(self):
+        cache = LRUCache(size=1)
+        docs = [Document() for i in range(3)]
+        get_obj_info(docs[0]).flush_pending = True
+        get_obj_info(docs[1]).flush_pending = True
+        cache.add(0, docs[0])
+        cache.add(1, docs[1])
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.evictions, 0)
+
+        get_obj_info(docs[0]).flush_pending = False
+        cache.add(2, docs[2])
+        self.assertEquals(cache.get(0), None)
+        self.failUnless(cache.get(1) is docs[1])
+        self.failUnless(cache.get(2) is docs[2])
+        self.assertEquals(cache.evictions, 1)
+
+    def testAllPending(self):
+        cache = LRUCache(size=2)
+        docs = [Document() for i in range(3)]
+        for i, doc in enumerate(docs[:2]):
+            get_obj_info(doc).flush_pending = True
+            cache.add(i, doc)
+        cache.add(2, docs[2])
+        self.assertEquals(len(cache), 3)
+        self.failUnless(cache.get(2) is docs[2])
+        self.assertEquals(cache.evictions, 0)
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = QueryCache(size=2, ttl=10, clock=lambda: self.now)
+        self.cls_info = get_cls_info(Document)
+
+    def testKey(self):
+        key = self.cache.get_key(self.cls_info, {'a': 1, 'b': [1, {'c': 2}]},
+                                 ['a'], {'limit': 1})
+        self.assertEquals(key, self.cache.get_key(
+            self.cls_info, {'b': [1, {'c': 2}], 'a': 1}, ['a'],
+            {'limit': 1}))
+        self.assertNotEquals(key, self.cache.get_key(
+            self.cls_info, {'a': 1, 'b': [1, {'c': 2}]}, ['a']))
+        self.assertEquals(
+            self.cache.get_key(self.cls_info, {'a': set()}), None)
+
+    def testExpire(self):
+        key = self.cache.get_key(self.cls_info, {})
+        self.cache.add(key, [1, 2])
+        self.assertEquals(self.cache.get(key), (1, 2))
+        self.now = 10
+        self.assertEquals(self.cache.get(key), None)
+        self.assertEquals(len(self.cache), 0)
+
+    def testEvict(self):
+        keys = [self.cache.get_key(self.cls_info, {'a': i})
+                for i in range(3)]
+        self.cache.add(keys[0], [0])
+        self.cache.add(keys[1], [1])
+        self.cache.get(keys[0])
+        self.cache.add(keys[2], [2])
+        self.assertEquals(self.cache.get(keys[1]), None)
+        self.assertEquals(self.cache.get(keys[0]), (0, ))
+        self.assertEquals(self.cache.get_stats(),
+                          dict(size=2, hits=2, misses=1, evictions=1,
+                               invalidations=0))
+
+    def testInvalidate(self):
+        key = self.cache.get_key(self.cls_info, {})
+        self.cache.add(key, [1])
+        self.cache.invalidate(self.cls_info)
+        self.assertEquals(self.cache.get(key), None)
+        self.cache.add(key, [1])
+        self.assertEquals(self.cache.get(key), (1, ))
+
+
+class TestStoreQueryCache(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.store = Store(TEST_URI, 'thunder-test',
+                           query_cache=QueryCache())
+        self.store.trace = True
+
+    def testFind(self):
+        class Person(object):
+            name = StringField()
+
+        for name in ['Ann', 'Bob']:
+            p = Person()
+            p.name = name
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        people = list(self.store.find_by(Person, name='Ann'))
+        self.assertOp(Person, name='find')
+        self.assertEquals(list(self.store.find_by(Person, name='Ann')),
+                          people)
+        self.failUnless(self.store.find_one(Person, {'name': 'Ann'})
+                        is people[0])
+        self.assertOp(Person, name='find_one')
+        self.failUnless(self.store.find_one_by(Person, name='Ann')
+                        is people[0])
+        self.failIf(self.getCollection(Person).ops)
+
+        p = Person()
+        p.name = 'Ann'
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.assertEquals(len(list(self.store.find_by(Person, name='Ann'))),
+                          2)
+        self.assertOp(Person, name='find')
+
+        self.store.find(Person, {'name': 'Bob'}).remove()
+        self.assertOp(Person, name='remove')
+        self.assertEquals(self.store.find_one(Person, {'name': 'Bob'}), None)
+        self.assertOp(Person, name='find_one')
+        self.assertEquals(self.store.query_cache.hits, 2)
+
+
+class TestStoreCache(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.store = Store(TEST_URI, 'thunder-test', cache=LRUCache(2))
+        self.store.trace = True
+
+    def testStats(self):
+        class Person(object):
+            name = StringField()
+
+        people = []
+        for i in range(3):
+            p = Person()
+            p.name = 'Person %d' % (i, )
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        self.store.drop_cache()
+        p0, p1, p2 = [person._id for person in people]
+        self.store.get(Person, p0)
+        self.store.get(Person, p1)
+        self.store.get(Person, p0)
+        self.store.get(Person, p2)
+        self.store.get(Person, p1)
+        for i in range(4):
+            self.assertOp(Person, name='find_one')
+        self.assertEquals(self.store.get_cache_stats(),
+                          dict(size=2, hits=1, misses=4, evictions=3))
+
+    def testPendingIdentity(self):
+        class Person(object):
+            name = StringField()
+
+        for i in range(3):
+            p = Person()
+            p.name = 'Person %d' % (i, )
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        obj_ids = [row[0] for row in self.store.iter_values(Person, ['_id'])]
+        self.assertOp(Person, name='find')
+        self.store.drop_cache()
+
+        for obj_id in obj_ids[:2]:
+            self.store.get(Person, obj_id).name = u'Changed'
+            self.assertOp(Person, name='find_one')
+        p1 = self.store.get(Person, obj_ids[2])
+        self.assertOp(Person, name='find_one')
+        self.failUnless(self.store.get(Person, obj_ids[2]) is p1)
+        self.assertEquals(self.store.get_cache_stats()['size'], 3)
@@ -0,0 +1,67 @@
+from thunder.events import Counters
+from thunder.fields import StringField
+from thunder.testutils import StoreTest
+
+
+class Person(object):
+    name = StringField()
+
+
+class TestEvents(StoreTest):
+    def testCounters(self):
+        counters = Counters()
+        self.store.add_listener(counters)
+
+        people = []
+        for i in range(3):
+            p = Person()
+            p.name = u'Person %d' % (i, )
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        people[0].name = u'Changed'
+        self.store.remove(people[1])
+        self.store.flush()
+        self.assertOp(Person, name='remove')
+        self.assertOp(Person, name='update')
+
+        self.store.get(Person, people[0]._id)
+        self.store.drop_cache()
+        self.store.get(Person, people[0]._id)
+        self.assertOp(Person, name='find_one')
+        list(self.store.find(Person))
+        self.assertOp(Person, name='find')
+
+        self.assertEquals(counters, {
+            'insert': 1, 'update': 1, 'remove': 1, 'flush': 2, 'get': 2,
+            'find': 1, 'cache_hit': 2, 'cache_miss': 2, 'hydrate': 2})
+
+    def testArguments(self):
+        events = []
+        self.store.add_listener(lambda *args: events.append(args),
+                                ['find', 'update'])
+        self.store.find(Person, {'name': u'John'}).set(name=u'Jack')
+        list(self.store.find(Person, {'name': u'Jack'}))
+        self.assertOp(Person, name='find')
+        self.assertOp(Person, name='update')
+        self.assertEquals(events, [
+            ('update', Person, {'name': u'John'},
+             {'$set': {'name': u'Jack'}}),
+            ('find', Person, {'name': u'Jack'})])
+
+    def testSampling(self):
+        counters = Counters()
+        self.store.add_listener(counters, ['count'], sample_rate=0)
+        self.store.count(Person)
+        self.assertOp(Person, name='find')
+        self.failIf(counters)
+
+    def testRemoveListener(self):
+        counters = Counters()
+        self.store.add_listener(counters)
+        self.store.remove_listener(counters)
+        self.failIf(self.store._listeners)
+        self.assertRaises(ValueError, self.store.add_listener, counters,
+                          ['save'])
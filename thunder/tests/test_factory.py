@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from thunder.cache import LRUCache
+from thunder.factory import StoreFactory
+from thunder.fields import StringField
+from thunder.testutils import TEST_URI
+
+
+class Person(object):
+    name = StringField()
+
+
+class TestStoreFactory(unittest.TestCase):
+    def setUp(self):
+        self.factory = StoreFactory(TEST_URI, 'thunder-test')
+
+    def tearDown(self):
+        self.factory.create().drop_collections()
+
+    def testGet(self):
+        store = self.factory.get()
+        self.failUnless(self.factory.get() is store)
+        self.failUnless(store.connection is self.factory.connection)
+
+        self.factory.release()
+        self.failIf(self.factory.get() is store)
+
+    def testCacheFactory(self):
+        factory = StoreFactory(TEST_URI, 'thunder-test',
+                               cache_factory=lambda: LRUCache(10))
+        caches = [factory.create()._cache for i in range(2)]
+        self.failUnless(isinstance(caches[0], LRUCache))
+        self.failIf(caches[0] is caches[1])
+
+    def testThreads(self):
+        stores = []
+        errors = []
+
+        def work(i):
+            try:
+                store = self.factory.get()
+                stores.append(store)
+                for j in range(20):
+                    p = Person()
+                    p.name = u'%d-%d' % (i, j)
+                    store.add(p)
+                store.flush()
+                self.assertEquals(
+                    store.find(Person, {'name': u'%d-0' % (i, )}).count(), 1)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i, ))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+        self.assertEquals(len(set(map(id, stores))), 5)
+        self.assertEquals(self.factory.get().count(Person), 100)
+
+    def testSession(self):
+        with self.factory.session() as store:
+            p = Person()
+            store.add(p)
+        self.assertEquals(self.factory.get().count(Person), 1)
+
+        def fail():
+            with self.factory.session() as store:
+                store.add(Person())
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(self.factory.get().count(Person), 1)
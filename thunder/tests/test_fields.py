@@ -26,7 +26,7 @@ class DateTimeFieldTest(StoreTest):
         self.store.flush()
         self.store.drop_cache()
 
-        self.assertEquals(collection.ops.pop().name, 'save')
+        self.assertEquals(collection.ops.pop().name, 'insert')
 
         d = list(self.store.find(DateTimeDocument))[0]
         self.assertEquals(d.date, old)
@@ -47,7 +47,7 @@ class DecimalFieldTest(StoreTest):
         self.store.flush()
         self.store.drop_cache()
 
-        self.assertEquals(collection.ops.pop().name, 'save')
+        self.assertEquals(collection.ops.pop().name, 'insert')
 
         d = list(self.store.find(DecimalDocument))[0]
         self.assertEquals(d.dec, old)
@@ -58,6 +58,16 @@ class DecimalFieldTest(StoreTest):
 
         self.assertEquals(collection.ops.pop().name, 'find')
 
+    def testDefault(self):
+        class DecimalDocument(object):
+            dec = DecimalField()
+        self.store.add(DecimalDocument())
+        self.store.flush()
+        self.assertOp(DecimalDocument, name='insert')
+        doc = self.getCollection(DecimalDocument).collection.find_one()
+        self.assertEquals(doc['dec'], 0)
+        self.failIf(isinstance(doc['dec'], decimal.Decimal))
+
 
 class TestField(unittest.TestCase):
     def test__get__(self):
@@ -109,7 +119,7 @@ class TestReferenceField(StoreTest):
         address.street = "My street"
         self.store.add(address)
         self.store.flush()
-        self.assertOp(Address, name='save')
+        self.assertOp(Address, name='insert')
 
         p = Person()
         p.address = address
@@ -118,9 +128,7 @@ class TestReferenceField(StoreTest):
         self.store.add(p)
 
         self.store.flush()
-        self.assertOp(Person, name='save')
-        # FIXME: Use flush_pending to avoid this operation
-        self.assertOp(Address, name='save')
+        self.assertOp(Person, name='insert')
 
         self.store.drop_cache()
 
@@ -128,15 +136,89 @@ class TestReferenceField(StoreTest):
         self.assertOp(Person, name='find_one')
         self.failUnless(p.address_id)
         self.failUnless(p.address)
-        self.assertOp(Address, name='find')
+        self.assertOp(Address, name='find_one')
 
         p.address = None
         self.failIf(p.address_id)
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'address_id': None}}))
+
+    def testPrefetch(self):
+        class Address(object):
+            street = StringField()
+
+        class Person(object):
+            address_id = ObjectIdField()
+            address = ReferenceField(address_id, Address)
+
+        addresses = []
+        for street in ['First street', 'Second street']:
+            address = Address()
+            address.street = street
+            self.store.add(address)
+            addresses.append(address)
+        self.store.flush()
+        self.assertOp(Address, name='insert')
+
+        # The first batch of people refers to both addresses, flush
+        # them first as the order of the objects flushed together is
+        # not defined.
+        for i in range(5):
+            p = Person()
+            p.address = addresses[i % 2]
+            self.store.add(p)
+            if i == 1:
+                self.store.flush()
+                self.assertOp(Person, name='insert')
+        self.store.add(Person())
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        self.store.query_batch_size = 4
+        people = self.store.find(Person, prefetch=['address'])
+        self.assertEquals(
+            sorted(p.address.street for p in people if p.address_id),
+            ['First street', 'First street', 'First street',
+             'Second street', 'Second street'])
+        self.assertOp(Person, name='find')
+        # Only the first batch of people needs to query for addresses,
+        # the second one finds them in the cache.
+        self.assertOp(Address, name='find')
+
+        self.assertRaises(ValueError, list,
+                          self.store.find_by(Person, prefetch=['foo']))
+        self.assertOp(Person, name='find')
 
-        # FIXME: use flush pending to avoid this operation
-        self.assertOp(Address, name='save')
+    def testReferenceUnloaded(self):
+        class Address(object):
+            street = StringField()
+
+        class Person(object):
+            name = StringField()
+            address_id = ObjectIdField()
+            address = ReferenceField(address_id, Address)
+
+        address = Address()
+        address.street = u'My street'
+        self.store.add(address)
+        self.store.flush()
+        self.assertOp(Address, name='insert')
+        p = Person()
+        p.name = u'Ann'
+        p.address = address
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        p = self.store.find_one(Person, fields=['name'])
+        self.assertOp(Person, name='find_one')
+        self.assertEquals(p.address.street, u'My street')
+        self.assertOp(Address, name='find_one')
+        self.assertOp(Person, name='find_one',
+                      kwargs=dict(fields=['address_id']))
 
     def testReferenceWrongType(self):
         class Address(object):
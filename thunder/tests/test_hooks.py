@@ -18,7 +18,7 @@ class TestHooks(StoreTest):
         self.failIf(d.loaded)
         self.store.drop_cache()
         self.failIf(d.loaded)
-        self.assertOp(Document, name='save')
+        self.assertOp(Document, name='insert')
 
         self.failIf(d.loaded)
         d = self.store.find_one(Document)
@@ -40,7 +40,7 @@ class TestHooks(StoreTest):
         self.failIf(d.flushed)
         self.store.flush()
         self.failUnless(d.flushed)
-        self.assertOp(Document, name='save')
+        self.assertOp(Document, name='insert')
 
     def testFlushed(self):
         class Document(object):
@@ -57,4 +57,4 @@ class TestHooks(StoreTest):
         self.failIf(d.flushed)
         self.store.flush()
         self.failUnless(d.flushed)
-        self.assertOp(Document, name='save')
+        self.assertOp(Document, name='insert')
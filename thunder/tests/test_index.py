@@ -0,0 +1,119 @@
+from pymongo import ASCENDING, DESCENDING, GEO2D
+
+from thunder.exceptions import InvalidObject
+from thunder.fields import DateTimeField, GeoPointField, IntField, StringField
+from thunder.index import Index
+from thunder.info import get_cls_info
+from thunder.testutils import StoreTest
+
+
+class Person(object):
+    __thunder_indexes__ = [
+        Index([('last_name', ASCENDING), ('age', DESCENDING)]),
+        'first_name',
+    ]
+    email = StringField(unique=True)
+    nick = StringField(unique=True, sparse=True)
+    first_name = StringField()
+    last_name = StringField()
+    age = IntField(index=DESCENDING)
+    location = GeoPointField()
+    seen = DateTimeField(expire_after=3600)
+
+
+class TestIndex(StoreTest):
+    def testDeclared(self):
+        indexes = dict((index.name, index)
+                       for index in get_cls_info(Person).indexes)
+        self.assertEquals(sorted(indexes), [
+            'age_-1', 'email_1', 'first_name_1', 'last_name_1_age_-1',
+            'location_2d', 'nick_1', 'seen_1'])
+        self.assertEquals(indexes['email_1'].get_options(),
+                          dict(name='email_1', unique=True))
+        self.assertEquals(indexes['nick_1'].get_options(),
+                          dict(name='nick_1', unique=True, sparse=True))
+        self.assertEquals(indexes['seen_1'].get_options(),
+                          dict(name='seen_1', expireAfterSeconds=3600))
+        self.assertEquals(indexes['location_2d'].keys, [('location', GEO2D)])
+
+    def testUnknownField(self):
+        class Document(object):
+            __thunder_indexes__ = ['name']
+            title = StringField()
+        self.assertRaises(InvalidObject, get_cls_info, Document)
+
+    def testEnsureIndexes(self):
+        report = self.store.ensure_indexes(Person)
+        self.assertEquals(report, {'Person': dict(missing=[
+            'age_-1', 'email_1', 'first_name_1', 'last_name_1_age_-1',
+            'location_2d', 'nick_1', 'seen_1'], extra=[])})
+        ops = self.getCollection(Person).ops
+        self.assertEquals([op.name for op in ops],
+                          ['index_information'] + ['create_index'] * 7)
+        self.assertEquals(ops[1].args, ([('age', -1)], ))
+        self.assertEquals(ops[1].kwargs, dict(name='age_-1'))
+        del ops[:]
+
+        # Nothing to do once they are in sync.
+        self.assertEquals(self.store.ensure_indexes(Person),
+                          {'Person': dict(missing=[], extra=[])})
+        self.assertOp(Person, name='index_information')
+
+    def testStartup(self):
+        class Author(object):
+            name = StringField(unique=True)
+
+        class Book(object):
+            title = StringField(index=True)
+
+        report = self.store.ensure_indexes([Author, Book])
+        self.assertEquals(report, {
+            'Author': dict(missing=['name_1'], extra=[]),
+            'Book': dict(missing=['title_1'], extra=[])})
+        self.assertEquals(
+            sorted(self.getCollection(Book).collection.index_information()),
+            ['_id_', 'title_1'])
+        for cls in [Author, Book]:
+            self.assertOp(cls, name='create_index')
+            self.assertOp(cls, name='index_information')
+
+    def testReportAll(self):
+        get_cls_info(Person)
+        report = self.store.get_index_report()
+        self.assertEquals(report['Person'], dict(
+            missing=['age_-1', 'email_1', 'first_name_1',
+                     'last_name_1_age_-1', 'location_2d', 'nick_1',
+                     'seen_1'], extra=[]))
+        # The indexed classes of the other tests are in the report too.
+        for collection in self.store.collections:
+            collection.ops = []
+
+    def testReport(self):
+        class Document(object):
+            name = StringField(unique=True)
+        collection = self.getCollection(Document)
+        collection.collection.create_index('name')
+        collection.collection.create_index('title')
+
+        self.assertEquals(self.store.get_index_report(Document),
+                          {'Document': dict(missing=['name_1'],
+                                            extra=['title_1'])})
+        self.assertOp(Document, name='index_information')
+
+        # The changed index is rebuilt, the extra one is kept.
+        self.store.ensure_indexes(Document)
+        self.assertOp(Document, name='create_index',
+                      args=([('name', 1)], ),
+                      kwargs=dict(name='name_1', unique=True))
+        self.assertOp(Document, name='drop_index', args=('name_1', ))
+        self.assertOp(Document, name='index_information')
+        self.assertEquals(self.store.get_index_report(Document),
+                          {'Document': dict(missing=[], extra=['title_1'])})
+        self.assertOp(Document, name='index_information')
+
+        self.store.ensure_indexes(Document, drop_extra=True)
+        self.assertOp(Document, name='drop_index', args=('title_1', ))
+        self.assertOp(Document, name='index_information')
+        self.assertEquals(self.store.get_index_report(Document),
+                          {'Document': dict(missing=[], extra=[])})
+        self.assertOp(Document, name='index_information')
@@ -0,0 +1,146 @@
+import time
+import unittest
+
+from bson.timestamp import Timestamp
+
+from thunder.fields import StringField
+from thunder.invalidation import OplogInvalidator
+from thunder.store import Store
+from thunder.testutils import TEST_URI
+
+
+class Person(object):
+    name = StringField()
+
+
+class TestOplogInvalidator(unittest.TestCase):
+    def setUp(self):
+        self.store = Store(TEST_URI, 'thunder-test')
+        person = Person()
+        person.name = u'John'
+        self.store.add(person)
+        self.store.flush()
+        self.obj_id = person._id
+
+    def tearDown(self):
+        self.store.drop_collections()
+
+    def entry(self, op, obj_id, ns='thunder-test.Person'):
+        if op == 'u':
+            return dict(op=op, ns=ns, o={'$set': {'name': u'Jack'}},
+                        o2={'_id': obj_id})
+        return dict(op=op, ns=ns, o={'_id': obj_id})
+
+    def testEvict(self):
+        invalidator = OplogInvalidator(self.store)
+        person = self.store.get(Person, self.obj_id)
+        self.assertEquals(invalidator.handle(
+            self.entry('u', self.obj_id, 'other.Person')), 0)
+        self.assertEquals(invalidator.handle(dict(op='n', ns='')), 0)
+        self.failUnless(self.store.get(Person, self.obj_id) is person)
+
+        self.assertEquals(invalidator.handle(self.entry('u', self.obj_id)), 1)
+        self.failIf(self.store.get(Person, self.obj_id) is person)
+        self.assertEquals(invalidator.handle(self.entry('d', 'missing')), 0)
+        self.assertEquals(invalidator.invalidations, 1)
+
+    def testRefresh(self):
+        invalidator = OplogInvalidator(self.store, refresh=True)
+        person = self.store.get(Person, self.obj_id)
+        self.store.database['Person'].update(
+            {'_id': self.obj_id}, {'$set': {'name': u'Jack'}})
+        self.assertEquals(person.name, u'John')
+
+        invalidator.handle(self.entry('u', self.obj_id))
+        self.failUnless(self.store.get(Person, self.obj_id) is person)
+        self.assertEquals(person.name, u'Jack')
+
+    def testPending(self):
+        invalidator = OplogInvalidator(self.store)
+        person = self.store.get(Person, self.obj_id)
+        person.name = u'Jane'
+        self.assertEquals(invalidator.handle(self.entry('u', self.obj_id)), 0)
+        self.failUnless(self.store.get(Person, self.obj_id) is person)
+        self.assertEquals(person.name, u'Jane')
+
+    def testOwnWrites(self):
+        invalidator = OplogInvalidator(self.store)
+        person = self.store.get(Person, self.obj_id)
+        person.name = u'Jane'
+        self.store.flush()
+        self.assertEquals(invalidator.handle(self.entry('u', self.obj_id)), 0)
+        self.failUnless(self.store.get(Person, self.obj_id) is person)
+        self.assertEquals(self.store._written, {})
+
+        # A write from another process.
+        self.assertEquals(invalidator.handle(self.entry('u', self.obj_id)), 1)
+        self.failIf(self.store.get(Person, self.obj_id) is person)
+
+    def testQueued(self):
+        invalidator = OplogInvalidator(self.store)
+        person = self.store.get(Person, self.obj_id)
+        invalidator._queue.append(self.entry('u', self.obj_id))
+        self.assertEquals(invalidator.invalidations, 0)
+        self.failIf(self.store.get(Person, self.obj_id) is person)
+        self.assertEquals(invalidator.invalidations, 1)
+        self.assertEquals(len(invalidator._queue), 0)
+
+    def testForgetWrites(self):
+        invalidator = OplogInvalidator(self.store)
+        self.store.get(Person, self.obj_id).name = u'Jane'
+        self.store.flush()
+        self.assertEquals(len(self.store._written), 1)
+
+        # Entries written long after the write show its entry was
+        # skipped or won't come.
+        self.store._written.values()[0][1] -= invalidator.write_delay + 1
+        entry = self.entry('d', 'other')
+        entry['ts'] = Timestamp(int(time.time()), 1)
+        invalidator._queue.append(entry)
+        invalidator.apply()
+        self.assertEquals(self.store._written, {})
+
+    def testPollError(self):
+        invalidator = OplogInvalidator(self.store, poll_interval=0.01)
+        polled = []
+
+        def poll():
+            polled.append(True)
+            if len(polled) == 1:
+                raise ValueError('broken')
+            invalidator._stopped.set()
+        invalidator.poll = poll
+        invalidator.start()
+        invalidator._thread.join(5)
+        invalidator.stop()
+        self.assertEquals(len(polled), 2)
+
+    def testClose(self):
+        invalidator = OplogInvalidator(self.store)
+        invalidator.close()
+        self.failUnless(self.store._invalidator is None)
+        self.failUnless(self.store._written is None)
+        self.store.get(Person, self.obj_id).name = u'Jane'
+        self.store.flush()
+
+    def testTail(self):
+        local = self.store.connection['local']
+        if 'oplog.rs' not in local.collection_names():
+            raise unittest.SkipTest('needs a replica set, see '
+                                    'THUNDER_TEST_URI')
+        invalidator = OplogInvalidator(self.store, poll_interval=0.1)
+        person = self.store.get(Person, self.obj_id)
+        self.assertEquals(person.name, u'John')
+        invalidator.start()
+        try:
+            other = Store(TEST_URI, 'thunder-test')
+            other.get(Person, self.obj_id).name = u'Jack'
+            other.flush()
+            for i in range(50):
+                if invalidator.apply():
+                    break
+                time.sleep(0.1)
+        finally:
+            invalidator.stop()
+        self.assertEquals(invalidator.invalidations, 1)
+        self.assertEquals(self.store.get(Person, self.obj_id).name, u'Jack')
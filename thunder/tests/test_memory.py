@@ -0,0 +1,118 @@
+import decimal
+import unittest
+
+from bson.errors import InvalidDocument
+from pymongo.errors import DuplicateKeyError
+
+from thunder.memory import MemoryConnection, apply_update, match, project
+from thunder.store import Store
+
+
+class TestMatch(unittest.TestCase):
+    def testOperators(self):
+        doc = {'name': 'John', 'age': 30, 'tags': ['a', 'b'],
+               'address': {'city': 'Paris'}}
+        self.failUnless(match(doc, {'name': 'John'}))
+        self.failUnless(match(doc, {'tags': 'a'}))
+        self.failUnless(match(doc, {'address.city': 'Paris'}))
+        self.failUnless(match(doc, {'age': {'$gt': 20, '$lte': 30}}))
+        self.failIf(match(doc, {'age': {'$lt': 30}}))
+        self.failUnless(match(doc, {'name': {'$in': ['Jack', 'John']}}))
+        self.failUnless(match(doc, {'email': None}))
+        self.failUnless(match(doc, {'email': {'$exists': False}}))
+        self.failUnless(match(doc, {'$or': [{'age': 1}, {'name': 'John'}]}))
+
+    def testUpdate(self):
+        doc = {'_id': 1, 'count': 1, 'tags': ['a']}
+        apply_update(doc, {'$inc': {'count': 2}, '$push': {'tags': 'b'},
+                           '$set': {'a.b': 1}, '$unset': {'missing': 1}})
+        self.assertEquals(doc, {'_id': 1, 'count': 3, 'tags': ['a', 'b'],
+                                'a': {'b': 1}})
+        apply_update(doc, {'name': 'John'})
+        self.assertEquals(doc, {'_id': 1, 'name': 'John'})
+
+    def testProject(self):
+        doc = {'_id': 1, 'name': 'John', 'age': 30}
+        self.assertEquals(project(doc, ['name']), {'_id': 1, 'name': 'John'})
+        self.assertEquals(project(doc, {'age': 0}), {'_id': 1, 'name': 'John'})
+
+
+class TestMemoryCollection(unittest.TestCase):
+    def setUp(self):
+        self.connection = MemoryConnection('memory://test-memory')
+        self.collection = self.connection['db']['people']
+        for i in range(10):
+            self.collection.insert({'name': 'Person %d' % (i, ), 'age': i})
+
+    def tearDown(self):
+        self.connection.drop_database('db')
+
+    def testCursor(self):
+        cursor = self.collection.find({'age': {'$gte': 2}},
+                                      fields=['age'])
+        docs = list(cursor.sort('age', -1).skip(1).limit(3))
+        self.assertEquals([doc['age'] for doc in docs], [8, 7, 6])
+        self.assertEquals(sorted(docs[0]), ['_id', 'age'])
+        self.assertEquals(self.collection.find().count(), 10)
+        self.assertEquals(
+            self.collection.find().limit(4).count(with_limit_and_skip=True),
+            4)
+
+    def testSharedData(self):
+        other = MemoryConnection('memory://test-memory')['db']['people']
+        self.assertEquals(other.count(), 10)
+        self.assertEquals(MemoryConnection()['db']['people'].count(), 0)
+
+    def testIndex(self):
+        spec = {'name': 'Person 3'}
+        self.assertEquals(
+            self.collection.find(spec).explain()['cursor'], 'BasicCursor')
+        self.collection.create_index('name', unique=True)
+        plan = self.collection.find(spec).explain()
+        self.assertEquals(plan['cursor'], 'BtreeCursor name_1')
+        self.assertEquals(plan['nscanned'], 1)
+        self.assertRaises(DuplicateKeyError, self.collection.insert,
+                          {'name': 'Person 3'})
+
+        self.collection.update(spec, {'$set': {'name': 'Changed'}})
+        self.assertEquals(self.collection.find_one(spec), None)
+        self.assertEquals(self.collection.find_one({'name': 'Changed'})['age'],
+                          3)
+
+    def testEncoded(self):
+        price = decimal.Decimal('1.5')
+        self.assertRaises(InvalidDocument, self.collection.insert,
+                          {'name': 'Person 10', 'price': price})
+        self.assertEquals(self.collection.count(), 10)
+        spec = {'name': 'Person 3'}
+        self.assertRaises(InvalidDocument, self.collection.update, spec,
+                          {'$set': {'price': price}})
+        self.assertRaises(InvalidDocument, self.collection.find_and_modify,
+                          spec, {'$set': {'price': price}})
+        self.assertRaises(InvalidDocument, self.collection.save,
+                          {'name': 'Person 10', 'price': price})
+        self.assertEquals(self.collection.find_one(spec, fields=['price']),
+                          {'_id': self.collection.find_one(spec)['_id']})
+
+        doc = self.collection.find_and_modify(
+            spec, {'$set': {'tags': ('a', 'b')}}, new=True)
+        self.assertEquals(doc['tags'], ['a', 'b'])
+        self.assertEquals(self.collection.find_one(spec)['tags'], ['a', 'b'])
+
+    def testUpdateRemove(self):
+        self.collection.update({'age': {'$lt': 5}}, {'$inc': {'age': 10}},
+                               multi=True)
+        self.assertEquals(self.collection.find({'age': {'$gte': 10}}).count(),
+                          5)
+        self.collection.update({'name': 'New'}, {'$set': {'age': 1}},
+                               upsert=True)
+        self.assertEquals(self.collection.find_one({'name': 'New'})['age'], 1)
+        self.collection.remove({'age': {'$gte': 10}})
+        self.assertEquals(self.collection.count(), 6)
+
+
+class TestBackend(unittest.TestCase):
+    def testBackends(self):
+        store = Store('memory://', 'thunder-test')
+        self.failUnless(isinstance(store.connection, MemoryConnection))
+        self.assertRaises(ValueError, Store, 'unknown://', 'thunder-test')
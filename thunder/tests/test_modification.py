@@ -0,0 +1,98 @@
+import decimal
+
+from thunder.cache import LRUCache
+from thunder.fields import DecimalField, IntField, ListField, StringField
+from thunder.store import Store
+from thunder.testutils import TEST_URI, StoreTest
+
+
+class Post(object):
+    title = StringField()
+    views = IntField()
+    tags = ListField()
+    balance = DecimalField()
+
+
+class TestModification(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.post = Post()
+        self.post.title = u'Hello'
+        self.post.views = 0
+        self.post.tags = [u'a']
+        self.store.add(self.post)
+        self.store.flush()
+        self.assertOp(Post, name='insert')
+
+    def getDocument(self):
+        return self.store.database['Post'].find_one(self.post._id)
+
+    def testModify(self):
+        self.store.modify(self.post).inc(views=2).push(tags=u'b').execute()
+        self.assertOp(Post, name='update',
+                      args=({'_id': self.post._id},
+                            {'$inc': {'views': 2}, '$push': {'tags': u'b'}}))
+        self.assertEquals(self.post.views, 2)
+        self.assertEquals(self.post.tags, [u'a', u'b'])
+        self.store.flush()
+        self.failIf(self.getCollection(Post).ops)
+
+        doc = self.getDocument()
+        self.assertEquals((doc['views'], doc['tags']), (2, [u'a', u'b']))
+
+        self.store.modify(self.post).set(title=u'Bye').unset('tags').execute()
+        self.assertOp(Post, name='update')
+        self.assertEquals(self.post.title, u'Bye')
+        self.assertEquals(self.post.tags, None)
+
+    def testIncConverted(self):
+        self.store.modify(self.post).inc(
+            balance=decimal.Decimal('0.25')).execute()
+        self.assertOp(Post, name='update')
+        self.assertEquals(self.post.balance, decimal.Decimal('0.25'))
+        self.assertEquals(self.getDocument()['balance'], 25)
+        self.assertRaises(TypeError, self.store.modify(self.post).inc,
+                          title=u'x')
+
+    def testNew(self):
+        other = Store(TEST_URI, 'thunder-test')
+        other.modify(other.get(Post, self.post._id)).inc(views=5).execute()
+
+        post = self.store.modify(self.post).inc(views=1).execute(new=True)
+        self.assertOp(Post, name='find_and_modify')
+        self.failUnless(post is self.post)
+        self.assertEquals(post.views, 6)
+        self.assertEquals(post.tags, [u'a'])
+
+    def testNewEvicted(self):
+        store = Store(TEST_URI, 'thunder-test', cache=LRUCache(1))
+        post = store.get(Post, self.post._id)
+        store.add(Post())
+        store.flush()
+        self.assertEquals(store.get_cache_stats()['evictions'], 1)
+        self.failUnless(store.modify(post).inc(views=1).execute(new=True)
+                        is post)
+        self.assertEquals(post.views, 1)
+
+    def testUnflushed(self):
+        self.post.views = 10
+        modification = self.store.modify(self.post).inc(views=1)
+        self.assertRaises(ValueError, modification.execute)
+        self.assertRaises(ValueError, self.store.modify(self.post).inc,
+                          unknown=1)
+        self.assertRaises(ValueError, self.store.modify, Post())
+
+    def testUpdate(self):
+        post = self.store.update(Post).inc(views=1).execute(new=True)
+        self.assertOp(Post, name='find_and_modify')
+        self.failUnless(post is self.post)
+        self.assertEquals(post.views, 1)
+        self.assertEquals(
+            self.store.update(Post, {'title': u'Bye'}).inc(views=1).execute(
+                new=True), None)
+        self.assertOp(Post, name='find_and_modify')
+
+        self.store.update(Post, {'title': u'Hello'}).inc(views=3).execute()
+        self.assertOp(Post, name='update', kwargs={'multi': True})
+        self.assertEquals(self.post.views, 4)
+        self.assertOp(Post, name='find_one')
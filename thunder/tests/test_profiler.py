@@ -0,0 +1,80 @@
+import unittest
+
+from thunder.fields import IntField, StringField
+from thunder.profiler import Profiler, get_shape, is_collection_scan
+from thunder.store import Store
+from thunder.testutils import TEST_URI
+
+
+class TestShape(unittest.TestCase):
+    def testShape(self):
+        self.assertEquals(get_shape(None), '{}')
+        self.assertEquals(get_shape('4f0c'), '{_id: ?}')
+        self.assertEquals(get_shape({'name': 'John', 'age': {'$gt': 3}}),
+                          '{age: {$gt: ?}, name: ?}')
+        self.assertEquals(get_shape({'_id': {'$in': [1, 2, 3]}}),
+                          '{_id: {$in: ?}}')
+        self.assertEquals(get_shape({'$or': [{'a': 1}, {'b': [2]}]}),
+                          '{$or: [{a: ?}, {b: ?}]}')
+
+    def testCollectionScan(self):
+        self.failUnless(is_collection_scan({'cursor': 'BasicCursor'}))
+        self.failIf(is_collection_scan({'cursor': 'BtreeCursor name_1'}))
+        self.failUnless(is_collection_scan({'queryPlanner': {
+            'winningPlan': {'stage': 'LIMIT',
+                            'inputStage': {'stage': 'COLLSCAN'}}}}))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler(size=50)
+        self.store = Store(TEST_URI, 'thunder-test',
+                           profiler=self.profiler)
+
+        class Person(object):
+            name = StringField(unique=True)
+            age = IntField()
+        self.Person = Person
+        self.store.ensure_indexes(Person)
+
+    def tearDown(self):
+        self.store.drop_collections()
+
+    def testReport(self):
+        for i in range(10):
+            p = self.Person()
+            p.name = u'Person %d' % (i, )
+            p.age = i
+            self.store.add(p)
+        self.store.flush()
+
+        for i in range(10):
+            list(self.store.find(self.Person, {'age': {'$gte': i}}))
+            self.store.find_one(self.Person, {'name': u'Person %d' % (i, )})
+        self.store.find(self.Person).count()
+
+        report = self.store.profile_report()
+        self.assertEquals(
+            [(stat['op'], stat['shape'], stat['collection_scan'])
+             for stat in report[:1]],
+            [('find', '{age: {$gte: ?}}', True)])
+        stats = dict((stat['shape'], stat) for stat in report)
+        self.assertEquals(stats['{age: {$gte: ?}}']['count'], 10)
+        self.assertEquals(stats['{age: {$gte: ?}}']['returned'], 55)
+        self.assertEquals(stats['{name: ?}']['collection_scan'], False)
+        self.assertEquals(stats['{name: ?}']['returned'], 10)
+        self.assertEquals(stats['{}']['op'], 'count')
+        self.assertEquals(stats['{}']['collection_scan'], None)
+        for stat in report:
+            self.failUnless(stat['p50'] <= stat['p99'] <= stat['total'])
+
+    def testRingBuffer(self):
+        for i in range(100):
+            self.store.find_one(self.Person, {'age': i})
+        stats = self.profiler.get_stats()
+        self.assertEquals(len(stats), 1)
+        self.assertEquals(stats[0]['count'], 50)
+
+    def testNoProfiler(self):
+        store = Store(TEST_URI, 'thunder-test')
+        self.assertRaises(TypeError, store.profile_report)
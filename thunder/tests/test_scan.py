@@ -0,0 +1,108 @@
+import operator
+import time
+import unittest
+
+from bson.objectid import ObjectId
+
+from thunder.exceptions import ScanError
+from thunder.fields import IntField
+from thunder.scan import range_spec, split_ranges
+from thunder.store import Store
+from thunder.testutils import TEST_URI
+
+
+class Item(object):
+    __thunder_doc__ = 'scan_item'
+    value = IntField()
+
+
+def get_value(item):
+    return item.value
+
+
+def get_row_value(row):
+    return row[0]
+
+
+def fail_on_seven(item):
+    if item.value == 7:
+        raise ValueError(item.value)
+    return item.value
+
+
+class TestParallelScan(unittest.TestCase):
+    def setUp(self):
+        self.store = Store(TEST_URI, 'thunder-test')
+        # Items inserted every second, as by a steady writer.
+        collection = self.store.database['scan_item']
+        start = int(time.time()) - 50
+        for i in range(50):
+            obj_id = ObjectId('%08x%016x' % (start + i, i))
+            collection.insert({'_id': obj_id, 'value': i})
+
+    def tearDown(self):
+        self.store.drop_collections()
+
+    def testSplitRanges(self):
+        collection = self.store.database['scan_item']
+        ranges = split_ranges(collection, 5)
+        self.assertEquals(len(ranges), 5)
+        self.assertEquals(ranges[0][0], None)
+        self.assertEquals(ranges[-1][1], None)
+        counts = [collection.find(range_spec(None, *id_range)).count()
+                  for id_range in ranges]
+        self.assertEquals(counts, [10] * 5)
+
+        spec = range_spec({'value': {'$lt': 10}}, *ranges[1])
+        self.assertEquals(sorted(spec), ['_id', 'value'])
+        docs = collection.find(range_spec(None, *ranges[1]))
+        self.assertEquals(collection.find(spec).count(),
+                          len([doc for doc in docs if doc['value'] < 10]))
+
+    def testSplitRangesOther(self):
+        collection = self.store.database['scan_other']
+        for i in range(50):
+            collection.insert({'_id': 'item-%02d' % i})
+        ranges = split_ranges(collection, 5)
+        self.assertEquals(ranges, [(None, 'item-10'),
+                                   ('item-10', 'item-20'),
+                                   ('item-20', 'item-30'),
+                                   ('item-30', 'item-40'),
+                                   ('item-40', None)])
+        collection.drop()
+
+        collection.insert({'_id': 3})
+        collection.insert({'_id': 5})
+        self.assertEquals(split_ranges(collection, 4),
+                          [(None, 4), (4, None)])
+        collection.drop()
+        self.assertEquals(split_ranges(collection, 4), [(None, None)])
+
+    def testScan(self):
+        values = self.store.parallel_scan(Item, None, get_value, workers=2)
+        self.assertEquals(sorted(values), range(50))
+
+        values = self.store.parallel_scan(Item, {'value': {'$gte': 40}},
+                                          get_row_value, workers=2,
+                                          names=['value'])
+        self.assertEquals(sorted(values), range(40, 50))
+
+        total = self.store.parallel_scan(Item, None, get_value, workers=2,
+                                         reduce_func=operator.add)
+        self.assertEquals(total, sum(range(50)))
+
+    def testResume(self):
+        try:
+            self.store.parallel_scan(Item, None, fail_on_seven, workers=2)
+        except ScanError, e:
+            pass
+        else:
+            self.fail('ScanError not raised')
+        self.assertEquals(len(e.failed), 1)
+        self.failUnless('ValueError: 7' in str(e))
+        scanned = sum(map(len, e.results.values()))
+
+        values = self.store.parallel_scan(Item, None, get_value, workers=2,
+                                          ranges=e.failed)
+        self.failUnless(7 in values)
+        self.assertEquals(scanned + len(values), 50)
@@ -0,0 +1,184 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from thunder.fields import StringField
+from thunder.info import get_cls_info
+from thunder.sharedcache import HEADER_SIZE, SharedCache, _slot
+from thunder.store import Store
+from thunder.testutils import TEST_URI, StoreTest
+
+
+class Person(object):
+    name = StringField()
+
+
+def _read_name(path, obj_id, queue):
+    queue.put(SharedCache(path, size=HEADER_SIZE + 4 * 512,
+                          slot_size=512).get('people', obj_id)['name'])
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache')
+        self.cache = self.open()
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def open(self, **kwargs):
+        return SharedCache(self.path, size=HEADER_SIZE + 4 * 512,
+                           slot_size=512, **kwargs)
+
+    def testPutGet(self):
+        self.assertEquals(self.cache.get('people', 1), None)
+        self.failUnless(self.cache.put('people', {'_id': 1, 'name': u'Ann'}))
+        self.assertEquals(self.cache.get('people', 1),
+                          {'_id': 1, 'name': u'Ann'})
+        self.assertEquals(self.cache.get('other', 1), None)
+
+        self.cache.remove('people', 1)
+        self.assertEquals(self.cache.get('people', 1), None)
+        self.failIf(self.cache.put('people', {'_id': 1, 'name': 'x' * 512}))
+        self.assertEquals(self.cache.get_stats(),
+                          dict(slots=4, hits=1, misses=3, writes=1))
+
+    def testBounded(self):
+        for i in range(20):
+            self.cache.put('people', {'_id': i})
+        found = [i for i in range(20) if self.cache.get('people', i)]
+        self.failUnless(0 < len(found) <= 4)
+        self.assertEquals(os.path.getsize(self.path), HEADER_SIZE + 4 * 512)
+
+    def testInvalidate(self):
+        self.cache.put('people', {'_id': 1})
+        self.cache.invalidate('people')
+        self.assertEquals(self.cache.get('people', 1), None)
+        self.cache.put('people', {'_id': 1})
+        self.cache.clear()
+        self.assertEquals(self.cache.get('people', 1), None)
+
+    def testVersion(self):
+        version = self.cache.get_version('people', 1)
+        self.cache.put('people', {'_id': 1, 'name': u'Anne'})
+        self.failIf(self.cache.put('people', {'_id': 1, 'name': u'Ann'},
+                                   version))
+        self.assertEquals(self.cache.get('people', 1)['name'], u'Anne')
+
+        version = self.cache.get_version('people', 1)
+        self.cache.remove('people', 1)
+        self.failIf(self.cache.put('people', {'_id': 1}, version))
+        version = self.cache.get_version('people', 2)
+        self.cache.remove('people', 2)
+        self.failIf(self.cache.put('people', {'_id': 2}, version))
+        version = self.cache.get_version('people', 1)
+        self.cache.invalidate('people')
+        self.failIf(self.cache.put('people', {'_id': 1}, version))
+        self.assertEquals(self.cache.get('people', 1), None)
+
+        version = self.cache.get_version('people', 1)
+        self.failUnless(self.cache.put('people', {'_id': 1}, version))
+        self.assertEquals(self.cache.get('people', 1), {'_id': 1})
+
+    def testExpire(self):
+        cache = self.open(ttl=-1)
+        cache.put('people', {'_id': 1})
+        self.assertEquals(cache.get('people', 1), None)
+        cache.close()
+
+    def testCorrupted(self):
+        self.cache.put('people', {'_id': 1, 'name': u'Ann'})
+        digest, offset = self.cache._locate('people', 1)
+        self.assertEquals(_slot.unpack_from(self.cache._map, offset)[0], 2)
+        start = offset + _slot.size
+        self.cache._map[start:start + 4] = '\xff' * 4
+        self.assertEquals(self.cache.get('people', 1), None)
+        self.assertEquals(self.cache.misses, 1)
+
+    def testProcesses(self):
+        self.cache.put('people', {'_id': 1, 'name': u'Ann'})
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_read_name, args=(self.path, 1, queue))
+        process.start()
+        process.join()
+        self.assertEquals(queue.get(), u'Ann')
+
+
+class TestStoreSharedCache(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.shared_cache = SharedCache(os.path.join(self.dir, 'cache'),
+                                        size=1024 * 1024)
+        self.store.shared_cache = self.shared_cache
+
+    def tearDown(self):
+        StoreTest.tearDown(self)
+        self.shared_cache.close()
+        shutil.rmtree(self.dir)
+
+    def testGet(self):
+        ann = Person()
+        ann.name = u'Ann'
+        self.store.add(ann)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        other = Store(TEST_URI, 'thunder-test',
+                      shared_cache=self.shared_cache)
+        self.assertEquals(other.get(Person, ann._id).name, u'Ann')
+
+        ann.name = u'Anne'
+        self.store.flush()
+        self.assertOp(Person, name='update')
+        other.drop_cache()
+        self.assertEquals(other.get_many(Person, [ann._id])[0].name,
+                          u'Anne')
+        self.assertEquals(self.shared_cache.writes, 2)
+        self.assertEquals(self.shared_cache.hits, 2)
+
+        self.store.remove(ann)
+        self.store.flush()
+        self.assertOp(Person, name='remove')
+        other.drop_cache()
+        self.assertEquals(other.get(Person, ann._id), None)
+
+        bob = Person()
+        bob.name = u'Bob'
+        other.add(bob)
+        other.flush()
+        self.store.shared_cache.remove('Person', bob._id)
+        self.assertEquals(self.store.get(Person, bob._id).name, u'Bob')
+        self.assertOp(Person, name='find_one')
+        self.store.drop_cache()
+        self.assertEquals(self.store.get(Person, bob._id).name, u'Bob')
+
+    def testGetStale(self):
+        ann = Person()
+        ann.name = u'Ann'
+        self.store.add(ann)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.shared_cache.remove('Person', ann._id)
+
+        # Another process updates the document while it's fetched.
+        other = Store(TEST_URI, 'thunder-test',
+                      shared_cache=self.shared_cache)
+        collection = get_cls_info(Person).get_collection(other)
+        find_one = collection.find_one
+
+        def stale_find_one(*args, **kwargs):
+            doc = find_one(*args, **kwargs)
+            ann.name = u'Anne'
+            self.store.flush()
+            return doc
+        collection.find_one = stale_find_one
+        self.assertEquals(other.get(Person, ann._id).name, u'Ann')
+        self.assertOp(Person, name='update')
+        self.assertEquals(self.shared_cache.get('Person', ann._id)['name'],
+                          u'Anne')
@@ -1,6 +1,15 @@
-from thunder.fields import StringField
+import decimal
+import threading
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from thunder.exceptions import NotOneError
+from thunder.fields import (DecimalField, DictField, IntField, ListField,
+                            StringField)
+from thunder.info import Undef, get_obj_info
 from thunder.store import Store
-from thunder.testutils import StoreTest
+from thunder.testutils import TEST_URI, StoreTest
 
 
 class TestStore(StoreTest):
@@ -25,7 +34,7 @@ class TestStore(StoreTest):
         self.failUnless(hasattr(p, '_id'))
 
         op = collection.ops.pop()
-        self.assertEquals(op.name, 'save')
+        self.assertEquals(op.name, 'insert')
         self.failUnless(op.args)
         self.assertEquals(op.kwargs, {})
 
@@ -36,9 +45,8 @@ class TestStore(StoreTest):
         self.assertEquals(np.full_name, "Jonathan Doe")
 
         op = collection.ops.pop()
-        self.assertEquals(op.name, 'find')
-        self.assertEquals(op.kwargs, dict(fields=['name', 'full_name'],
-                                          limit=2))
+        self.assertEquals(op.name, 'find_one')
+        self.assertEquals(op.kwargs, dict(fields=['full_name', 'name']))
         self.assertEquals(op.args, ({'_id': np._id},))
 
         self.store.drop_cache()
@@ -49,9 +57,8 @@ class TestStore(StoreTest):
 
         collection = self.getCollection(SPPerson)
         op = collection.ops.pop()
-        self.assertEquals(op.name, 'find')
-        self.assertEquals(op.kwargs, dict(fields=['name'],
-                                          limit=2))
+        self.assertEquals(op.name, 'find_one')
+        self.assertEquals(op.kwargs, dict(fields=['name']))
         self.failUnless(op.args)
 
     def testUpdate(self):
@@ -64,7 +71,7 @@ class TestStore(StoreTest):
         p.full_name = "Jonathan Doe"
         self.store.add(p)
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
 
         p = self.store.get(Person, p._id)
         self.failUnless(p)
@@ -72,8 +79,215 @@ class TestStore(StoreTest):
         old_id = p._id
 
         self.store.flush()
-        self.assertNotEquals(p._id, old_id)
-        self.assertOp(Person, name='save')
+        self.assertEquals(p._id, old_id)
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'name': 'Foo'}}))
+
+        self.store.flush()
+
+        del p.full_name
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$unset': {'full_name': 1}}))
+
+        self.store.drop_cache()
+        p = self.store.get(Person, old_id)
+        self.assertOp(Person, name='find_one')
+        self.assertEquals(p.name, 'Foo')
+        self.assertEquals(p.full_name, None)
+
+    def testUpdateUnchanged(self):
+        class Person(object):
+            name = StringField()
+            tags = ListField()
+
+        p = Person()
+        p.name = "John"
+        p.tags = ['a']
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        p.name = "John"
+        self.store.flush()
+
+        p.tags.append('b')
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'tags': ['a', 'b']}}))
+
+    def testReadMutable(self):
+        class Person(object):
+            tags = ListField()
+
+        for i in range(10):
+            p = Person()
+            p.tags = ['a']
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        people = list(self.store.find(Person))
+        self.assertOp(Person, name='find')
+        for p in people:
+            self.assertEquals(p.tags, ['a'])
+        self.assertEquals(len(self.store.obj_infos), 0)
+        self.store.flush()
+
+        p = people[0]
+        p.tags.append('b')
+        self.assertEquals(len(self.store.obj_infos), 0)
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'tags': ['a', 'b']}}))
+
+    def testReadMutableUnchanged(self):
+        class Person(object):
+            name = StringField()
+            tags = ListField()
+
+        p = Person()
+        p.name = u'Ann'
+        p.tags = ['x']
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        p.name = u'Ann'
+        self.assertEquals(p.tags, ['x'])
+        self.store.flush()
+        p.tags.append('y')
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'tags': ['x', 'y']}}))
+
+    def testInvalidateMutable(self):
+        class Person(object):
+            tags = ListField()
+            flag = StringField()
+
+        p = Person()
+        p.tags = [u'x']
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        p.tags.append(u'y')
+        self.store.find(Person, {'_id': p._id}).set(flag=u'f')
+        self.assertOp(Person, name='update')
+        self.assertEquals(p.tags, [u'x', u'y'])
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$set': {'tags': [u'x', u'y']}}))
+        doc = self.getCollection(Person).collection.find_one()
+        self.assertEquals((doc['tags'], doc['flag']), ([u'x', u'y'], u'f'))
+
+    def testFlushError(self):
+        class Person(object):
+            name = StringField(unique=True)
+
+        self.store.ensure_indexes(Person)
+        self.assertOp(Person, name='create_index')
+        self.assertOp(Person, name='index_information')
+        people = []
+        for name in [u'a', u'b', u'c']:
+            p = Person()
+            p.name = name
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        a, b, c = people
+        a.name = u'A'
+        self.store.remove(c)
+        d = Person()
+        d.name = u'b'
+        self.store.add(d)
+        self.assertRaises(DuplicateKeyError, self.store.flush)
+        self.assertOp(Person, name='update')
+
+        d.name = u'd'
+        self.store.flush()
+        self.assertOp(Person, name='remove')
+        self.assertOp(Person, name='insert')
+        self.assertEquals(
+            sorted(doc['name'] for doc in
+                   self.getCollection(Person).collection.find()),
+            [u'A', u'b', u'd'])
+
+    def testFlushBatches(self):
+        class Person(object):
+            name = StringField()
+
+            def __thunder_flushed__(self):
+                self.flushed = getattr(self, 'flushed', 0) + 1
+
+        self.store.flush_batch_size = 2
+        people = []
+        for i in range(5):
+            p = Person()
+            p.name = 'Person %d' % (i, )
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        for size in [1, 2, 2]:
+            op = self.getCollection(Person).ops.pop()
+            self.assertEquals(op.name, 'insert')
+            self.assertEquals(len(op.args[0]), size)
+
+        for p in people:
+            self.assertEquals(p.flushed, 1)
+            self.failUnless(self.store.get(Person, p._id) is p)
+
+        self.store.flush_batch_size = 10
+        for p in people[:3]:
+            self.store.remove(p)
+        self.store.flush()
+        op = self.getCollection(Person).ops.pop()
+        self.assertEquals(op.name, 'remove')
+        self.assertEquals(sorted(op.args[0]['_id']['$in']),
+                          sorted(p._id for p in people[:3]))
+        self.assertEquals(self.store.count(Person), 2)
+        self.assertOp(Person, name='find')
+
+    def testFlushPending(self):
+        class Person(object):
+            name = StringField()
+
+        collection = self.getCollection(Person)
+        people = []
+        for i in range(100):
+            p = Person()
+            p.name = 'Person %d' % (i, )
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.failIf(self.store.obj_infos)
+
+        self.store.flush()
+        self.failIf(collection.ops)
+
+        # Each flush only costs as much as the objects changed since
+        # the previous one, no matter how many objects the store owns.
+        for i, p in enumerate(people[:10]):
+            p.name = 'Changed %d' % (i, )
+            self.assertEquals(len(self.store.obj_infos), 1)
+            self.store.flush()
+            self.assertOp(Person, name='update',
+                          args=({'_id': p._id},
+                                {'$set': {'name': 'Changed %d' % (i, )}}))
+            self.failIf(collection.ops)
+            self.failIf(self.store.obj_infos)
+            self.failIf(get_obj_info(p).flush_pending)
+
+        p = Person()
+        self.store.add(p)
+        self.store.remove(p)
+        self.failIf(self.store.obj_infos)
+        self.store.flush()
 
     def testRemove(self):
         class Person(object):
@@ -91,7 +305,7 @@ class TestStore(StoreTest):
         self.store.flush()
         self.assertEquals(collection.count(), 1)
         self.assertOp(Person, name='count')
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
 
         p = self.store.get(Person, p._id)
         obj_id = p._id
@@ -106,10 +320,107 @@ class TestStore(StoreTest):
 
         self.assertRaises(Exception, self.store.remove, p)
         self.failIf(self.store.get(Person, obj_id))
-        self.assertOp(Person, name='find')
+        self.assertOp(Person, name='find_one')
         self.assertEquals(p._id, obj_id)
         self.assertEquals(p.name, "John")
 
+    def testGetMany(self):
+        class Person(object):
+            name = StringField()
+
+        people = []
+        for i in range(5):
+            p = Person()
+            p.name = 'Person %d' % (i, )
+            self.store.add(p)
+            people.append(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        self.store.drop_cache()
+        cached = self.store.get(Person, people[1]._id)
+        self.assertOp(Person, name='find_one')
+
+        self.store.query_batch_size = 2
+        obj_ids = [person._id for person in reversed(people)]
+        obj_ids.insert(2, people[0]._id)
+        obj_ids.append(ObjectId())
+        results = self.store.get_many(Person, obj_ids)
+        self.assertEquals([person and person.name for person in results],
+                          ['Person 4', 'Person 3', 'Person 0', 'Person 2',
+                           'Person 1', 'Person 0', None])
+        self.failUnless(results[4] is cached)
+        self.failUnless(results[2] is results[5])
+
+        # 5 ids were not cached, fetched 2 at a time
+        for size in [1, 2, 2]:
+            op = self.getCollection(Person).ops.pop()
+            self.assertEquals(op.name, 'find')
+            self.assertEquals(len(op.args[0]['_id']['$in']), size)
+
+        self.assertEquals(self.store.get_many(Person, obj_ids[:2]),
+                          results[:2])
+
+    def testDeferred(self):
+        class Person(object):
+            __thunder_deferred__ = True
+            name = StringField()
+            tags = ListField()
+            extra = DictField()
+
+        collection = self.getCollection(Person)
+        p = Person()
+        p.name = 'John'
+        p.tags = ['a', 'b']
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        p = self.store.get(Person, p._id)
+        self.assertOp(Person, name='find_one', kwargs=dict(fields=['name']))
+        self.assertEquals(p.name, 'John')
+        self.failIf(collection.ops)
+
+        p.extra = {'a': 1}
+        self.assertEquals(p.tags, ['a', 'b'])
+        self.assertOp(Person, name='find_one', args=({'_id': p._id}, ),
+                      kwargs=dict(fields=['tags']))
+        self.assertEquals(p.tags, ['a', 'b'])
+        self.assertEquals(p.extra, {'a': 1})
+        self.failIf(collection.ops)
+
+        p.tags.append('c')
+        self.store.flush()
+        op = collection.ops.pop()
+        self.assertEquals(op.name, 'update')
+        self.assertEquals(op.args[1], {'$set': {'tags': ['a', 'b', 'c'],
+                                                'extra': {'a': 1}}})
+
+    def testPartialLoad(self):
+        class Person(object):
+            name = StringField()
+            full_name = StringField()
+
+        p = Person()
+        p.name = 'John'
+        p.full_name = 'John Doe'
+        self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+
+        p = self.store.find_one(Person, {}, fields=['name'])
+        self.assertOp(Person, name='find_one')
+        del p.name
+        self.assertEquals(p.full_name, 'John Doe')
+        self.assertOp(Person, name='find_one',
+                      kwargs=dict(fields=['full_name']))
+
+        self.store.flush()
+        self.assertOp(Person, name='update',
+                      args=({'_id': p._id}, {'$unset': {'name': 1}}))
+
     def testFind(self):
         class Person(object):
             name = StringField()
@@ -130,8 +441,7 @@ class TestStore(StoreTest):
         self.assertEquals(collection.count(), 0)
         self.assertOp(Person, name='count')
         self.store.flush()
-        self.assertOp(Person, name='save')
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
         self.assertEquals(collection.count(), 2)
         self.assertOp(Person, name='count')
 
@@ -161,8 +471,7 @@ class TestStore(StoreTest):
         self.assertEquals(collection.count(), 0)
         self.assertOp(Person, name='count')
         self.store.flush()
-        self.assertOp(Person, name='save')
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
         self.assertEquals(collection.count(), 2)
         self.assertOp(Person, name='count')
 
@@ -185,7 +494,7 @@ class TestStore(StoreTest):
         self.assertOp(Person, name='find')
         self.assertEquals(len(results), 0)
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
         results = list(self.store.find(Person, {'name': 'John'}))
         self.assertOp(Person, name='find')
         self.assertEquals(len(results), 1)
@@ -211,7 +520,7 @@ class TestStore(StoreTest):
         self.assertOp(Person, name='find_one')
 
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
 
         p1 = self.store.find_one(Person, {'name': 'John'})
         self.failUnless(p1)
@@ -239,7 +548,7 @@ class TestStore(StoreTest):
         self.assertOp(Person, name='find_one')
 
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
 
         p1 = self.store.find_one_by(Person, name='John')
         self.failUnless(p1)
@@ -265,7 +574,7 @@ class TestStore(StoreTest):
         self.assertEquals(self.store.count(Person), 0)
         self.assertOp(Person, name='find')
         self.store.flush()
-        self.assertOp(Person, name='save')
+        self.assertOp(Person, name='insert')
 
         self.assertEquals(self.store.count(Person), 1)
         self.assertOp(Person, name='find')
@@ -281,7 +590,251 @@ class TestStore(StoreTest):
     def testDropCollection(self):
         class Document(object):
             pass
-        s = Store('localhost', 'hurricane-test-2')
+        s = Store(TEST_URI, 'hurricane-test-2')
         d = Document()
         s.add(d)
         s.drop_collection(Document)
+
+    def testObjectInfo(self):
+        class Person(object):
+            name = StringField()
+            title = StringField(default=u'')
+
+        person = Person()
+        person.name = u'Ann'
+        obj_info = get_obj_info(person)
+        self.assertFalse(hasattr(obj_info, '__dict__'))
+        self.assertEquals(obj_info.changes, 1 << obj_info.cls_info.index[
+            obj_info.cls_info.attributes['name']])
+        self.assertEquals(obj_info.cls_info.encode(obj_info.variables),
+                          {'name': u'Ann', 'title': u''})
+        self.assertEquals(obj_info.cls_info.decode({'name': u'Ann'}),
+                          [u'Ann', Undef])
+
+    def testPaginate(self):
+        class Person(object):
+            name = StringField()
+            age = IntField()
+
+        for i in range(7):
+            p = Person()
+            p.name = u'Person %d' % (i, )
+            p.age = i // 2
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        pages = []
+        token = None
+        while True:
+            page, token = self.store.paginate(Person, {}, 'age', 3,
+                                              after=token)
+            self.assertOp(Person, name='find')
+            pages.append([person.age for person in page])
+            if token is None:
+                break
+        self.assertEquals(pages, [[0, 0, 1], [1, 2, 2], [3]])
+
+        page, token = self.store.paginate(Person, {'age': {'$lt': 3}},
+                                          'age', 4, direction=-1)
+        self.assertEquals([person.age for person in page], [2, 2, 1, 1])
+        page, token = self.store.paginate(Person, {'age': {'$lt': 3}},
+                                          'age', 4, after=token,
+                                          direction=-1)
+        self.assertEquals([person.age for person in page], [0, 0])
+        self.assertEquals(token, None)
+        self.assertOp(Person, name='find')
+        self.assertOp(Person, name='find')
+
+        self.assertRaises(ValueError, self.store.paginate, Person, {},
+                          'age', 3, after='invalid')
+        self.assertRaises(ValueError, self.store.paginate, Person, {},
+                          'unknown', 3)
+
+    def testPaginateUnloaded(self):
+        class Person(object):
+            name = StringField()
+            age = IntField()
+
+        for i in range(4):
+            p = Person()
+            p.name = u'Person %d' % (i, )
+            p.age = i
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+        self.store.drop_cache()
+        list(self.store.find(Person, {}, fields=['name']))
+        self.assertOp(Person, name='find')
+
+        page, token = self.store.paginate(Person, {}, 'age', 2)
+        self.assertOp(Person, name='find_one',
+                      args=({'_id': page[-1]._id}, ),
+                      kwargs=dict(fields=['age']))
+        self.assertOp(Person, name='find')
+        page, token = self.store.paginate(Person, {}, 'age', 2, after=token)
+        self.assertOp(Person, name='find')
+        self.assertEquals([person.name for person in page],
+                          [u'Person 2', u'Person 3'])
+        self.assertEquals(token, None)
+
+    def testPaginateNull(self):
+        class Person(object):
+            nick = StringField()
+
+        for nick in [None, u'a', None, u'b', None]:
+            p = Person()
+            p.nick = nick
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+        orders = [(1, [[None, None], [None, u'a'], [u'b']]),
+                  (-1, [[u'b', u'a'], [None, None], [None]])]
+        for direction, expected in orders:
+            pages = []
+            token = None
+            while True:
+                page, token = self.store.paginate(
+                    Person, None, 'nick', 2, after=token,
+                    direction=direction)
+                self.assertOp(Person, name='find')
+                pages.append([person.nick for person in page])
+                if token is None:
+                    break
+            self.assertEquals(pages, expected)
+
+
+class TestResultSet(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+
+        class Person(object):
+            name = StringField()
+            age = IntField()
+        self.Person = Person
+
+        for i, name in enumerate(['Anne', 'Bob', 'Carl', 'Dave']):
+            p = Person()
+            p.name = name
+            p.age = 20 + i
+            self.store.add(p)
+        self.store.flush()
+        self.assertOp(Person, name='insert')
+
+    def testLazy(self):
+        results = self.store.find(self.Person)
+        self.failIf(self.getCollection(self.Person).ops)
+        self.assertEquals(len(list(results)), 4)
+        self.assertOp(self.Person, name='find')
+
+    def testCount(self):
+        self.assertEquals(self.store.find(self.Person).count(), 4)
+        self.assertOp(self.Person, name='find')
+        self.assertEquals(self.store.count(self.Person,
+                                           {'age': {'$gt': 21}}), 2)
+        self.assertOp(self.Person, name='find',
+                      args=({'age': {'$gt': 21}}, ))
+        self.assertEquals(
+            self.store.find(self.Person).skip(1).limit(2).count(), 2)
+        self.assertOp(self.Person, name='find',
+                      kwargs=dict(skip=1, limit=2))
+
+    def testChaining(self):
+        results = self.store.find(self.Person)
+        ordered = results.sort('age', -1)
+        self.failIf(ordered is results)
+        self.assertEquals([p.name for p in ordered.skip(1).limit(2)],
+                          ['Carl', 'Bob'])
+        self.assertOp(self.Person, name='find',
+                      kwargs=dict(fields=['age', 'name'],
+                                  sort=[('age', -1)], skip=1, limit=2))
+        self.assertEquals(
+            [p.name for p in results.sort([('name', 1)]).batch_size(2)],
+            ['Anne', 'Bob', 'Carl', 'Dave'])
+        self.assertOp(self.Person, name='find')
+
+    def testFirstOne(self):
+        results = self.store.find(self.Person).sort('name')
+        self.assertEquals(results.first().name, 'Anne')
+        self.assertOp(self.Person, name='find_one')
+        self.assertRaises(NotOneError, results.one)
+        self.assertOp(self.Person, name='find')
+        bob = self.store.find_by(self.Person, name='Bob').one()
+        self.assertEquals(bob.age, 21)
+        self.assertOp(self.Person, name='find')
+        self.assertEquals(self.store.find_by(self.Person, name='Eve').one(),
+                          None)
+        self.assertOp(self.Person, name='find')
+        self.assertEquals(self.store.find_by(self.Person, name='Eve').first(),
+                          None)
+        self.assertOp(self.Person, name='find_one')
+
+    def testValues(self):
+        results = self.store.find(self.Person, {'age': {'$lt': 22}})
+        self.assertEquals(sorted(results.values('name', 'age')),
+                          [('Anne', 20), ('Bob', 21)])
+        self.assertOp(self.Person, name='find',
+                      kwargs=dict(fields=['name', 'age']))
+        self.assertRaises(ValueError, results.values, 'foo')
+
+    def testSet(self):
+        bob = self.store.find_one_by(self.Person, name='Bob')
+        self.assertOp(self.Person, name='find_one')
+        self.store.find(self.Person, {'age': {'$gt': 20}}).set(age=30)
+        self.assertOp(self.Person, name='update',
+                      args=({'age': {'$gt': 20}}, {'$set': {'age': 30}}),
+                      kwargs=dict(multi=True))
+        self.assertEquals(bob.age, 30)
+        self.assertOp(self.Person, name='find_one')
+        self.assertEquals(bob.name, 'Bob')
+        self.assertEquals(self.store.count(self.Person, {'age': 30}), 3)
+        self.assertOp(self.Person, name='find')
+
+    def testRemove(self):
+        self.store.find_by(self.Person, name='Bob').remove()
+        self.assertOp(self.Person, name='remove', args=({'name': 'Bob'}, ))
+        self.assertEquals(self.store.count(self.Person), 3)
+        self.assertOp(self.Person, name='find')
+
+    def testIterValues(self):
+        class Account(object):
+            name = StringField()
+            balance = DecimalField()
+
+        a = Account()
+        a.name = 'Savings'
+        a.balance = decimal.Decimal('12.50')
+        self.store.add(a)
+        self.store.flush()
+        self.assertOp(Account, name='insert')
+        self.store.drop_cache()
+
+        rows = list(self.store.iter_values(Account, ['_id', 'name', 'balance'],
+                                           {'name': 'Savings'}))
+        self.assertOp(Account, name='find')
+        self.assertEquals(rows, [(a._id, 'Savings', decimal.Decimal('12.50'))])
+        self.assertEquals(rows[0]._id, a._id)
+        self.assertEquals(rows[0].balance, decimal.Decimal('12.50'))
+        self.assertEquals(self.store.get_cache_stats()['size'], 0)
+
+    def testReadAhead(self):
+        results = self.store.find(self.Person).sort('age').batch_size(1)
+        people = list(results.read_ahead(2))
+        self.assertOp(self.Person, name='find')
+        self.assertEquals([p.name for p in people],
+                          ['Anne', 'Bob', 'Carl', 'Dave'])
+
+        # Closing the iterator stops the reading thread.
+        iterator = iter(results.read_ahead(1))
+        self.failUnless(iterator.next() is people[0])
+        self.assertOp(self.Person, name='find')
+        iterator.close()
+        for thread in threading.enumerate():
+            if thread.name == 'thunder-read-ahead':
+                thread.join(1)
+                self.failIf(thread.is_alive())
+
+        results = self.store.find(self.Person, {'age': {'$unknown': 1}})
+        self.assertRaises(Exception, list, results.read_ahead())
+        self.assertOp(self.Person, name='find')
@@ -0,0 +1,97 @@
+from thunder.fields import IntField, StringField
+from thunder.info import get_obj_info
+from thunder.testutils import StoreTest
+
+
+class Product(object):
+    sku = StringField()
+    region = StringField()
+    name = StringField()
+    stock = IntField(default=0)
+
+
+class TestUpsertMany(StoreTest):
+    def testUpsert(self):
+        result = self.store.upsert_many(Product, [
+            dict(sku=u'a', name=u'Apple'),
+            dict(sku=u'b', name=u'Banana', stock=3),
+        ], key=['sku'])
+        self.assertOp(Product, name='insert')
+        self.assertOp(Product, name='find')
+        self.assertEquals(result, dict(created=2, updated=0, unchanged=0))
+
+        apple = self.store.find_one_by(Product, sku=u'a')
+        self.assertOp(Product, name='find_one')
+        self.assertEquals((apple.name, apple.stock), (u'Apple', 0))
+
+        result = self.store.upsert_many(Product, [
+            dict(sku=u'a', name=u'Green apple'),
+            dict(sku=u'b', name=u'Banana'),
+            dict(sku=u'c', name=u'Cherry'),
+            dict(sku=u'c', stock=5),
+        ], key=['sku'], hydrate=True)
+        self.assertOp(Product, name='insert')
+        self.assertOp(Product, name='update',
+                      args=({'_id': apple._id},
+                            {'$set': {'name': u'Green apple'}}))
+        self.assertOp(Product, name='find')
+        objects = result.pop('objects')
+        self.assertEquals(result, dict(created=1, updated=2, unchanged=1))
+        self.failUnless(objects[0] is apple)
+        self.assertEquals(apple.name, u'Green apple')
+        self.failIf(get_obj_info(apple).flush_pending)
+        self.assertEquals([obj.sku for obj in objects],
+                          [u'a', u'b', u'c', u'c'])
+        self.failUnless(objects[2] is objects[3])
+        self.assertEquals(objects[3].stock, 5)
+        self.failIf(self.getCollection(Product).ops)
+
+        self.assertEquals(self.store.count(Product), 3)
+        self.assertOp(Product, name='find')
+
+    def testCompoundKey(self):
+        records = [dict(sku=u'a', region=region, stock=1)
+                   for region in [u'eu', u'us']]
+        self.store.upsert_many(Product, records, key=('sku', 'region'))
+        records[1]['stock'] = 2
+        result = self.store.upsert_many(Product, records,
+                                        key=('sku', 'region'))
+        self.assertEquals(result, dict(created=0, updated=1, unchanged=1))
+        for name in ['update', 'find', 'insert', 'find']:
+            self.assertOp(Product, name=name)
+
+        self.assertRaises(ValueError, self.store.upsert_many, Product,
+                          [dict(name=u'x')], key=['sku'])
+        self.assertRaises(ValueError, self.store.upsert_many, Product,
+                          [dict(sku=u'x', unknown=1)], key=['sku'])
+        self.assertRaises(ValueError, self.store.upsert_many, Product,
+                          [], key=['unknown'])
+
+    def testConcurrentInsert(self):
+        self.store.database['Product'].ensure_index('sku', unique=True)
+        other = dict(sku=u'a', name=u'Other', stock=7)
+
+        def insert_other(name, *args):
+            # Another process inserts a record after it was looked up.
+            if other.pop('sku', None):
+                self.store.database['Product'].insert(
+                    dict(other, sku=u'a'))
+        self.store.add_listener(insert_other, ['insert'])
+
+        result = self.store.upsert_many(Product, [
+            dict(sku=u'a', name=u'Apple'),
+            dict(sku=u'b', name=u'Banana'),
+        ], key=['sku'], hydrate=True)
+        objects = result.pop('objects')
+        self.assertEquals(result, dict(created=1, updated=1, unchanged=0))
+        self.assertEquals([(obj.sku, obj.name, obj.stock) for obj in objects],
+                          [(u'a', u'Apple', 7), (u'b', u'Banana', 0)])
+        self.assertEquals(self.store.count(Product), 2)
+        self.assertOp(Product, name='find')
+        # The order of the inserts depends on the one of a dict.
+        ops = self.getCollection(Product).ops
+        self.assertEquals([op.args for op in ops
+                           if op.name == 'find_and_modify'],
+                          [({'sku': u'a'}, {'$set': {'sku': u'a',
+                                                     'name': u'Apple'}})])
+        del ops[:]
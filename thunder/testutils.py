@@ -1,12 +1,17 @@
+import os
 import unittest
 
 from thunder.info import get_cls_info
 from thunder.store import Store
 
+# The tests use the in-memory engine unless THUNDER_TEST_URI points
+# them to a server, eg THUNDER_TEST_URI=localhost.
+TEST_URI = os.environ.get('THUNDER_TEST_URI', 'memory://')
+
 
 class StoreTest(unittest.TestCase):
     def setUp(self):
-        self.store = Store('localhost', 'thunder-test')
+        self.store = Store(TEST_URI, 'thunder-test')
         self.store.trace = True
 
     def tearDown(self):
@@ -1,5 +1,6 @@
 import os
 import collections
+import operator
 import time
 
 
@@ -9,10 +10,91 @@ Op = collections.namedtuple('Op', ['name', 'args', 'kwargs', 'time'])
 THUNDER_DEBUG = os.environ.get('THUNDER_DEBUG') == '1'
 
 
+def row_type(name, fields):
+    """Creates a tuple subclass with attribute access to its items,
+    like collections.namedtuple but allowing names such as _id.
+    """
+    namespace = dict(__slots__=(), _fields=tuple(fields))
+    for i, field in enumerate(fields):
+        namespace[field] = property(operator.itemgetter(i))
+
+    def __repr__(self):
+        return '%s(%s)' % (name, ', '.join(
+            '%s=%r' % item for item in zip(fields, self)))
+    namespace['__repr__'] = __repr__
+    return type(name, (tuple, ), namespace)
+
+
+class TraceCursor(object):
+    """Wraps a cursor returned by a profiled TraceCollection.find, the
+    time spent fetching the documents and their number are reported
+    to the profiler once all of them have been read.
+    """
+
+    def __init__(self, cursor, collection, spec):
+        self.cursor = cursor
+        self.collection = collection
+        self.spec = spec
+        self.time = 0
+        self.returned = 0
+        self.done = False
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            doc = self.cursor.next()
+        except StopIteration:
+            self.time += time.time() - start
+            if not self.done:
+                self.done = True
+                self.collection.profile('find', self.spec, self.time,
+                                        self.returned)
+            raise
+        self.time += time.time() - start
+        self.returned += 1
+        return doc
+
+    def count(self, *args, **kwargs):
+        start = time.time()
+        retval = self.cursor.count(*args, **kwargs)
+        end = time.time()
+        self.collection.profile('count', self.spec, end - start)
+        return retval
+
+    def batch_size(self, *args, **kwargs):
+        self.cursor.batch_size(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self.cursor.limit(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self.cursor.skip(*args, **kwargs)
+        return self
+
+    def sort(self, *args, **kwargs):
+        self.cursor.sort(*args, **kwargs)
+        return self
+
+
 class TraceCollection(object):
-    def __init__(self, collection):
+    def __init__(self, collection, profiler=None, record=True):
         self.collection = collection
-        self.ops = []
+        self.profiler = profiler
+        # Ops are only kept when tracing, not when just profiling.
+        self.ops = [] if record else None
+
+    def profile(self, name, spec, elapsed, returned=None):
+        if self.profiler is not None:
+            self.profiler.add(self.collection, name, spec, elapsed,
+                              returned)
 
     def add(self, op):
         if THUNDER_DEBUG:  # pragma nocoverage
@@ -24,13 +106,17 @@ class TraceCollection(object):
             args.extend(s)
             print '%.6f %-.2f msec: %s%s' % (
                 time.time(), op.time * 1000, op.name, ', '.join(args))
-        self.ops.append(op)
+        if self.ops is not None:
+            self.ops.append(op)
 
     def find(self, *args, **kwargs):
         start = time.time()
         retval = self.collection.find(*args, **kwargs)
         end = time.time()
         self.add(Op('find', args, kwargs, end - start))
+        if self.profiler is not None:
+            spec = args and args[0] or kwargs.get('spec')
+            retval = TraceCursor(retval, self, spec)
         return retval
 
     def find_one(self, *args, **kwargs):
@@ -38,6 +124,8 @@ class TraceCollection(object):
         retval = self.collection.find_one(*args, **kwargs)
         end = time.time()
         self.add(Op('find_one', args, kwargs, end - start))
+        self.profile('find_one', args and args[0] or kwargs.get('spec_or_id'),
+                     end - start, int(retval is not None))
         return retval
 
     def count(self, *args, **kwargs):
@@ -45,6 +133,7 @@ class TraceCollection(object):
         retval = self.collection.count(*args, **kwargs)
         end = time.time()
         self.add(Op('count', args, kwargs, end - start))
+        self.profile('count', None, end - start)
         return retval
 
     def save(self, *args, **kwargs):
@@ -54,11 +143,60 @@ class TraceCollection(object):
         self.add(Op('save', args, kwargs, end - start))
         return retval
 
+    def insert(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.insert(*args, **kwargs)
+        end = time.time()
+        self.add(Op('insert', args, kwargs, end - start))
+        return retval
+
+    def update(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.update(*args, **kwargs)
+        end = time.time()
+        self.add(Op('update', args, kwargs, end - start))
+        self.profile('update', args and args[0] or kwargs.get('spec'),
+                     end - start)
+        return retval
+
+    def find_and_modify(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.find_and_modify(*args, **kwargs)
+        end = time.time()
+        self.add(Op('find_and_modify', args, kwargs, end - start))
+        self.profile('find_and_modify',
+                     args and args[0] or kwargs.get('query'), end - start,
+                     int(retval is not None))
+        return retval
+
     def remove(self, *args, **kwargs):
         start = time.time()
         retval = self.collection.remove(*args, **kwargs)
         end = time.time()
         self.add(Op('remove', args, kwargs, end - start))
+        self.profile('remove', args and args[0] or kwargs.get('spec_or_id'),
+                     end - start)
+        return retval
+
+    def create_index(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.create_index(*args, **kwargs)
+        end = time.time()
+        self.add(Op('create_index', args, kwargs, end - start))
+        return retval
+
+    def drop_index(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.drop_index(*args, **kwargs)
+        end = time.time()
+        self.add(Op('drop_index', args, kwargs, end - start))
+        return retval
+
+    def index_information(self, *args, **kwargs):
+        start = time.time()
+        retval = self.collection.index_information(*args, **kwargs)
+        end = time.time()
+        self.add(Op('index_information', args, kwargs, end - start))
         return retval
 
     def drop(self, *args, **kwargs):  # pragma nocoverage